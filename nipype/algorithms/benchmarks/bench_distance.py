@@ -0,0 +1,55 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the surface distance metrics of misc.Distance
+
+The masks are ellipsoids the size of a brain and of a large structure on the
+2mm MNI grid. The distance matrices computed before would have needed the
+memory reported next to the timings.
+
+Run with ``python -c "import nipype; nipype.bench()"`` or directly with
+``nosetests -s --match bench bench_distance.py``.
+"""
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import nibabel as nb
+import numpy as np
+
+import nipype.algorithms.misc as misc
+
+
+def make_ellipsoid(filename, center, radii, shape=(91, 109, 91)):
+    grid = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    sq = sum([((grid[i] - center[i]) / float(radii[i])) ** 2
+              for i in range(3)])
+    affine = np.diag([-2., 2., 2., 1.])
+    affine[:3, 3] = [90, -126, -72]
+    nb.save(nb.Nifti1Image((sq <= 1).astype(np.uint8), affine), filename)
+
+
+def bench_distance():
+    tempdir = mkdtemp(prefix='bench_distance_')
+    brain = os.path.join(tempdir, 'brain.nii')
+    structure = os.path.join(tempdir, 'structure.nii')
+    make_ellipsoid(brain, (45, 54, 40), (34, 44, 34))
+    make_ellipsoid(structure, (52, 60, 45), (18, 25, 20))
+    dist = misc.Distance()
+    n_voxels = [int(nb.load(f).get_data().sum()) for f in (brain, structure)]
+    n_border = [int(dist._find_border(nb.load(f).get_data() > 0).sum())
+                for f in (brain, structure)]
+    print
+    print 'voxels: %d / %d, border voxels: %d / %d' % tuple(n_voxels +
+                                                           n_border)
+    matrix_sizes = {'eucl_min': n_border[0] * n_border[1],
+                    'eucl_max': n_border[0] * n_border[1],
+                    'eucl_mean': n_border[0] * n_voxels[1],
+                    'eucl_wmean': n_border[0] * n_voxels[1]}
+    for method in ['eucl_min', 'eucl_max', 'eucl_mean', 'eucl_wmean']:
+        t0 = time()
+        misc.Distance(volume1=brain, volume2=structure, method=method,
+                      mask_volume=brain).run()
+        print '%-10s: %6.2f s (distance matrix: %.1f GB)' % (
+            method, time() - t0, matrix_sizes[method] * 8 / 1024. ** 3)
+    rmtree(tempdir)
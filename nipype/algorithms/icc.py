@@ -1,7 +1,6 @@
-from numpy import ones, kron, mean, eye, hstack, dot, tile
-from scipy.linalg import pinv
 from ..interfaces.base import BaseInterfaceInputSpec, TraitedSpec, \
     BaseInterface, traits, File
+from .misc import _read_slab
 import nibabel as nb
 import numpy as np
 import os
@@ -12,12 +11,16 @@ class ICCInputSpec(BaseInterfaceInputSpec):
                            desc="n subjects m sessions 3D stat files",
                            mandatory=True)
     mask = File(exists=True, mandatory=True)
+    chunk_size = traits.Int(100000, usedefault=True,
+                            desc=('maximum number of voxels processed at '
+                                  'once (rounded to whole slices)'))
 
 
 class ICCOutputSpec(TraitedSpec):
     icc_map = File(exists=True)
     session_var_map = File(exists=True, desc="variance between sessions")
     subject_var_map = File(exists=True, desc="variance between subjects")
+    sessions_F_map = File(exists=True, desc="F statistic of the session effect")
 
 
 class ICC(BaseInterface):
@@ -26,6 +29,9 @@ class ICC(BaseInterface):
     P. E. Shrout & Joseph L. Fleiss (1979). "Intraclass Correlations: Uses in
     Assessing Rater Reliability". Psychological Bulletin 86 (2): 420-428. This
     particular implementation is aimed at relaibility (test-retest) studies.
+
+    The voxels of the mask are processed in slabs of whole slices holding at
+    most chunk_size voxels, and each stat file is read once per slab.
     '''
     input_spec = ICCInputSpec
     output_spec = ICCOutputSpec
@@ -34,33 +40,41 @@ class ICC(BaseInterface):
         maskdata = nb.load(self.inputs.mask).get_data()
         maskdata = np.logical_not(np.logical_or(maskdata == 0, np.isnan(maskdata)))
 
-        session_datas = [[nb.load(fname).get_data()[maskdata].reshape(-1, 1) for fname in sessions] for sessions in self.inputs.subjects_sessions]
-        list_of_sessions = [np.dstack(session_data) for session_data in session_datas]
-        all_data = np.hstack(list_of_sessions)
-        icc = np.zeros(session_datas[0][0].shape)
-        session_F = np.zeros(session_datas[0][0].shape)
-        session_var = np.zeros(session_datas[0][0].shape)
-        subject_var = np.zeros(session_datas[0][0].shape)
-
-        for x in range(icc.shape[0]):
-            Y = all_data[x, :, :]
-            icc[x], subject_var[x], session_var[x],  session_F[x], _, _ = ICC_rep_anova(Y)
+        voxels = np.flatnonzero(maskdata.ravel(order='F'))
+        imgs = [[nb.load(fname) for fname in sessions]
+                for sessions in self.inputs.subjects_sessions]
+        icc = np.zeros(voxels.shape)
+        session_F = np.zeros(voxels.shape)
+        session_var = np.zeros(voxels.shape)
+        subject_var = np.zeros(voxels.shape)
+
+        shape = maskdata.shape
+        slice_size = shape[0] * shape[1]
+        n_slices = max(1, self.inputs.chunk_size // slice_size)
+        for start in range(0, shape[2], n_slices):
+            slab = slice(start, min(start + n_slices, shape[2]))
+            # the mask voxels of the slab, in the Fortran order of `voxels`
+            chunk = slice(*np.searchsorted(voxels, [slab.start * slice_size,
+                                                    slab.stop * slice_size]))
+            if chunk.start == chunk.stop:
+                continue
+            offsets = voxels[chunk] - slab.start * slice_size
+            # voxels x subjects x sessions
+            Y = np.array([[_read_slab(img, slab).ravel(order='F')[offsets]
+                           for img in sessions]
+                          for sessions in imgs]).transpose(2, 0, 1)
+            icc[chunk], subject_var[chunk], session_var[chunk], \
+                session_F[chunk], _, _ = ICC_rep_anova(Y)
 
         nim = nb.load(self.inputs.subjects_sessions[0][0])
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = icc.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'icc_map.nii')
-
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = session_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'session_var_map.nii')
-
-        new_data = np.zeros(nim.get_shape())
-        new_data[maskdata] = subject_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
-        nb.save(new_img, 'subject_var_map.nii')
+        for values, filename in [(icc, 'icc_map.nii'),
+                                 (session_var, 'session_var_map.nii'),
+                                 (subject_var, 'subject_var_map.nii'),
+                                 (session_F, 'sessions_F_map.nii')]:
+            new_data = np.zeros(nim.get_shape(), order='F')
+            new_data.reshape(-1, order='F')[voxels] = values
+            new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
+            nb.save(new_img, filename)
 
         return runtime
 
@@ -76,15 +90,20 @@ class ICC(BaseInterface):
 def ICC_rep_anova(Y):
     '''
     the data Y are entered as a 'table' ie subjects are in rows and repeated
-    measures in columns
+    measures in columns. A 3D array is a stack of such tables (e.g. one per
+    voxel) and all of them are computed at once.
 
     --------------------------------------------------------------------------
                        One Sample Repeated measure ANOVA
                        Y = XB + E with X = [FaTor / Subjects]
     --------------------------------------------------------------------------
+
+    The design is balanced, so the fit of X is the sum of the row and column
+    means minus the grand mean and the sums of squares have closed forms.
     '''
 
-    [nb_subjects, nb_conditions] = Y.shape
+    Y = np.asarray(Y, dtype=np.float64)
+    [nb_subjects, nb_conditions] = Y.shape[-2:]
     dfc = nb_conditions - 1
     dfe = (nb_subjects - 1) * dfc
     dfr = nb_subjects - 1
@@ -93,25 +112,19 @@ def ICC_rep_anova(Y):
     # ------------------------------------
 
     # Sum Square Total
-    mean_Y = mean(Y)
-    SST = ((Y - mean_Y) ** 2).sum()
-
-    # create the design matrix for the different levels
-    x = kron(eye(nb_conditions), ones((nb_subjects, 1)))  # sessions
-    x0 = tile(eye(nb_subjects), (nb_conditions, 1))  # subjects
-    X = hstack([x, x0])
+    mean_Y = Y.mean(axis=-1).mean(axis=-1)[..., None, None]
+    SST = ((Y - mean_Y) ** 2).sum(axis=-1).sum(axis=-1)
 
     # Sum Square Error
-    predicted_Y = dot(dot(dot(X, pinv(dot(X.T, X))), X.T), Y.flatten('F'))
-    residuals = Y.flatten('F') - predicted_Y
-    SSE = (residuals ** 2).sum()
-
-    residuals.shape = Y.shape
+    subject_means = Y.mean(axis=-1)[..., :, None]
+    session_means = Y.mean(axis=-2)[..., None, :]
+    residuals = Y - subject_means - session_means + mean_Y
+    SSE = (residuals ** 2).sum(axis=-1).sum(axis=-1)
 
     MSE = SSE / dfe
 
     # Sum square session effect - between colums/sessions
-    SSC = ((mean(Y, 0) - mean_Y) ** 2).sum() * nb_subjects
+    SSC = ((session_means - mean_Y) ** 2).sum(axis=-1).sum(axis=-1) * nb_subjects
     MSC = SSC / dfc / nb_subjects
 
     session_effect_F = MSC / MSE
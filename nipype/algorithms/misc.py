@@ -19,6 +19,10 @@ from math import floor, ceil
 from scipy.ndimage.morphology import grey_dilation
 from scipy.ndimage.morphology import binary_erosion
 from scipy.spatial.distance import cdist, euclidean, dice, jaccard
+try:
+    from scipy.spatial import cKDTree as KDTree
+except ImportError:
+    from scipy.spatial import KDTree
 from scipy.ndimage.measurements import center_of_mass, label
 from scipy.special import legendre
 import scipy.io as sio
@@ -77,18 +81,17 @@ class PickAtlas(BaseInterface):
     def _get_brodmann_area(self):
         nii = nb.load(self.inputs.atlas)
         origdata = nii.get_data()
-        newdata = np.zeros(origdata.shape)
 
         if not isinstance(self.inputs.labels, list):
             labels = [self.inputs.labels]
         else:
             labels = self.inputs.labels
-        for lab in labels:
-            newdata[origdata == lab] = 1
+        newdata = np.in1d(origdata.ravel(), labels).reshape(origdata.shape)
+        newdata = newdata.astype(np.float64)
         if self.inputs.hemi == 'right':
-            newdata[floor(float(origdata.shape[0]) / 2):, :, :] = 0
+            newdata[int(floor(float(origdata.shape[0]) / 2)):, :, :] = 0
         elif self.inputs.hemi == 'left':
-            newdata[:ceil(float(origdata.shape[0]) / 2), :, : ] = 0
+            newdata[:int(ceil(float(origdata.shape[0]) / 2)), :, : ] = 0
 
         if self.inputs.dilation_size != 0:
             newdata = grey_dilation(newdata , (2 * self.inputs.dilation_size + 1,
@@ -190,18 +193,27 @@ class DistanceInputSpec(BaseInterfaceInputSpec):
     "eucl_max": maximum over minimum Euclidian distances of all volume2 voxels to volume1 (also known as the Hausdorff distance)',
     usedefault=True)
     mask_volume = File(exists=True, desc="calculate overlap only within this mask.")
+    create_histogram = traits.Bool(False, usedefault=True,
+                                   desc=('plot a histogram of the minimum '
+                                         'distances (eucl_mean and '
+                                         'eucl_wmean)'))
 
 
 class DistanceOutputSpec(TraitedSpec):
     distance = traits.Float()
     point1 = traits.Array(shape=(3,))
     point2 = traits.Array(shape=(3,))
-    histogram = File()
+    histogram = File(desc=('histogram of the minimum distances (only with '
+                           'create_histogram)'))
 
 
 class Distance(BaseInterface):
     '''
     Calculates distance between two volumes.
+
+    Minimum distances between the voxels of both volumes are found with
+    nearest neighbour queries on a KD-tree, which requires memory linear in
+    the number of voxels.
     '''
     input_spec = DistanceInputSpec
     output_spec = DistanceOutputSpec
@@ -221,6 +233,12 @@ class Distance(BaseInterface):
         coordinates = np.dot(affine, indices)
         return coordinates[:3, :]
 
+    def _min_distances(self, set1_coordinates, set2_coordinates):
+        """Returns for every point of set2 the distance to the closest point
+        of set1 and the index of that point"""
+        tree = KDTree(set1_coordinates.T)
+        return tree.query(set2_coordinates.T)
+
     def _eucl_min(self, nii1, nii2):
         origdata1 = nii1.get_data().astype(np.bool)
         border1 = self._find_border(origdata1)
@@ -232,8 +250,10 @@ class Distance(BaseInterface):
 
         set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        (point1, point2) = np.unravel_index(np.argmin(dist_matrix), dist_matrix.shape)
+        distances, indices = self._min_distances(set1_coordinates,
+                                                 set2_coordinates)
+        point2 = np.argmin(distances)
+        point1 = indices[point2]
         return (euclidean(set1_coordinates.T[point1, :], set2_coordinates.T[point2, :]), set1_coordinates.T[point1, :], set2_coordinates.T[point2, :])
 
     def _eucl_cog(self, nii1, nii2):
@@ -265,14 +285,10 @@ class Distance(BaseInterface):
         set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
         set2_coordinates = self._get_coordinates(origdata2, nii2.get_affine())
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        min_dist_matrix = np.amin(dist_matrix, axis=0)
-        import matplotlib.pyplot as plt
-        plt.figure()
-        plt.hist(min_dist_matrix, 50, normed=1, facecolor='green')
-        plt.savefig(self._hist_filename)
-        plt.clf()
-        plt.close()
+        min_dist_matrix, _ = self._min_distances(set1_coordinates,
+                                                 set2_coordinates)
+        if self.inputs.create_histogram:
+            self._plot_histogram(min_dist_matrix)
 
         if weighted:
             return np.average(min_dist_matrix, weights=nii2.get_data()[origdata2].flat)
@@ -299,11 +315,21 @@ class Distance(BaseInterface):
 
         set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
         set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
-        distances = cdist(set1_coordinates.T, set2_coordinates.T)
-        mins = np.concatenate((np.amin(distances, axis=0), np.amin(distances, axis=1)))
+        mins = np.concatenate((self._min_distances(set1_coordinates,
+                                                   set2_coordinates)[0],
+                               self._min_distances(set2_coordinates,
+                                                   set1_coordinates)[0]))
 
         return np.max(mins)
 
+    def _plot_histogram(self, distances):
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plt.hist(distances, 50, normed=1, facecolor='green')
+        plt.savefig(self._hist_filename)
+        plt.clf()
+        plt.close()
+
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
         nii2 = nb.load(self.inputs.volume2)
@@ -330,7 +356,8 @@ class Distance(BaseInterface):
         if self.inputs.method == "eucl_min":
             outputs['point1'] = self._point1
             outputs['point2'] = self._point2
-        elif self.inputs.method in ["eucl_mean", "eucl_wmean"]:
+        elif (self.inputs.method in ["eucl_mean", "eucl_wmean"] and
+              self.inputs.create_histogram):
             outputs['histogram'] = os.path.abspath(self._hist_filename)
         return outputs
 
@@ -340,6 +367,9 @@ class OverlapInputSpec(BaseInterfaceInputSpec):
     volume2 = File(exists=True, mandatory=True, desc="Has to have the same dimensions as volume1.")
     mask_volume = File(exists=True, desc="calculate overlap only within this mask.")
     out_file = File("diff.nii", usedefault=True)
+    multi_label = traits.Bool(False, usedefault=True,
+                              desc=("treat the volumes as label maps and "
+                                    "compute the overlap of every label"))
 
 
 class OverlapOutputSpec(TraitedSpec):
@@ -347,12 +377,20 @@ class OverlapOutputSpec(TraitedSpec):
     dice = traits.Float()
     volume_difference = traits.Int()
     diff_file = File(exists=True)
+    labels = traits.List(traits.Int, desc="labels found in either volume")
+    roi_ji = traits.List(traits.Float, desc="jaccard index of every label")
+    roi_di = traits.List(traits.Float, desc="dice index of every label")
+    roi_voldiff = traits.List(traits.Int,
+                              desc="volume difference of every label")
 
 
 class Overlap(BaseInterface):
     """
     Calculates various overlap measures between two maps.
 
+    With multi_label the volumes are label maps: the overlap of every label
+    is computed in a single pass from the joint histogram of both maps.
+
     Example
     -------
 
@@ -371,19 +409,53 @@ class Overlap(BaseInterface):
             return 0
         return 1 - methods[method](booldata1.flat, booldata2.flat)
 
+    def _label_overlaps(self, labeldata1, labeldata2, maskdata=None):
+        """Returns labels and their dice, jaccard and volume difference
+
+        Both maps are converted to indices into the sorted union of their
+        labels and counted once with bincount.
+        """
+        labeldata1 = np.nan_to_num(labeldata1)
+        labeldata2 = np.nan_to_num(labeldata2)
+        if maskdata is not None:
+            labeldata1 = labeldata1[maskdata]
+            labeldata2 = labeldata2[maskdata]
+        labels = np.union1d(np.unique(labeldata1), np.unique(labeldata2))
+        labels = np.union1d(labels, [0])
+        n_labels = len(labels)
+        index1 = np.searchsorted(labels, labeldata1.ravel())
+        index2 = np.searchsorted(labels, labeldata2.ravel())
+        joint = np.bincount(index1 * n_labels + index2,
+                            minlength=n_labels ** 2).reshape(n_labels,
+                                                             n_labels)
+        nonzero = labels != 0
+        both = np.diag(joint)[nonzero].astype(np.float64)
+        volume1 = joint.sum(axis=1)[nonzero]
+        volume2 = joint.sum(axis=0)[nonzero]
+        dice = 2 * both / (volume1 + volume2)
+        jaccard = both / (volume1 + volume2 - both)
+        return labels[nonzero], dice, jaccard, volume1 - volume2
+
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
         nii2 = nb.load(self.inputs.volume2)
+        data1 = nii1.get_data()
+        data2 = nii2.get_data()
 
-        origdata1 = np.logical_not(np.logical_or(nii1.get_data() == 0, np.isnan(nii1.get_data())))
-        origdata2 = np.logical_not(np.logical_or(nii2.get_data() == 0, np.isnan(nii2.get_data())))
+        origdata1 = np.logical_not(np.logical_or(data1 == 0, np.isnan(data1)))
+        origdata2 = np.logical_not(np.logical_or(data2 == 0, np.isnan(data2)))
 
+        maskdata = None
         if isdefined(self.inputs.mask_volume):
             maskdata = nb.load(self.inputs.mask_volume).get_data()
             maskdata = np.logical_not(np.logical_or(maskdata == 0, np.isnan(maskdata)))
             origdata1 = np.logical_and(maskdata, origdata1)
             origdata2 = np.logical_and(maskdata, origdata2)
 
+        if self.inputs.multi_label:
+            (self._labels, self._roi_di, self._roi_ji,
+             self._roi_voldiff) = self._label_overlaps(data1, data2, maskdata)
+
         for method in ("dice", "jaccard"):
             setattr(self, '_' + method, self._bool_vec_dissimilarity(origdata1, origdata2, method=method))
 
@@ -403,6 +475,11 @@ class Overlap(BaseInterface):
             outputs[method] = getattr(self, '_' + method)
         outputs['volume_difference'] = self._volume
         outputs['diff_file'] = os.path.abspath(self.inputs.out_file)
+        if self.inputs.multi_label:
+            outputs['labels'] = [int(label) for label in self._labels]
+            outputs['roi_di'] = self._roi_di.tolist()
+            outputs['roi_ji'] = self._roi_ji.tolist()
+            outputs['roi_voldiff'] = [int(diff) for diff in self._roi_voldiff]
         return outputs
 
 
@@ -444,10 +521,29 @@ class CreateNifti(BaseInterface):
         return outputs
 
 
+def _read_slab(img, slab):
+    """Returns the slices `slab` of a 3D or 4D image as a 4D float array
+
+    Only the requested slices are read from uncompressed files.
+    """
+    shape = img.get_shape()
+    if hasattr(img, 'dataobj'):
+        index = (slice(None), slice(None), slab) + (slice(None),) * (len(shape) - 3)
+        data = img.dataobj[index]
+    else:
+        data = img.get_data()[:, :, slab]
+    data = np.asarray(data, dtype=np.float64)
+    return data.reshape(data.shape[:3] + (-1,))
+
+
 class TSNRInputSpec(BaseInterfaceInputSpec):
     in_file = InputMultiPath(File(exists=True), mandatory=True,
                    desc='realigned 4D file or a list of 3D files')
     regress_poly = traits.Int(min=1, desc='Remove polynomials')
+    chunk_size = traits.Int(100000, usedefault=True,
+                            desc=('maximum number of voxel time series '
+                                  'processed at once (rounded to whole '
+                                  'slices)'))
 
 
 class TSNROutputSpec(TraitedSpec):
@@ -483,27 +579,41 @@ class TSNR(BaseInterface):
             return os.path.abspath(base + "_tsnr" + ext)
 
     def _run_interface(self, runtime):
-        img = nb.load(self.inputs.in_file[0])
-        header = img.get_header().copy()
         vollist = [nb.load(filename) for filename in self.inputs.in_file]
-        data = np.concatenate([vol.get_data().reshape(vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
-        if data.dtype.kind == 'i':
+        img = vollist[0]
+        header = img.get_header().copy()
+        shape = img.get_shape()[:3]
+        timepoints = sum([(vol.get_shape() + (1,))[3] for vol in vollist])
+        if header.get_data_dtype().kind in 'iu':
             header.set_data_dtype(np.float32)
-            data = data.astype(np.float32)
         if isdefined(self.inputs.regress_poly):
-            timepoints = img.get_shape()[-1]
             X = np.ones((timepoints, 1))
             for i in range(self.inputs.regress_poly):
                 X = np.hstack((X, legendre(i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
-            betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
-            datahat = np.rollaxis(np.dot(X[:, 1:],
-                                         np.rollaxis(betas[1:, :, :, :], 0, 3)),
-                                  0, 4)
-            data = data - datahat
-            img = nb.Nifti1Image(data, img.get_affine(), header)
-            nb.save(img, self._gen_output_file_name('detrended'))
-        meanimg = np.mean(data, axis=3)
-        stddevimg = np.std(data, axis=3)
+            # the fit of the polynomials is data . proj . trend
+            proj = np.linalg.pinv(X)[1:, :].T
+            trend = X[:, 1:].T
+            detrended = self._detrended_array(header, shape + (timepoints,))
+        meanimg = np.zeros(shape)
+        stddevimg = np.zeros(shape)
+        n_slices = max(1, self.inputs.chunk_size // (shape[0] * shape[1]))
+        for start in range(0, shape[2], n_slices):
+            slab = slice(start, min(start + n_slices, shape[2]))
+            data = np.concatenate([_read_slab(vol, slab) for vol in vollist],
+                                  axis=3)
+            if isdefined(self.inputs.regress_poly):
+                data -= np.dot(np.dot(data, proj), trend)
+                detrended[:, :, slab, :] = data
+            meanimg[:, :, slab] = np.mean(data, axis=3)
+            stddevimg[:, :, slab] = np.std(data, axis=3)
+            del data
+        if isdefined(self.inputs.regress_poly):
+            if isinstance(detrended, np.memmap):
+                detrended.flush()
+            else:
+                nb.save(nb.Nifti1Image(detrended, img.get_affine(), header),
+                        self._gen_output_file_name('detrended'))
+            del detrended
         tsnr = meanimg / stddevimg
         img = nb.Nifti1Image(tsnr, img.get_affine(), header)
         nb.save(img, self._gen_output_file_name())
@@ -513,6 +623,36 @@ class TSNR(BaseInterface):
         nb.save(img, self._gen_output_file_name('stddev'))
         return runtime
 
+    def _detrended_array(self, header, shape):
+        """Returns the array the detrended data is written to
+
+        Uncompressed NIfTI files are created upfront and memory-mapped, so
+        that the slabs go straight to disk; other formats are assembled in
+        memory and saved at the end.
+        """
+        filename = self._gen_output_file_name('detrended')
+        if not (isinstance(header, nb.Nifti1Header) and
+                filename.endswith('.nii')):
+            return np.zeros(shape, dtype=header.get_data_dtype())
+        header = header.copy()
+        header.set_data_shape(shape)
+        header.set_slope_inter(1, 0)
+        # the data start after the header and its extensions
+        offset = header.sizeof_hdr + 4
+        if header.extensions:
+            offset += header.extensions.get_sizeondisk()
+        offset = max(header.get_data_offset(), int(ceil(offset / 16.)) * 16)
+        header.set_data_offset(offset)
+        dtype = header.get_data_dtype()
+        fp = open(filename, 'wb')
+        header.write_to(fp)
+        fp.write('\0' * (offset - fp.tell()))
+        fp.seek(offset + dtype.itemsize * np.prod(shape) - 1)
+        fp.write('\0')
+        fp.close()
+        return np.memmap(filename, dtype=dtype, mode='r+', offset=offset,
+                         shape=shape, order='F')
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['tsnr_file'] = self._gen_output_file_name()
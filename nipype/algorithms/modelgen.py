@@ -24,6 +24,7 @@ import os
 from nibabel import load
 import numpy as np
 from scipy.special import gammaln
+from scipy.signal import fftconvolve
 
 from nipype.interfaces.base import (BaseInterface, TraitedSpec, InputMultiPath,
                                     traits, File, Bunch, BaseInterfaceInputSpec,
@@ -581,47 +582,48 @@ class SpecifySparseModel(SpecifyModel):
         iflogger.info("Setting dt = %d ms\n" % dt)
         npts = int(total_time/dt)
         times = np.arange(0, total_time, dt)*1e-3
-        timeline = np.zeros((npts))
-        timeline2 = np.zeros((npts))
         if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
             hrf = spm_hrf(dt*1e-3)
         reg_scale = 1.0
         if self.inputs.scale_regressors:
-            boxcar = np.zeros((50.*1e3/dt))
+            boxcar = np.zeros(int(50.*1e3/dt))
             if self.inputs.stimuli_as_impulses:
-                boxcar[1.*1e3/dt] = 1.0
+                boxcar[int(1.*1e3/dt)] = 1.0
                 reg_scale = float(TA/dt)
             else:
-                boxcar[1.*1e3/dt:2.*1e3/dt] = 1.0
+                boxcar[int(1.*1e3/dt):int(2.*1e3/dt)] = 1.0
             if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
                 response = np.convolve(boxcar, hrf)
                 reg_scale = 1./response.max()
                 iflogger.info('response sum: %.4f max: %.4f'%(response.sum(), response.max()))
             iflogger.info('reg_scale: %.4f'%reg_scale)
-        for i, t in enumerate(onsets):
-            idx = int(t/dt)
-            if i_amplitudes:
-                if len(i_amplitudes)>1:
-                    timeline2[idx] = i_amplitudes[i]
-                else:
-                    timeline2[idx] = i_amplitudes[0]
-            else:
-                timeline2[idx] = 1
-            if bplot:
-                plt.subplot(4, 1, 1)
-                plt.plot(times, timeline2)
-            if not self.inputs.stimuli_as_impulses:
-                if durations[i] == 0:
-                    durations[i] = TA*nvol
-                stimdur = np.ones((int(durations[i]/dt)))
-                timeline2 = np.convolve(timeline2, stimdur)[0:len(timeline2)]
-            timeline += timeline2
-            timeline2[:] = 0
+        starts = (onsets/dt).astype(int)
+        if i_amplitudes:
+            amplitudes = np.array(i_amplitudes, dtype=float)
+            if len(i_amplitudes) == 1:
+                amplitudes = amplitudes*np.ones(len(onsets))
+        else:
+            amplitudes = np.ones(len(onsets))
+        # all stimuli are accumulated at once: impulses directly, boxcars as
+        # differences (+amplitude at the onset, -amplitude at the offset)
+        # integrated by a cumulative sum
+        if self.inputs.stimuli_as_impulses:
+            timeline = np.bincount(starts, weights=amplitudes, minlength=npts)
+        else:
+            durations[durations == 0] = TA*nvol
+            ends = np.minimum(starts + (durations/dt).astype(int), npts)
+            delta = (np.bincount(starts, weights=amplitudes, minlength=npts + 1) -
+                     np.bincount(ends, weights=amplitudes, minlength=npts + 1))
+            timeline = np.cumsum(delta)[:npts]
         if bplot:
+            impulses = np.zeros((npts))
+            impulses[starts] = amplitudes
+            plt.subplot(4, 1, 1)
+            plt.plot(times, impulses)
             plt.subplot(4, 1, 2)
             plt.plot(times, timeline)
         if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
-            timeline = np.convolve(timeline, hrf)[0:len(timeline)]
+            timeline = fftconvolve(timeline, hrf)[0:len(timeline)]
             if isdefined(self.inputs.use_temporal_deriv) and self.inputs.use_temporal_deriv:
                 #create temporal deriv
                 timederiv = np.concatenate(([0], np.diff(timeline)))
@@ -630,22 +632,20 @@ class SpecifySparseModel(SpecifyModel):
             plt.plot(times, timeline)
             if isdefined(self.inputs.use_temporal_deriv) and self.inputs.use_temporal_deriv:
                 plt.plot(times, timederiv)
-        # sample timeline
-        timeline2 = np.zeros((npts))
-        reg = []
+        # sample timeline: one row of timeline indices per scan
+        scans = np.arange(nscans)
+        scanstart = ((SCANONSET + (scans//nvol)*TR + (scans%nvol)*TA)/dt).astype(int)
+        scanidx = scanstart[:, None] + np.arange(int(TA/dt))
+        reg = (np.mean(timeline[scanidx], axis=1)*reg_scale).tolist()
         regderiv = []
-        for i, trial in enumerate(np.arange(nscans)/nvol):
-            scanstart = int((SCANONSET + trial*TR + (i%nvol)*TA)/dt)
-            #print total_time/dt, SCANONSET, TR, TA, scanstart, trial, i%2, int(TA/dt)
-            scanidx = scanstart+np.arange(int(TA/dt))
-            timeline2[scanidx] = np.max(timeline)
-            reg.insert(i, np.mean(timeline[scanidx])*reg_scale)
-            if isdefined(self.inputs.use_temporal_deriv) and self.inputs.use_temporal_deriv:
-                regderiv.insert(i, np.mean(timederiv[scanidx])*reg_scale)
+        if isdefined(self.inputs.use_temporal_deriv) and self.inputs.use_temporal_deriv:
+            regderiv = (np.mean(timederiv[scanidx], axis=1)*reg_scale).tolist()
         if isdefined(self.inputs.use_temporal_deriv) and self.inputs.use_temporal_deriv:
             iflogger.info('orthoganlizing derivative w.r.t. main regressor')
             regderiv = orth(reg, regderiv)
         if bplot:
+            timeline2 = np.zeros((npts))
+            timeline2[scanidx] = np.max(timeline)
             plt.subplot(4, 1, 3)
             plt.plot(times, timeline2)
             plt.subplot(4, 1, 4)
@@ -21,7 +21,7 @@ These functions include:
 import os
 from copy import deepcopy
 
-from nibabel import load, funcs
+from nibabel import load
 import numpy as np
 from scipy import signal
 import scipy.io as sio
@@ -71,6 +71,8 @@ class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
                             usedefault=True)
     plot_type = traits.Enum('png', 'svg', 'eps', 'pdf', desc="file type of the outlier plot",
                             usedefault=True)
+    chunk_size = traits.Int(64, usedefault=True,
+                            desc="number of volumes read from disk at once")
 
 
 class ArtifactDetectOutputSpec(TraitedSpec):
@@ -175,29 +177,48 @@ class ArtifactDetect(BaseInterface):
         shear/affine (3)]
 
         """
-        rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)], [-np.sin(x), np.cos(x)]])
-        q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
-        if len(params) < 12:
-            params = np.hstack((params, q[len(params):]))
-        params.shape = (len(params),)
+        return self._get_affine_matrices(np.atleast_2d(params))[0]
+
+    def _get_affine_matrices(self, params):
+        """Returns one affine matrix per row of parameters
+
+        params : np.array (N x upto 12)
+        [translation (3), rotation (3, xyz, radians), scaling (3),
+        shear/affine (3)]
+
+        """
+        params = np.asarray(params, dtype=float)
+        n = params.shape[0]
+        q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0], dtype=float)
+        if params.shape[1] < 12:
+            params = np.hstack((params, np.tile(q[params.shape[1]:], (n, 1))))
+        identity = np.tile(np.eye(4), (n, 1, 1))
         # Translation
-        T = np.eye(4)
-        T[0:3, -1] = params[0:3]  # np.vstack((np.hstack((np.eye(3), params[0:3,])), np.array([0, 0, 0, 1])))
+        T = identity.copy()
+        T[:, 0:3, -1] = params[:, 0:3]
         # Rotation
-        Rx = np.eye(4)
-        Rx[1:3, 1:3] = rotfunc(params[3])
-        Ry = np.eye(4)
-        Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
-        Rz = np.eye(4)
-        Rz[0:2, 0:2] = rotfunc(params[5])
+        cos = np.cos(params[:, 3:6])
+        sin = np.sin(params[:, 3:6])
+        Rx = identity.copy()
+        Rx[:, (1, 1, 2, 2), (1, 2, 1, 2)] = np.column_stack((cos[:, 0], sin[:, 0],
+                                                              -sin[:, 0], cos[:, 0]))
+        Ry = identity.copy()
+        Ry[:, (0, 0, 2, 2), (0, 2, 0, 2)] = np.column_stack((cos[:, 1], sin[:, 1],
+                                                              -sin[:, 1], cos[:, 1]))
+        Rz = identity.copy()
+        Rz[:, (0, 0, 1, 1), (0, 1, 0, 1)] = np.column_stack((cos[:, 2], sin[:, 2],
+                                                              -sin[:, 2], cos[:, 2]))
         # Scaling
-        S = np.eye(4)
-        S[0:3, 0:3] = np.diag(params[6:9])
+        S = identity.copy()
+        S[:, (0, 1, 2), (0, 1, 2)] = params[:, 6:9]
         # Shear
-        Sh = np.eye(4)
-        Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+        Sh = identity.copy()
+        Sh[:, (0, 0, 1), (1, 2, 2)] = params[:, 9:12]
 
-        return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+        affines = Sh
+        for matrix in [S, Rz, Ry, Rx, T]:
+            affines = np.einsum('nij,njk->nik', matrix, affines)
+        return affines
 
     def _calc_norm(self, mc, use_differences):
         """Calculates the maximum overall displacement of the midpoints
@@ -220,14 +241,14 @@ class ArtifactDetect(BaseInterface):
         # respos=np.diag([50, 50, 50]);resneg=np.diag([-50,-50,-50]);
         # XXX - SG why not the above box
         cube_pts = np.vstack((np.hstack((respos, resneg)), np.ones((1, 6))))
-        newpos = np.zeros((mc.shape[0], 18))
-        for i in range(mc.shape[0]):
-            newpos[i, :] = np.dot(self._get_affine_matrix(mc[i, :]), cube_pts)[0:3, :].ravel()
-        normdata = np.zeros(mc.shape[0])
+        affines = self._get_affine_matrices(mc)
+        newpos = np.einsum('nij,jk->nik', affines[:, 0:3, :],
+                           cube_pts).reshape((mc.shape[0], 18))
         if use_differences:
             newpos = np.concatenate((np.zeros((1, 18)), np.diff(newpos, n=1, axis=0)), axis=0)
-            for i in range(newpos.shape[0]):
-                normdata[i] = np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos[i, :]), 2), (3, 6)), axis=0)))
+            normdata = np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos), 2),
+                                                        (newpos.shape[0], 3, 6)),
+                                             axis=1)), axis=1)
         else:
             #if not registered to mean we may want to use this
             #mc_sum = np.sum(np.abs(mc), axis=1)
@@ -244,6 +265,78 @@ class ArtifactDetect(BaseInterface):
         else:
             return np.nansum(a) / np.sum(1 - np.isnan(a))
 
+    def _iter_volumes(self, imgfile):
+        """Yields the volumes of the functional runs in chunks
+
+        Each chunk is a (voxels x volumes) view of at most `chunk_size`
+        volumes, with voxels in the (Fortran) order they are stored on disk.
+        Only the volumes of the current chunk are read into memory.
+        """
+        chunk_size = max(self.inputs.chunk_size, 1)
+        for f in filename_to_list(imgfile):
+            nim = load(f)
+            # image proxies read slices from disk (nibabel >= 2.0), older
+            # versions memory map uncompressed images
+            data = getattr(nim, 'dataobj', None)
+            if data is None or not hasattr(data, '__getitem__'):
+                data = nim.get_data()
+            shape = nim.get_shape()
+            if len(shape) == 3:
+                yield np.asarray(data[:, :, :]).reshape((-1, 1), order='F')
+                continue
+            for t0 in range(0, shape[3], chunk_size):
+                chunk = np.asarray(data[:, :, :, t0:t0 + chunk_size])
+                yield chunk.reshape((-1, chunk.shape[3]), order='F')
+
+    def _volume_means(self, vols):
+        """Mean of each volume (column), ignoring nans"""
+        return np.nansum(vols, 0) / np.sum(1 - np.isnan(vols), 0)
+
+    def _masked_means(self, vols, masks):
+        """Mean of the voxels of each volume within its own mask"""
+        return (np.sum(np.where(masks, vols, 0), 0) /
+                np.sum(masks, 0))
+
+    def _calc_global_intensity(self, imgfile):
+        """Returns the global intensity of each volume of the runs
+        """
+        nim = load(filename_to_list(imgfile)[0])
+        shape = nim.get_shape()[:3]
+        chunks = lambda: self._iter_volumes(imgfile)
+        means = []
+        masktype = self.inputs.mask_type
+        if masktype == 'spm_global':  # spm_global like calculation
+            intersect_mask = self.inputs.intersect_mask
+            if intersect_mask:
+                mask = np.ones(np.prod(shape), dtype=bool)
+                for vols in chunks():
+                    thresholds = self._volume_means(vols) / 8
+                    mask &= np.all(vols > thresholds, 1)
+                for vols in chunks():
+                    means.append(self._volume_means(vols[mask]))
+                if mask.sum() < (np.prod(shape) / 10):
+                    intersect_mask = False
+                    means = []
+            if not intersect_mask:
+                for vols in chunks():
+                    thresholds = self._volume_means(vols) / 8
+                    means.append(self._masked_means(vols, vols > thresholds))
+        elif masktype == 'file':  # uses a mask image to determine intensity
+            mask = load(self.inputs.mask_file).get_data()
+            mask = (mask > 0.5).ravel(order='F')
+            for vols in chunks():
+                means.append(self._volume_means(vols[mask]))
+        elif masktype == 'thresh':  # uses a fixed signal threshold
+            for vols in chunks():
+                means.append(self._masked_means(vols,
+                                                vols > self.inputs.mask_threshold))
+        else:
+            for vols in chunks():
+                means.append(self._volume_means(vols))
+        g = np.zeros((sum([len(m) for m in means]), 1))
+        g[:, 0] = np.concatenate(means)
+        return g
+
     def _plot_outliers_with_wave(self, wave, outliers, name):
         import matplotlib.pyplot as plt
         plt.plot(wave)
@@ -287,54 +380,8 @@ class ArtifactDetect(BaseInterface):
             tidx = find_indices(np.sum(abs(traval) > self.inputs.translation_threshold, 1) > 0)
             ridx = find_indices(np.sum(abs(rotval) > self.inputs.rotation_threshold, 1) > 0)
 
-        # read in functional image
-        if isinstance(imgfile, str):
-            nim = load(imgfile)
-        elif isinstance(imgfile, list):
-            if len(imgfile) == 1:
-                nim = load(imgfile[0])
-            else:
-                images = [load(f) for f in imgfile]
-                nim = funcs.concat_images(images)
-
         # compute global intensity signal
-        (x, y, z, timepoints) = nim.get_shape()
-
-        data = nim.get_data()
-        g = np.zeros((timepoints, 1))
-        masktype = self.inputs.mask_type
-        if  masktype == 'spm_global':  # spm_global like calculation
-            intersect_mask = self.inputs.intersect_mask
-            if intersect_mask:
-                mask = np.ones((x, y, z), dtype=bool)
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask = mask * (vol > (self._nanmean(vol) / 8))
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    g[t0] = self._nanmean(vol[mask])
-                if len(find_indices(mask)) < (np.prod((x, y, z)) / 10):
-                    intersect_mask = False
-                    g = np.zeros((timepoints, 1))
-            if not intersect_mask:
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask = vol > (self._nanmean(vol) / 8)
-                    g[t0] = self._nanmean(vol[mask])
-        elif masktype == 'file':  # uses a mask image to determine intensity
-            mask = load(self.inputs.mask_file).get_data()
-            mask = mask > 0.5
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                g[t0] = self._nanmean(vol[mask])
-        elif masktype == 'thresh':  # uses a fixed signal threshold
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                mask = vol > self.inputs.mask_threshold
-                g[t0] = self._nanmean(vol[mask])
-        else:
-            mask = np.ones((x, y, z))
-            g = self._nanmean(data[mask > 0, :], 1)
+        g = self._calc_global_intensity(imgfile)
 
         # compute normalized intensity values
         gz = signal.detrend(g, axis=0)       # detrend the signal
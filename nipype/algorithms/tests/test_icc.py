@@ -1,6 +1,11 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
 import numpy as np
-from nipype.testing import assert_equal
-from nipype.algorithms.icc import ICC_rep_anova
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms.icc import ICC, ICC_rep_anova
 
 
 def test_ICC_rep_anova():
@@ -19,3 +24,78 @@ def test_ICC_rep_anova():
     yield assert_equal, dfc, 3
     yield assert_equal, dfe, 15
     yield assert_equal, r_var/(r_var + e_var), icc
+
+
+def _reference_icc(Y):
+    """ICC_rep_anova computed from the design matrix, as before"""
+    from numpy import ones, kron, mean, eye, hstack, dot, tile
+    from scipy.linalg import pinv
+    [nb_subjects, nb_conditions] = Y.shape
+    dfc = nb_conditions - 1
+    dfe = (nb_subjects - 1) * dfc
+    dfr = nb_subjects - 1
+    mean_Y = mean(Y)
+    SST = ((Y - mean_Y) ** 2).sum()
+    x = kron(eye(nb_conditions), ones((nb_subjects, 1)))
+    x0 = tile(eye(nb_subjects), (nb_conditions, 1))
+    X = hstack([x, x0])
+    predicted_Y = dot(dot(dot(X, pinv(dot(X.T, X))), X.T), Y.flatten('F'))
+    residuals = Y.flatten('F') - predicted_Y
+    SSE = (residuals ** 2).sum()
+    MSE = SSE / dfe
+    SSC = ((mean(Y, 0) - mean_Y) ** 2).sum() * nb_subjects
+    MSC = SSC / dfc / nb_subjects
+    session_effect_F = MSC / MSE
+    SSR = SST - SSC - SSE
+    MSR = SSR / dfr
+    ICC = (MSR - MSE) / (MSR + dfc * MSE)
+    e_var = MSE
+    r_var = (MSR - MSE) / nb_conditions
+    return ICC, r_var, e_var, session_effect_F, dfc, dfe
+
+
+def test_ICC_rep_anova_vectorized():
+    np.random.seed(0)
+    Y = np.random.randn(50, 7, 3) + np.random.randn(50, 7, 1) * 2
+    results = ICC_rep_anova(Y)
+    for i in range(Y.shape[0]):
+        expected = _reference_icc(Y[i])
+        for value, expected_value in zip(results[:4], expected[:4]):
+            yield assert_almost_equal, value[i], expected_value, 10
+    yield assert_equal, results[4:], (2, 12)
+
+
+def test_ICC():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    shape = (6, 5, 4)
+    subject_effect = np.random.randn(5, *shape) * 2
+    mask = np.random.uniform(size=shape) > 0.3
+    nb.save(nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)), 'mask.nii')
+    subjects_sessions = []
+    data = np.zeros(shape + (5, 3))
+    for subject in range(5):
+        sessions = []
+        for session in range(3):
+            data[..., subject, session] = (subject_effect[subject] +
+                                           np.random.randn(*shape))
+            sessions.append(os.path.abspath('sub%d_ses%d.nii' % (subject,
+                                                                 session)))
+            nb.save(nb.Nifti1Image(data[..., subject, session].astype(np.float32),
+                                   np.eye(4)), sessions[-1])
+        subjects_sessions.append(sessions)
+    data = data.astype(np.float32)
+    outputs = ICC(subjects_sessions=subjects_sessions, mask='mask.nii',
+                  chunk_size=90).run().outputs
+    expected = np.zeros(shape + (4,))
+    for index in zip(*np.nonzero(mask)):
+        expected[index] = _reference_icc(data[index].astype(np.float64))[:4]
+    for i, name in enumerate(['icc_map', 'subject_var_map',
+                              'session_var_map', 'sessions_F_map']):
+        yield (assert_almost_equal,
+               nb.load(getattr(outputs, name)).get_data(), expected[..., i],
+               5)
+    os.chdir(cwd)
+    rmtree(tempdir)
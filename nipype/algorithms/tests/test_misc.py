@@ -0,0 +1,185 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_almost_equal
+import nipype.algorithms.misc as misc
+import nibabel as nb
+import numpy as np
+from scipy.special import legendre
+from scipy.spatial.distance import cdist
+
+
+def _reference_tsnr(data, regress_poly=None):
+    """Whole-array computation TSNR used before chunking"""
+    data = data.astype(np.float64)
+    if regress_poly:
+        timepoints = data.shape[-1]
+        X = np.ones((timepoints, 1))
+        for i in range(regress_poly):
+            X = np.hstack((X, legendre(i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+        betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
+        datahat = np.rollaxis(np.dot(X[:, 1:],
+                                     np.rollaxis(betas[1:, :, :, :], 0, 3)),
+                              0, 4)
+        data = data - datahat
+    meanimg = np.mean(data, axis=3)
+    stddevimg = np.std(data, axis=3)
+    return meanimg / stddevimg, meanimg, stddevimg, data
+
+
+def test_tsnr_chunked():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    trend = np.linspace(0, 50, 30)
+    data = (np.random.randint(500, 1000, (6, 7, 5, 30)) + trend).astype(np.int16)
+    files = []
+    for i, run in enumerate([data[..., :12], data[..., 12:]]):
+        files.append(os.path.join(tempdir, 'run%d.nii' % i))
+        nb.save(nb.Nifti1Image(run, np.eye(4)), files[-1])
+    for regress_poly in [None, 2]:
+        expected = _reference_tsnr(data, regress_poly)
+        for chunk_size in [1, 100, 100000]:
+            tsnr = misc.TSNR(in_file=files, chunk_size=chunk_size)
+            if regress_poly:
+                tsnr.inputs.regress_poly = regress_poly
+            outputs = tsnr.run().outputs
+            for name, value in zip(['tsnr_file', 'mean_file', 'stddev_file'],
+                                   expected[:3]):
+                yield (assert_almost_equal,
+                       nb.load(getattr(outputs, name)).get_data(), value, 3)
+            if regress_poly:
+                detrended = nb.load(outputs.detrended_file)
+                yield (assert_equal, detrended.get_data_dtype(),
+                       np.dtype(np.float32))
+                yield (assert_almost_equal, detrended.get_data(),
+                       expected[3], 3)
+    # a list of 3D volumes
+    for i in range(data.shape[3]):
+        nb.save(nb.Nifti1Image(data[..., i], np.eye(4)),
+                os.path.join(tempdir, 'vol%02d.nii' % i))
+    files = [os.path.join(tempdir, 'vol%02d.nii' % i)
+             for i in range(data.shape[3])]
+    outputs = misc.TSNR(in_file=files, regress_poly=1, chunk_size=50).run().outputs
+    expected = _reference_tsnr(data, 1)
+    yield (assert_almost_equal, nb.load(outputs.tsnr_file).get_data(),
+           expected[0], 3)
+    yield (assert_equal, nb.load(outputs.detrended_file).get_shape(),
+           data.shape)
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+def test_distance():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    grid = np.mgrid[:20, :22, :18]
+    affine = np.diag([2., 2.5, 3., 1.])
+    affine[:3, 3] = [-10, 4, 7]
+    centers = [(6, 8, 7), (13, 12, 9)]
+    files = []
+    for i, (center, radius) in enumerate(zip(centers, [5, 4])):
+        sq = sum([(grid[j] - center[j]) ** 2 for j in range(3)])
+        data = (sq <= radius ** 2) * np.random.uniform(1, 2, sq.shape)
+        files.append(os.path.join(tempdir, 'vol%d.nii' % i))
+        nb.save(nb.Nifti1Image(data, affine), files[-1])
+    dist = misc.Distance(volume1=files[0], volume2=files[1])
+    nii1, nii2 = [nb.load(f) for f in files]
+    data1 = nii1.get_data().astype(np.bool)
+    data2 = nii2.get_data().astype(np.bool)
+    border1 = dist._get_coordinates(dist._find_border(data1), affine)
+    border2 = dist._get_coordinates(dist._find_border(data2), affine)
+    all2 = dist._get_coordinates(data2, affine)
+
+    # references using the full distance matrices
+    dist_matrix = cdist(border1.T, border2.T)
+    outputs = misc.Distance(volume1=files[0], volume2=files[1],
+                            method='eucl_min').run().outputs
+    yield assert_almost_equal, outputs.distance, dist_matrix.min()
+    yield (assert_almost_equal, np.sqrt(np.sum((outputs.point1 -
+                                                outputs.point2) ** 2)),
+           dist_matrix.min())
+    yield (assert_almost_equal, misc.Distance(volume1=files[0],
+                                              volume2=files[1],
+                                              method='eucl_max').run()
+           .outputs.distance,
+           max(dist_matrix.min(axis=0).max(), dist_matrix.min(axis=1).max()))
+    mins = cdist(border1.T, all2.T).min(axis=0)
+    outputs = misc.Distance(volume1=files[0], volume2=files[1],
+                            method='eucl_mean').run().outputs
+    yield assert_almost_equal, outputs.distance, mins.mean()
+    yield assert_equal, outputs.histogram, misc.traits.Undefined
+    outputs = misc.Distance(volume1=files[0], volume2=files[1],
+                            method='eucl_wmean').run().outputs
+    yield (assert_almost_equal, outputs.distance,
+           np.average(mins, weights=nii2.get_data()[data2].flat))
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+def test_pickatlas():
+    tempdir = mkdtemp()
+    np.random.seed(0)
+    atlas = np.random.randint(0, 10, (9, 8, 7)).astype(np.int16)
+    atlas_file = os.path.join(tempdir, 'atlas.nii')
+    nb.save(nb.Nifti1Image(atlas, np.eye(4)), atlas_file)
+    for labels, hemi in [(3, 'both'), ([1, 4, 7], 'both'), ([2, 5], 'left'),
+                         ([2, 5], 'right')]:
+        expected = np.zeros(atlas.shape)
+        for label in np.atleast_1d(labels):
+            expected[atlas == label] = 1
+        if hemi == 'right':
+            expected[4:] = 0
+        elif hemi == 'left':
+            expected[:5] = 0
+        out_file = os.path.join(tempdir, 'mask.nii')
+        misc.PickAtlas(atlas=atlas_file, labels=labels, hemi=hemi,
+                       output_file=out_file).run()
+        yield assert_almost_equal, nb.load(out_file).get_data(), expected
+    rmtree(tempdir)
+
+
+def test_overlap_multi_label():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    labels1 = np.random.randint(0, 6, (10, 9, 8)).astype(np.float32)
+    labels2 = labels1.copy()
+    labels2[np.random.uniform(size=labels1.shape) < 0.3] = 7
+    labels2[0, 0, 0] = np.nan
+    mask = np.ones(labels1.shape)
+    mask[:2] = 0
+    files = []
+    for name, data in [('labels1', labels1), ('labels2', labels2),
+                       ('mask', mask)]:
+        files.append(os.path.join(tempdir, name + '.nii'))
+        nb.save(nb.Nifti1Image(data, np.eye(4)), files[-1])
+    outputs = misc.Overlap(volume1=files[0], volume2=files[1],
+                           mask_volume=files[2],
+                           multi_label=True).run().outputs
+    yield assert_equal, outputs.labels, [1, 2, 3, 4, 5, 7]
+    inside = mask > 0
+    for i, label in enumerate(outputs.labels):
+        roi1 = (labels1 == label) & inside
+        roi2 = (labels2 == label) & inside
+        both = float(np.sum(roi1 & roi2))
+        yield (assert_almost_equal, outputs.roi_di[i],
+               2 * both / (roi1.sum() + roi2.sum()))
+        yield (assert_almost_equal, outputs.roi_ji[i],
+               both / np.sum(roi1 | roi2))
+        yield (assert_equal, outputs.roi_voldiff[i],
+               int(roi1.sum() - roi2.sum()))
+    # the binarized overlap is unchanged
+    single = misc.Overlap(volume1=files[0], volume2=files[1],
+                          mask_volume=files[2]).run().outputs
+    yield assert_equal, single.dice, outputs.dice
+    yield assert_equal, single.labels, misc.traits.Undefined
+    os.chdir(cwd)
+    rmtree(tempdir)
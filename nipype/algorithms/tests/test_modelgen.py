@@ -110,3 +110,112 @@ def test_modelgen_sparse():
     yield assert_almost_equal, res.outputs.session_info[0]['regress'][0]['val'][0], 0.016675298129743384
     yield assert_almost_equal, res.outputs.session_info[1]['regress'][1]['val'][5], 0.007671459162258378
     rmtree(tempdir)
+
+
+class ReferenceSparseModel(SpecifySparseModel):
+    """Regressors built onset by onset with direct convolutions, as before"""
+
+    def _gen_regress(self, i_onsets, i_durations, i_amplitudes, nscans):
+        from nipype.algorithms.modelgen import gcd, spm_hrf, orth
+        from nipype.interfaces.base import isdefined
+        TR = np.round(self.inputs.time_repetition*1000)
+        if self.inputs.time_acquisition:
+            TA = np.round(self.inputs.time_acquisition*1000)
+        else:
+            TA = TR
+        nvol = self.inputs.volumes_in_cluster
+        SCANONSET = np.round(self.inputs.scan_onset*1000)
+        total_time = TR*(nscans-nvol)/nvol + TA*nvol + SCANONSET
+        SILENCE = TR-TA*nvol
+        dt = TA/10.
+        durations = np.round(np.array(i_durations)*1000)
+        if len(durations) == 1:
+            durations = durations*np.ones((len(i_onsets)))
+        onsets = np.round(np.array(i_onsets)*1000)
+        dttemp = gcd(TA, gcd(SILENCE, TR))
+        if dt < dttemp:
+            if dttemp % dt != 0:
+                dt = gcd(dttemp, dt)
+        npts = int(total_time/dt)
+        timeline = np.zeros((npts))
+        timeline2 = np.zeros((npts))
+        model_hrf = isdefined(self.inputs.model_hrf) and self.inputs.model_hrf
+        deriv = (isdefined(self.inputs.use_temporal_deriv) and
+                 self.inputs.use_temporal_deriv)
+        if model_hrf:
+            hrf = spm_hrf(dt*1e-3)
+        reg_scale = 1.0
+        if self.inputs.scale_regressors:
+            boxcar = np.zeros(int(50.*1e3/dt))
+            if self.inputs.stimuli_as_impulses:
+                boxcar[int(1.*1e3/dt)] = 1.0
+                reg_scale = float(TA/dt)
+            else:
+                boxcar[int(1.*1e3/dt):int(2.*1e3/dt)] = 1.0
+            if model_hrf:
+                response = np.convolve(boxcar, hrf)
+                reg_scale = 1./response.max()
+        for i, t in enumerate(onsets):
+            idx = int(t/dt)
+            if i_amplitudes:
+                if len(i_amplitudes)>1:
+                    timeline2[idx] = i_amplitudes[i]
+                else:
+                    timeline2[idx] = i_amplitudes[0]
+            else:
+                timeline2[idx] = 1
+            if not self.inputs.stimuli_as_impulses:
+                if durations[i] == 0:
+                    durations[i] = TA*nvol
+                stimdur = np.ones((int(durations[i]/dt)))
+                timeline2 = np.convolve(timeline2, stimdur)[0:len(timeline2)]
+            timeline += timeline2
+            timeline2[:] = 0
+        if model_hrf:
+            timeline = np.convolve(timeline, hrf)[0:len(timeline)]
+            if deriv:
+                timederiv = np.concatenate(([0], np.diff(timeline)))
+        reg = []
+        regderiv = []
+        for i, trial in enumerate(np.arange(nscans)/nvol):
+            scanstart = int((SCANONSET + trial*TR + (i%nvol)*TA)/dt)
+            scanidx = scanstart+np.arange(int(TA/dt))
+            reg.insert(i, np.mean(timeline[scanidx])*reg_scale)
+            if deriv:
+                regderiv.insert(i, np.mean(timederiv[scanidx])*reg_scale)
+        if deriv:
+            regderiv = orth(reg, regderiv)
+        if regderiv:
+            return [reg, regderiv]
+        else:
+            return reg
+
+
+def test_modelgen_sparse_regressors():
+    np.random.seed(0)
+    onsets = np.sort(np.random.uniform(0, 280, 40)).round(1).tolist()
+    durations = np.random.uniform(0, 6, 40).round(1)
+    durations[::7] = 0
+    durations = durations.tolist()
+    amplitudes = np.random.uniform(0.5, 2, 40).tolist()
+    for options in [dict(stimuli_as_impulses=True),
+                    dict(stimuli_as_impulses=False),
+                    dict(stimuli_as_impulses=False, model_hrf=True),
+                    dict(stimuli_as_impulses=True, model_hrf=True,
+                         use_temporal_deriv=True),
+                    dict(stimuli_as_impulses=False, model_hrf=True,
+                         use_temporal_deriv=True, volumes_in_cluster=2,
+                         scan_onset=1.)]:
+        models = []
+        for klass in [SpecifySparseModel, ReferenceSparseModel]:
+            s = klass(input_units='secs', time_repetition=6,
+                      time_acquisition=2, high_pass_filter_cutoff=128.,
+                      **options)
+            models.append(s)
+        for args in [(onsets, durations, amplitudes),
+                     (onsets, [2.5], [1.5]), (onsets[:5], [0], None)]:
+            nscans = 48 * options.get('volumes_in_cluster', 1)
+            reg, expected = [model._gen_regress(*(args + (nscans,)))
+                             for model in models]
+            yield (assert_almost_equal, np.array(reg), np.array(expected),
+                   10)
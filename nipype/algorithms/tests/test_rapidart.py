@@ -1,9 +1,14 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
 from nipype.testing import (assert_equal, assert_false, assert_true,
                             assert_almost_equal)
 import nipype.algorithms.rapidart as ra
 from nipype.interfaces.base import Bunch
+import nibabel as nb
 import numpy as np
 
 
@@ -116,3 +121,111 @@ def test_sc_output_filenames():
     f = 'motion.nii'
     corrfile = sc._get_output_filenames(f, outputdir)
     yield assert_equal, corrfile, '/tmp/qa.motion_stimcorr.txt'
+
+
+def _reference_affine(params):
+    """_get_affine_matrix before vectorization"""
+    rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)], [-np.sin(x), np.cos(x)]])
+    q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
+    if len(params) < 12:
+        params = np.hstack((params, q[len(params):]))
+    T = np.eye(4)
+    T[0:3, -1] = params[0:3]
+    Rx = np.eye(4)
+    Rx[1:3, 1:3] = rotfunc(params[3])
+    Ry = np.eye(4)
+    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
+    Rz = np.eye(4)
+    Rz[0:2, 0:2] = rotfunc(params[5])
+    S = np.eye(4)
+    S[0:3, 0:3] = np.diag(params[6:9])
+    Sh = np.eye(4)
+    Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+    return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+
+
+def _reference_norm(mc):
+    """_calc_norm (with differences) before vectorization"""
+    respos = np.diag([70, 70, 75])
+    resneg = np.diag([-70, -110, -45])
+    cube_pts = np.vstack((np.hstack((respos, resneg)), np.ones((1, 6))))
+    newpos = np.zeros((mc.shape[0], 18))
+    for i in range(mc.shape[0]):
+        newpos[i, :] = np.dot(_reference_affine(mc[i, :]), cube_pts)[0:3, :].ravel()
+    normdata = np.zeros(mc.shape[0])
+    newpos = np.concatenate((np.zeros((1, 18)), np.diff(newpos, n=1, axis=0)), axis=0)
+    for i in range(newpos.shape[0]):
+        normdata[i] = np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos[i, :]), 2), (3, 6)), axis=0)))
+    return normdata
+
+
+def _reference_intensity(data, masktype, intersect_mask=True, mask=None,
+                         threshold=None):
+    """global intensity computation before vectorization"""
+    nanmean = lambda a: np.nansum(a) / np.sum(1 - np.isnan(a))
+    (x, y, z, timepoints) = data.shape
+    g = np.zeros((timepoints, 1))
+    if masktype == 'spm_global':
+        if intersect_mask:
+            mask = np.ones((x, y, z), dtype=bool)
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                mask = mask * (vol > (nanmean(vol) / 8))
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                g[t0] = nanmean(vol[mask])
+            if len(np.nonzero(mask.ravel())[0]) < (np.prod((x, y, z)) / 10):
+                intersect_mask = False
+                g = np.zeros((timepoints, 1))
+        if not intersect_mask:
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                mask = vol > (nanmean(vol) / 8)
+                g[t0] = nanmean(vol[mask])
+    elif masktype == 'file':
+        for t0 in range(timepoints):
+            vol = data[:, :, :, t0]
+            g[t0] = nanmean(vol[mask > 0.5])
+    elif masktype == 'thresh':
+        for t0 in range(timepoints):
+            vol = data[:, :, :, t0]
+            mask = vol > threshold
+            g[t0] = nanmean(vol[mask])
+    return g
+
+
+def test_ad_vectorized():
+    tempdir = mkdtemp()
+    np.random.seed(0)
+    ad = ra.ArtifactDetect()
+    mc = np.random.randn(40, 6) * [1, 1, 1, 0.02, 0.02, 0.02]
+    yield assert_almost_equal, ad._get_affine_matrices(mc), \
+        np.array([_reference_affine(params) for params in mc]), 12
+    yield assert_almost_equal, ad._calc_norm(mc, True), _reference_norm(mc), 10
+
+    for dtype in [np.int16, np.float32]:
+        data = np.random.randint(500, 1000, (7, 8, 9, 40)).astype(dtype)
+        data[:2] = np.random.randint(0, 50, (2, 8, 9, 40))
+        data[3, 3, 3, 5] += 2000
+        if dtype == np.float32:
+            data[0, 0, 0, 3] = np.nan
+        mask = np.zeros(data.shape[:3])
+        mask[2:5, 2:5, 2:5] = 1
+        nb.save(nb.Nifti1Image(mask, np.eye(4)),
+                os.path.join(tempdir, 'mask.nii'))
+        files = []
+        for i, run in enumerate([data[..., :25], data[..., 25:]]):
+            files.append(os.path.join(tempdir, 'run%d.nii' % i))
+            nb.save(nb.Nifti1Image(run, np.eye(4)), files[-1])
+        for masktype, intersect in [('spm_global', True),
+                                    ('spm_global', False),
+                                    ('file', False), ('thresh', False)]:
+            ad = ra.ArtifactDetect(mask_type=masktype, chunk_size=7,
+                                   intersect_mask=intersect,
+                                   mask_file=os.path.join(tempdir,
+                                                          'mask.nii'),
+                                   mask_threshold=700)
+            ad.inputs.realigned_files = files
+            g = _reference_intensity(data, masktype, intersect, mask, 700)
+            yield assert_equal, ad._calc_global_intensity(files), g
+    rmtree(tempdir)
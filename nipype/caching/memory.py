@@ -10,16 +10,64 @@ name-steps pipeline: getting back scope in command-line based programming.
 """
 
 import os
+from collections import OrderedDict
 import hashlib
 import pickle
 import time
 import shutil
 import glob
+from multiprocessing.pool import ThreadPool
+import sqlite3
+import threading
 
-from nipype.interfaces.base import BaseInterface
+from nipype import config
+from nipype.interfaces.base import BaseInterface, thread_state
 from nipype.pipeline.engine import Node
 from nipype.pipeline.utils import modify_paths
 
+################################################################################
+# ResultCache: in-memory store of the latest results
+
+class ResultCache(object):
+    """ Least recently used store of interface results
+
+        Results are keyed by the directory of the cached job and remain
+        valid as long as the hash file of the job exists.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, job_dir, hashfile):
+        with self._lock:
+            result = self._results.pop(job_dir, None)
+            if result is not None and os.path.exists(hashfile):
+                self._results[job_dir] = result
+                return result
+            return None
+
+    def put(self, job_dir, result):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._results.pop(job_dir, None)
+            self._results[job_dir] = result
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __getstate__(self):
+        # results are not shared with other processes
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
 ################################################################################
 # PipeFunc object: callable interface to nipype.interface objects
 
@@ -33,7 +81,8 @@ class PipeFunc(object):
             out = fsl_merge(in_files=files, dimension='t')
     """
 
-    def __init__(self, interface, base_dir, callback=None):
+    def __init__(self, interface, base_dir, callback=None, result_cache=None,
+                 n_jobs=1):
         """
 
             Parameters
@@ -46,6 +95,11 @@ class PipeFunc(object):
             callback: a callable
                 An optional callable called each time after the function
                 is called.
+            result_cache: a ResultCache, optional
+                In-memory store of results returned without loading
+                them from disk
+            n_jobs: integer, optional
+                The number of calls run concurrently by the map method
         """
         if not (isinstance(interface, type)
                                 and issubclass(interface, BaseInterface)):
@@ -61,14 +115,17 @@ class PipeFunc(object):
                             self.interface.help(returnhelp=True))
         self.__doc__ = doc
         self.callback = callback
+        self.result_cache = result_cache
+        self.n_jobs = n_jobs
 
     def __call__(self, **kwargs):
         kwargs = modify_paths(kwargs, relative=False)
         interface = self.interface()
         # Set the inputs early to get some argument checking
         interface.inputs.set(**kwargs)
-        # Make a name for our node
-        inputs = interface.inputs.get_hashval()
+        # Make a name for our node, the hash is reused by the node
+        inputs = interface.inputs.get_hashval(
+            hash_method=config.get('execution', 'hash_method'))
         hasher = hashlib.new('md5')
         hasher.update(pickle.dumps(inputs))
         dir_name = '%s-%s' % (interface.__class__.__module__.replace('.', '-'),
@@ -76,17 +133,82 @@ class PipeFunc(object):
         job_name = hasher.hexdigest()
         node = Node(interface, name=job_name)
         node.base_dir = os.path.join(self.base_dir, dir_name)
-        out = node.run()
+        out = None
+        if self.result_cache is not None:
+            hashfile = os.path.join(node.output_dir(), '_0x%s.json' % inputs[1])
+            out = self.result_cache.get(node.output_dir(), hashfile)
+        if out is None:
+            node.set_hashval(*inputs)
+            out = node.run()
+            if self.result_cache is not None:
+                self.result_cache.put(node.output_dir(), out)
         if self.callback is not None:
             self.callback(dir_name, job_name)
         return out
 
+    def map(self, arg_sets):
+        """ Call the interface with each set of keyword arguments
+
+            Up to n_jobs calls run concurrently on threads. The threads
+            share the working directory: Python code runs one thread at
+            a time while external programs run in parallel.
+
+            Parameters
+            ===========
+            arg_sets: list of dictionaries
+                The keyword arguments of each call
+
+            Returns
+            =======
+            results: list
+                The results of the calls, in the order of arg_sets
+        """
+        # identical calls would share a working directory
+        keys = [pickle.dumps(sorted(kwargs.items())) for kwargs in arg_sets]
+        unique_keys = []
+        unique_args = []
+        for key, kwargs in zip(keys, arg_sets):
+            if key not in unique_keys:
+                unique_keys.append(key)
+                unique_args.append(kwargs)
+        n_jobs = min(self.n_jobs, len(unique_args))
+        if n_jobs > 1:
+            cwd_lock = threading.Lock()
+            base_cwd = os.getcwd()
+            pool = ThreadPool(n_jobs)
+            try:
+                results = pool.map(lambda kwargs: _call_threaded(
+                        self, kwargs, cwd_lock, base_cwd), unique_args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self(**kwargs) for kwargs in unique_args]
+        results = dict(zip(unique_keys, results))
+        return [results[key] for key in keys]
+
     def __repr__(self):
         return '%s(%s.%s, base_dir=%s)' % (self.__class__.__name__,
                            self.interface.__module__,
                            self.interface.__name__,
                            self.base_dir)
 
+def _call_threaded(pipe_func, kwargs, cwd_lock, base_cwd):
+    """ Call pipe_func on a thread sharing the working directory
+
+        The lock is released while external programs run (see
+        nipype.interfaces.base.run_command).
+    """
+    cwd_lock.acquire()
+    thread_state.cwd_lock = cwd_lock
+    thread_state.base_cwd = base_cwd
+    try:
+        return pipe_func(**kwargs)
+    finally:
+        os.chdir(base_cwd)
+        thread_state.cwd_lock = None
+        cwd_lock.release()
+
 ################################################################################
 # Memory manager: provide some tracking about what is computed when, to
 # be able to flush the disk
@@ -117,7 +239,9 @@ def rm_all_but(base_dir, dirs_to_keep, warn=False):
     except OSError:
         "Dir has been deleted"
         return
-    all_dirs = [d for d in all_dirs if not d.startswith('log.')]
+    # keep the logs, the catalogue and the environment tables
+    all_dirs = [d for d in all_dirs if not d.startswith('log.')
+                and not d.startswith('_')]
     dirs_to_rm = list(dirs_to_keep.symmetric_difference(all_dirs))
     for dir_name in dirs_to_rm:
         dir_name = os.path.join(base_dir, dir_name)
@@ -127,6 +251,145 @@ def rm_all_but(base_dir, dirs_to_keep, warn=False):
             shutil.rmtree(dir_name)
 
 
+def dir_size(path):
+    """ Return the number of bytes used by the files below path
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                "File has been deleted"
+    return size
+
+
+class CacheCatalogue(object):
+    """ Index of the cached jobs, stored in a sqlite database
+
+        For each job, the catalogue records the size of its directory,
+        when it was created and last used, and how many times it was
+        reused. The number of hits and misses of each interface is kept
+        even when its jobs are removed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs (dir_name TEXT, '
+                     'job_name TEXT, size INTEGER, ctime REAL, atime REAL, '
+                     'hits INTEGER, PRIMARY KEY (dir_name, job_name))')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (dir_name TEXT '
+                     'PRIMARY KEY, hits INTEGER, misses INTEGER)')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=60)
+
+    def record(self, dir_name, job_name, job_dir, atime=None, count=True):
+        """ Record a use of a job, returns True if the job is new
+
+            The use is counted as a hit or a miss of the interface
+            unless count is False.
+        """
+        if atime is None:
+            atime = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute('UPDATE jobs SET hits=hits+1, '
+                                  'atime=max(atime, ?) WHERE dir_name=? '
+                                  'AND job_name=?',
+                                  (atime, dir_name, job_name))
+            new = cursor.rowcount == 0
+            if new:
+                conn.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, 0)',
+                             (dir_name, job_name, dir_size(job_dir), atime,
+                              atime))
+            conn.execute('INSERT OR IGNORE INTO counters VALUES (?, 0, 0)',
+                         (dir_name,))
+            if count:
+                conn.execute('UPDATE counters SET %s=%s+1 WHERE dir_name=?' %
+                             (('misses',) * 2 if new else ('hits',) * 2),
+                             (dir_name,))
+            conn.commit()
+        finally:
+            conn.close()
+        return new
+
+    def jobs(self, since=None):
+        """ Return the jobs used since the given time, grouped by
+            directory name
+        """
+        conn = self._connect()
+        if since is None:
+            rows = conn.execute('SELECT dir_name, job_name FROM jobs')
+        else:
+            rows = conn.execute('SELECT dir_name, job_name FROM jobs '
+                                'WHERE atime >= ?', (since,))
+        runs = dict()
+        for dir_name, job_name in rows:
+            runs.setdefault(dir_name, set()).add(job_name)
+        conn.close()
+        return runs
+
+    def remove_all_but(self, runs):
+        """ Forget all the jobs apart from those given
+        """
+        conn = self._connect()
+        rows = conn.execute('SELECT dir_name, job_name FROM jobs').fetchall()
+        conn.executemany('DELETE FROM jobs WHERE dir_name=? AND job_name=?',
+                         [(dir_name, job_name) for dir_name, job_name in rows
+                          if job_name not in runs.get(dir_name, ())])
+        conn.commit()
+        conn.close()
+
+    def select_evictions(self, max_bytes, policy='lru', keep=()):
+        """ Return the jobs to remove to fit the cache in max_bytes
+
+            Jobs are removed least recently ('lru') or least frequently
+            ('lfu') used first. Jobs listed in keep are not removed.
+        """
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown eviction policy: %s' % policy)
+        order = 'atime' if policy == 'lru' else 'hits, atime'
+        conn = self._connect()
+        total = conn.execute('SELECT total(size) FROM jobs').fetchone()[0]
+        rows = conn.execute('SELECT dir_name, job_name, size FROM jobs '
+                            'ORDER BY %s' % order).fetchall()
+        conn.close()
+        evictions = []
+        for dir_name, job_name, size in rows:
+            if total <= max_bytes:
+                break
+            if (dir_name, job_name) in keep:
+                continue
+            evictions.append((dir_name, job_name))
+            total -= size
+        return evictions
+
+    def remove(self, jobs):
+        conn = self._connect()
+        conn.executemany('DELETE FROM jobs WHERE dir_name=? AND job_name=?',
+                         jobs)
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        stats = dict()
+        for dir_name, hits, misses in conn.execute('SELECT * FROM counters'):
+            stats[dir_name] = dict(hits=hits, misses=misses, n_jobs=0,
+                                   size=0)
+        for dir_name, n_jobs, size in conn.execute(
+                'SELECT dir_name, count(*), total(size) FROM jobs '
+                'GROUP BY dir_name'):
+            stats.setdefault(dir_name, dict(hits=0, misses=0))
+            stats[dir_name].update(n_jobs=n_jobs, size=int(size))
+        conn.close()
+        return stats
+
+
 class _MemoryCallback(object):
     "An object to avoid closures and have everything pickle"
 
@@ -144,6 +407,15 @@ class Memory(object):
         ==========
         base_dir: string
             The directory name of the location for the caching
+        cache_size: integer, optional
+            The number of results kept in memory and returned without
+            reading the cache directory; 0 disables the in-memory cache
+        max_bytes: integer, optional
+            The size the cache directory is kept under by removing
+            jobs after each new computation; unlimited if None
+        eviction_policy: 'lru' or 'lfu', optional
+            Whether the least recently or the least frequently used jobs
+            are removed first
 
         Methods
         =======
@@ -152,27 +424,58 @@ class Memory(object):
         clear_previous_runs
             Removes from the disk all the runs that where not used after
             the creation time of the specific Memory instance
-        clear_previous_runs
+        clear_runs_since
             Removes from the disk all the runs that where not used after
             the given time
+        evict
+            Removes jobs until the cache fits in a given size
+        stats
+            Returns the size and hit counts of the cache
     """
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, cache_size=100, max_bytes=None,
+                 eviction_policy='lru'):
         base_dir = os.path.join(os.path.abspath(base_dir), 'nipype_mem')
         if not os.path.exists(base_dir):
             os.mkdir(base_dir)
         elif not os.path.isdir(base_dir):
             raise ValueError('base_dir should be a directory')
         self.base_dir = base_dir
-        open(os.path.join(base_dir, 'log.current'), 'w')
-
-    def cache(self, interface):
+        self.result_cache = ResultCache(cache_size)
+        self.max_bytes = max_bytes
+        self.eviction_policy = eviction_policy
+        self._creation_time = time.time()
+        catalogue_file = os.path.join(base_dir, 'log.catalogue.sqlite')
+        new_catalogue = not os.path.exists(catalogue_file)
+        self.catalogue = CacheCatalogue(catalogue_file)
+        if new_catalogue:
+            self._import_logs()
+
+    def _import_logs(self):
+        """ Add the jobs listed in the day logs of previous versions to
+            the catalogue
+        """
+        for log_name in sorted(glob.glob('%s/log.*/*/*.log' % self.base_dir)):
+            year, month, day = [int(part.split('.')[-1]) for part in
+                                log_name[:-len('.log')].split(os.sep)[-3:]]
+            atime = time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+            for dir_name, job_names in read_log(log_name).iteritems():
+                for job_name in job_names:
+                    job_dir = os.path.join(self.base_dir, dir_name, job_name)
+                    if os.path.exists(job_dir):
+                        self.catalogue.record(dir_name, job_name, job_dir,
+                                              atime=atime, count=False)
+
+    def cache(self, interface, n_jobs=1):
         """ Returns a callable that caches the output of an interface
 
             Parameters
             ==========
             interface: nipype interface
                 The nipype interface class to be wrapped and cached
+            n_jobs: integer, optional
+                The number of calls run concurrently by the map method
+                of the returned object
 
             Returns
             =======
@@ -204,31 +507,76 @@ class Memory(object):
             We can retrieve the resulting file from the outputs:
             >>> results.outputs.merged_file # doctest: +SKIP
             '...'
+
+            Several calls can run in parallel
+
+            >>> fsl_merge = mem.cache(fsl.Merge, n_jobs=2)
+            >>> results = fsl_merge.map([dict(in_files=['a.nii', 'b.nii'],
+            ...                               dimension='t'),
+            ...                          dict(in_files=['a.nii', 'b.nii'],
+            ...                               dimension='x')]) # doctest: +SKIP
         """
-        return PipeFunc(interface, self.base_dir, _MemoryCallback(self))
+        return PipeFunc(interface, self.base_dir, _MemoryCallback(self),
+                        result_cache=self.result_cache, n_jobs=n_jobs)
 
     def _log_name(self, dir_name, job_name):
-        """ Increment counters tracking which cached function get executed.
+        """ Record the use of a job in the catalogue and keep the cache
+            under max_bytes.
         """
-        base_dir = self.base_dir
-        # Every counter is a file opened in append mode and closed
-        # immediately to avoid race conditions in parallel computing:
-        # file appends are atomic
-        open(os.path.join(base_dir, 'log.current'),
-            'a').write('%s/%s\n' % (dir_name, job_name))
-        t = time.localtime()
-        year_dir = os.path.join(base_dir, 'log.%i' % t.tm_year)
-        try:
-            os.mkdir(year_dir)
-        except OSError:
-            "Dir exists"
-        month_dir = os.path.join(year_dir, '%02i' % t.tm_mon)
-        try:
-            os.mkdir(month_dir)
-        except OSError:
-            "Dir exists"
-        open(os.path.join(month_dir, '%02i.log' % t.tm_mday),
-            'a').write('%s/%s\n' % (dir_name, job_name))
+        job_dir = os.path.join(self.base_dir, dir_name, job_name)
+        new = self.catalogue.record(dir_name, job_name, job_dir)
+        if new and self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=[(dir_name, job_name)])
+
+    def evict(self, max_bytes, policy=None, keep=(), warn=False):
+        """ Remove cached jobs until the cache takes at most max_bytes
+
+            Parameters
+            ==========
+            max_bytes: integer
+                The size in bytes of the cache after eviction
+            policy: 'lru' or 'lfu', optional
+                Remove the least recently or least frequently used jobs
+                first (default: the eviction_policy of the Memory)
+            keep: list of (dir_name, job_name) tuples, optional
+                Jobs never removed
+            warn: boolean, optional
+                If true, echoes warning messages for all directory
+                removed
+        """
+        if policy is None:
+            policy = self.eviction_policy
+        evictions = self.catalogue.select_evictions(max_bytes, policy,
+                                                    keep=keep)
+        if evictions:
+            self.result_cache.clear()
+        for dir_name, job_name in evictions:
+            job_dir = os.path.join(self.base_dir, dir_name, job_name)
+            if os.path.exists(job_dir):
+                if warn:
+                    print 'removing directory: %s' % job_dir
+                shutil.rmtree(job_dir)
+        self.catalogue.remove(evictions)
+
+    def stats(self):
+        """ Return the number of jobs, size, hits and misses of the cache
+
+            Returns
+            =======
+            stats: dictionary
+                The totals, with the hit rate, and under 'interfaces' the
+                same numbers for each cached interface
+        """
+        interfaces = self.catalogue.stats()
+        stats = dict(n_jobs=0, size=0, hits=0, misses=0)
+        for interface_stats in interfaces.values():
+            for key in stats:
+                stats[key] += interface_stats[key]
+        for item in [stats] + interfaces.values():
+            calls = item['hits'] + item['misses']
+            item['hit_rate'] = float(item['hits']) / calls if calls else 0.
+        stats['interfaces'] = interfaces
+        return stats
 
     def clear_previous_runs(self, warn=True):
         """ Remove all the cache that where not used in the latest run of
@@ -241,8 +589,7 @@ class Memory(object):
                 If true, echoes warning messages for all directory
                 removed
         """
-        base_dir = self.base_dir
-        latest_runs = read_log(os.path.join(base_dir, 'log.current'))
+        latest_runs = self.catalogue.jobs(since=self._creation_time)
         self._clear_all_but(latest_runs, warn=warn)
 
     def clear_runs_since(self, day=None, month=None, year=None, warn=True):
@@ -262,24 +609,23 @@ class Memory(object):
         day = day if day is not None else t.tm_mday
         month = month if month is not None else t.tm_mon
         year = year if year is not None else t.tm_year
+        cut_off = time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+        recent_runs = self.catalogue.jobs(since=cut_off)
+        self._clear_all_but(recent_runs, warn=warn)
+        # day logs written by previous versions
         base_dir = self.base_dir
         cut_off_file = '%s/log.%i/%02i/%02i.log' % (base_dir,
                     year, month, day)
-        logs_to_flush = list()
-        recent_runs = dict()
         for log_name in glob.glob('%s/log.*/*/*.log' % base_dir):
             if log_name < cut_off_file:
-                logs_to_flush.append(log_name)
-            else:
-                recent_runs = read_log(log_name, recent_runs)
-        self._clear_all_but(recent_runs, warn=warn)
-        for log_name in logs_to_flush:
-            os.remove(log_name)
+                os.remove(log_name)
 
     def _clear_all_but(self, runs, warn=True):
         """ Remove all the runs appart from those given to the function
             input.
         """
+        self.result_cache.clear()
+        self.catalogue.remove_all_but(runs)
         rm_all_but(self.base_dir, set(runs.keys()), warn=warn)
         for dir_name, job_names in runs.iteritems():
             rm_all_but(os.path.join(self.base_dir, dir_name),
@@ -1,13 +1,14 @@
 """ Test the nipype interface caching mechanism
 """
 
+import os
 from tempfile import mkdtemp
 from shutil import rmtree
 
 from nose.tools import assert_equal
 
 from nipype.caching import Memory
-from nipype.pipeline.tests.test_engine import TestInterface
+from nipype.pipeline.tests.test_engine import TestInterface, InputSpec
 from nipype.utils.config import NipypeConfig
 config = NipypeConfig()
 config.set_default_config()
@@ -48,6 +49,104 @@ def test_caching():
         config.set('execution', 'stop_on_first_rerun', old_rerun)
 
 
+nb_hashes = 0
+
+
+class CountingInputSpec(InputSpec):
+
+    def get_hashval(self, hash_method=None):
+        global nb_hashes
+        nb_hashes += 1
+        return super(CountingInputSpec, self).get_hashval(hash_method)
+
+
+class CountingInterface(SideEffectInterface):
+    input_spec = CountingInputSpec
+
+
+def test_result_cache():
+    temp_dir = mkdtemp(prefix='test_memory_')
+    try:
+        mem = Memory(temp_dir)
+        cached = mem.cache(CountingInterface)
+        first_nb_run = nb_runs
+        first_nb_hashes = nb_hashes
+        results = cached(input1=3, input2=1)
+        # the node reuses the hash of the job name
+        assert_equal(nb_hashes, first_nb_hashes + 1)
+        assert_equal(nb_runs, first_nb_run + 1)
+        # results in memory are returned as is
+        assert_equal(id(cached(input1=3, input2=1)), id(results))
+        assert_equal(nb_runs, first_nb_run + 1)
+        # unless the job was removed from disk
+        job_dir = results.runtime.cwd
+        rmtree(job_dir)
+        results2 = cached(input1=3, input2=1)
+        assert_equal(nb_runs, first_nb_run + 2)
+        assert_equal(results2.outputs.output1, [1, 3])
+        # other Memory objects start empty but reuse the disk cache
+        results3 = Memory(temp_dir).cache(CountingInterface)(input1=3,
+                                                             input2=1)
+        assert_equal(nb_runs, first_nb_run + 2)
+        assert_equal(results3.outputs.output1, [1, 3])
+    finally:
+        rmtree(temp_dir)
+
+
+def test_cache_map():
+    temp_dir = mkdtemp(prefix='test_memory_')
+    cwd = os.getcwd()
+    try:
+        mem = Memory(temp_dir)
+        first_nb_run = nb_runs
+        cached = mem.cache(SideEffectInterface, n_jobs=2)
+        arg_sets = [dict(input1=i, input2=1) for i in [4, 5, 6, 4]]
+        results = cached.map(arg_sets)
+        assert_equal([result.outputs.output1 for result in results],
+                     [[1, 4], [1, 5], [1, 6], [1, 4]])
+        assert_equal(nb_runs, first_nb_run + 3)
+        assert_equal(os.getcwd(), cwd)
+    finally:
+        rmtree(temp_dir)
+
+
+def test_catalogue():
+    temp_dir = mkdtemp(prefix='test_memory_')
+    try:
+        mem = Memory(temp_dir, cache_size=0)
+        cached = mem.cache(SideEffectInterface)
+        for i in [7, 8, 7, 7, 9]:
+            cached(input1=i, input2=1)
+        stats = mem.stats()
+        assert_equal(stats['n_jobs'], 3)
+        assert_equal(stats['misses'], 3)
+        assert_equal(stats['hits'], 2)
+        assert_equal(stats['hit_rate'], 0.4)
+        assert_equal(len(stats['interfaces']), 1)
+        assert_equal(stats['size'] > 0, True)
+        # least frequently, then least recently, used jobs go first
+        mem.evict(stats['size'] - 1, policy='lfu')
+        assert_equal(mem.stats()['n_jobs'], 2)
+        first_nb_run = nb_runs
+        cached(input1=7, input2=1)
+        cached(input1=9, input2=1)
+        assert_equal(nb_runs, first_nb_run)
+        cached(input1=8, input2=1)
+        assert_equal(nb_runs, first_nb_run + 1)
+        # the cache is kept under max_bytes
+        mem = Memory(temp_dir, cache_size=0, max_bytes=1)
+        mem.cache(SideEffectInterface)(input1=10, input2=1)
+        stats = mem.stats()
+        assert_equal(stats['n_jobs'], 1)
+        assert_equal(stats['misses'], 5)
+        mem.clear_previous_runs(warn=False)
+        assert_equal(mem.stats()['n_jobs'], 1)
+        mem.clear_runs_since(year=3000, warn=False)
+        assert_equal(mem.stats()['n_jobs'], 0)
+    finally:
+        rmtree(temp_dir)
+
+
 if __name__ == '__main__':
     test_caching()
 
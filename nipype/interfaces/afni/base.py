@@ -7,6 +7,7 @@ import os
 import warnings
 
 from ...utils.filemanip import fname_presuffix
+from ...utils.toolcache import cached_probe
 from ..base import (CommandLine, traits, CommandLineInputSpec, isdefined)
 
 warn = warnings.warn
@@ -40,7 +41,12 @@ class Info(object):
            Version number as string or None if AFNI not found
 
         """
-        clout = CommandLine(command='afni_vcheck').run()
+        return cached_probe('afni.version', Info._probe_version)
+
+    @staticmethod
+    def _probe_version():
+        clout = CommandLine(command='afni_vcheck',
+                            terminal_output='allatonce').run()
         out = clout.runtime.stdout
         return out.split('\n')[1]
 
@@ -86,7 +92,7 @@ class Info(object):
         '''Grab an image from the standard location.
 
         Could be made more fancy to allow for more relocatability'''
-        clout = CommandLine('which afni').run()
+        clout = CommandLine('which afni', terminal_output='allatonce').run()
         if clout.runtime.returncode is not 0:
             return None
 
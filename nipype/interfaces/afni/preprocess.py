@@ -1367,6 +1367,7 @@ class BrickStat(AFNICommand):
 
     """
     _cmd = '3dBrickStat'
+    _terminal_output = 'allatonce'
     input_spec = BrickStatInputSpec
     output_spec = BrickStatOutputSpec
 
@@ -1444,6 +1445,7 @@ class ROIStats(AFNICommand):
 
     """
     _cmd = '3dROIstats'
+    _terminal_output = 'allatonce'
     input_spec = ROIStatsInputSpec
     output_spec = ROIStatsOutputSpec
 
@@ -3,6 +3,8 @@
 
 """Top-level namespace for ants."""
 
+from .base import Info
+
 # Registraiton programs
 from .registration import ANTS, Registration
 
@@ -5,6 +5,7 @@
 # Local imports
 from ..base import (CommandLine, CommandLineInputSpec, traits,
 isdefined)
+from ...utils.toolcache import cached_probe, which
 
 from ... import logging
 logger = logging.getLogger('interface')
@@ -24,6 +25,36 @@ LOCAL_DEFAULT_NUMBER_OF_THREADS=-1
 PREFERED_ITKv4_THREAD_LIMIT_VARIABLE='NSLOTS'
 ALT_ITKv4_THREAD_LIMIT_VARIABLE='ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
 
+class Info(object):
+    """Handle ANTS version information
+    """
+
+    @staticmethod
+    def version():
+        """Check for ANTS version on system
+
+        Returns
+        -------
+        version : str
+           Version number as string or None if ANTS not found
+
+        """
+        if which('antsRegistration') is None:
+            return None
+        return cached_probe('ants.version', Info._probe_version,
+                            env_vars=('ANTSPATH',))
+
+    @staticmethod
+    def _probe_version():
+        clout = CommandLine(command='antsRegistration', args='--version',
+                            terminal_output='allatonce',
+                            ignore_exception=True).run()
+        for line in clout.runtime.stdout.split('\n'):
+            if 'version' in line.lower():
+                return line.split(':')[-1].strip()
+        return None
+
+
 class ANTSCommandInputSpec(CommandLineInputSpec):
     """Base Input Specification for all ANTS Commands
     """
@@ -9,6 +9,7 @@ Requires Packages to be installed
 """
 
 from ConfigParser import NoOptionError
+from collections import deque
 from copy import deepcopy
 import datetime
 import errno
@@ -18,6 +19,7 @@ from string import Template
 import select
 import subprocess
 from textwrap import wrap
+import threading
 from time import time
 from warnings import warn
 
@@ -28,6 +30,7 @@ from .traits_extension import (traits, Undefined, TraitDictObject,
 from ..utils.filemanip import (md5, hash_infile, FileNotFoundError,
                                hash_timestamp)
 from ..utils.misc import is_container, trim
+from ..utils.toolcache import which
 from .. import config, logging, LooseVersion
 from .. import __version__
 
@@ -254,6 +257,10 @@ class InterfaceResult(object):
         * stdout : The output of running the ``cmdline``.
         * stderr : Any error messages output from running ``cmdline``.
         * returncode : The code returned from running the ``cmdline``.
+        * environ : The environment variables the interface was run with.
+          Result files of workflow nodes only store the changes to the
+          environment of the process (see
+          ``nipype.pipeline.utils.expand_environ``).
 
     """
 
@@ -842,7 +849,7 @@ class BaseInterface(Interface):
         self._check_mandatory_inputs()
         interface = self.__class__
         # initialize provenance tracking
-        env = deepcopy(os.environ.data)
+        env = dict(os.environ)
         runtime = Bunch(cwd=os.getcwd(),
                         returncode=None,
                         duration=None,
@@ -918,60 +925,199 @@ class BaseInterface(Interface):
 class Stream(object):
     """Function to capture stdout and stderr streams with timestamps
 
+    Lines are stored with the time they were read. If `log` is set, every
+    chunk of lines read is also sent to the interface logger. If `limit` is
+    set, only the most recent lines totalling at most `limit` bytes are kept.
+
     http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
     """
 
-    def __init__(self, name, impl):
+    def __init__(self, name, impl, log=True, limit=0):
         self._name = name
         self._impl = impl
         self._buf = ''
-        self._rows = []
-        self._lastidx = 0
+        self._rows = deque()
+        self._size = 0
+        self._log = log
+        self._limit = limit
+        self.closed = False
 
     def fileno(self):
         "Pass-through for file descriptor."
         return self._impl.fileno()
 
-    def read(self, drain=0):
-        "Read from the file descriptor. If 'drain' set, read until EOF."
-        while self._read(drain) is not None:
-            if not drain:
-                break
-
-    def _read(self, drain):
-        "Read from the file descriptor"
-        fd = self.fileno()
-        buf = os.read(fd, 4096)
-        if not buf and not self._buf:
-            return None
+    def read(self):
+        "Read available data from the file descriptor"
+        buf = os.read(self.fileno(), 65536)
+        if not buf:
+            self.closed = True
+            if self._buf:
+                self._add_rows([self._buf])
+                self._buf = ''
+            return
+        buf = self._buf + buf
         if '\n' not in buf:
-            if not drain:
-                self._buf += buf
-                return []
+            self._buf = buf
+            return
+        tmp, self._buf = buf.rsplit('\n', 1)
+        self._add_rows(tmp.split('\n'))
 
-        # prepend any data previously read, then split into lines and format
-        buf = self._buf + buf
-        if '\n' in buf:
-            tmp, rest = buf.rsplit('\n', 1)
-        else:
-            tmp = buf
-            rest = None
-        self._buf = rest
+    def _add_rows(self, lines):
         now = datetime.datetime.now().isoformat()
-        rows = tmp.split('\n')
-        self._rows += [(now, '%s %s:%s' % (self._name, now, r), r) for r in rows]
-        for idx in range(self._lastidx, len(self._rows)):
-            iflogger.info(self._rows[idx][1])
-        self._lastidx = len(self._rows)
+        rows = [(now, '%s %s:%s' % (self._name, now, r), r) for r in lines]
+        if self._log:
+            iflogger.info('\n'.join([row[1] for row in rows]))
+        self._rows.extend(rows)
+        if self._limit:
+            self._size += sum([len(row[2]) + 1 for row in rows])
+            while self._size > self._limit and len(self._rows) > 1:
+                self._size -= len(self._rows.popleft()[2]) + 1
+
+
+# Nodes executed on threads of a single process (see the ThreadProc plugin)
+# share the working directory. Such a thread holds a lock while running python
+# code and stores it in `thread_state.cwd_lock`, so that run_command can let
+# other threads proceed while the external program is running. Whenever the
+# lock is released the working directory is reset to `thread_state.base_cwd`.
+thread_state = threading.local()
+
+terminal_output_modes = ['stream', 'allatonce', 'file', 'file_split', 'none']
+terminal_output_files = {'file': {'merged': 'output.nipype'},
+                         'file_split': {'stdout': 'stdout.nipype',
+                                        'stderr': 'stderr.nipype'},
+                         'none': {}}
+
+
+def run_command(runtime, output='stream', timeout=None):
+    """
+    Run a command and capture stdout and stderr
+
+    The capture is controlled by `output`:
+
+    - stream : lines are prefixed with a timestamp and logged as they
+      arrive. The returned runtime contains stdout, stderr and a merged
+      stdout+stderr log with timestamps.
+    - allatonce : as stream, but nothing is logged
+    - file : stdout and stderr are merged into `output.nipype` in the working
+      directory
+    - file_split : stdout and stderr are written to `stdout.nipype` and
+      `stderr.nipype` in the working directory
+    - none : the output is discarded
+
+    The configuration option `terminal_output_limit` bounds the number of
+    bytes kept per stream. For the file modes, the files are listed in
+    `runtime.output_files` and only read back when `runtime.stdout`,
+    `runtime.stderr` or `runtime.merged` are accessed (see
+    `FileOutputRuntime`). In all modes the process waits on I/O instead of
+    polling the command.
 
+    http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
+    """
+    if output not in terminal_output_modes:
+        raise ValueError('Unknown terminal output mode: %s' % output)
+    return call_without_cwd_lock(_run_command, runtime, output, timeout)
+
+
+def call_without_cwd_lock(func, *args):
+    """Call `func` letting other threads use the working directory
 
-def run_command(runtime, timeout=0.01):
+    Used around calls that wait for an external program and don't depend on
+    the working directory of the process.
+    """
+    cwd_lock = getattr(thread_state, 'cwd_lock', None)
+    if cwd_lock is None:
+        return func(*args)
+    cwd = os.getcwd()
+    os.chdir(thread_state.base_cwd)
+    cwd_lock.release()
+    try:
+        return func(*args)
+    finally:
+        cwd_lock.acquire()
+        os.chdir(cwd)
+
+
+class InterfaceBatch(object):
+    """Combines work submitted by interfaces running on several threads
+
+    A MapNode running its subnodes as a batch (see `MapNode`) runs each of
+    them on a thread sharing the working directory lock and stores the batch
+    in `thread_state.batch`. An interface supporting batches submits its
+    work to it with `submit`, which blocks until every thread still running
+    has submitted or finished. The collected items are then processed at
+    once by `_run`, implemented by subclasses.
+
+    Items are dicts that `_run` completes with a 'result' key.
     """
-    Run a command, read stdout and stderr, prefix with timestamp. The returned
-    runtime contains a merged stdout+stderr log with timestamps
 
-    http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
+    def __init__(self, nitems, cwd):
+        self.cwd = cwd
+        self._active = nitems
+        self._waiting = []
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """Add item to the batch and return its result once processed
+        """
+        item['done'] = threading.Event()
+        self._lock.acquire()
+        self._waiting.append(item)
+        items = self._take_items()
+        self._lock.release()
+        if items:
+            self._execute(items)
+        else:
+            call_without_cwd_lock(item['done'].wait)
+        if 'error' in item:
+            raise item['error']
+        return item['result']
+
+    def leave(self):
+        """Called by each thread when it doesn't submit anything else
+        """
+        self._lock.acquire()
+        self._active -= 1
+        items = self._take_items()
+        self._lock.release()
+        if items:
+            self._execute(items)
+
+    def _take_items(self):
+        if not self._waiting or len(self._waiting) < self._active:
+            return None
+        items = self._waiting
+        self._waiting = []
+        return items
+
+    def _execute(self, items):
+        cwd = os.getcwd()
+        os.chdir(self.cwd)
+        try:
+            self._run(items)
+        except Exception, e:
+            for item in items:
+                item['error'] = e
+        finally:
+            os.chdir(cwd)
+            for item in items:
+                item['done'].set()
+
+    def _run(self, items):
+        raise NotImplementedError
+
+
+def terminal_output_limit():
+    """Number of bytes of output kept in memory per stream (0: no limit)
     """
+    if config.has_option('execution', 'terminal_output_limit'):
+        return int(config.get('execution', 'terminal_output_limit'))
+    return 0
+
+
+def _run_command(runtime, output, timeout):
+    if output in terminal_output_files:
+        return _run_command_to_files(runtime, output)
+    limit = terminal_output_limit()
     PIPE = subprocess.PIPE
     proc = subprocess.Popen(runtime.cmdline,
                              stdout=PIPE,
@@ -980,34 +1126,34 @@ def run_command(runtime, timeout=0.01):
                              cwd=runtime.cwd,
                              env=runtime.environ)
     streams = [
-        Stream('stdout', proc.stdout),
-        Stream('stderr', proc.stderr)
+        Stream('stdout', proc.stdout, log=output == 'stream', limit=limit),
+        Stream('stderr', proc.stderr, log=output == 'stream', limit=limit)
         ]
 
-    def _process(drain=0):
+    open_streams = streams
+    while open_streams:
         try:
-            res = select.select(streams, [], [], timeout)
+            res = select.select(open_streams, [], [], timeout)
         except select.error, e:
             iflogger.info(str(e))
             if e[0] == errno.EINTR:
-                return
+                continue
             else:
                 raise
-        else:
-            for stream in res[0]:
-                stream.read(drain)
+        for stream in res[0]:
+            stream.read()
+        open_streams = [stream for stream in streams if not stream.closed]
+    runtime.returncode = proc.wait()
+    return collect_streams(runtime, streams)
 
-    while proc.returncode is None:
-        proc.poll()
-        _process()
-    runtime.returncode = proc.returncode
-    _process(drain=1)
 
-    # collect results, merge and return
+def collect_streams(runtime, streams):
+    """Store the lines read by `streams` in runtime, merged by time
+    """
     result = {}
     temp = []
     for stream in streams:
-        rows = stream._rows
+        rows = list(stream._rows)
         temp += rows
         result[stream._name] = [r[2] for r in rows]
     temp.sort()
@@ -1018,6 +1164,84 @@ def run_command(runtime, timeout=0.01):
     return runtime
 
 
+def _run_command_to_files(runtime, output):
+    """Run a command sending its output directly to files
+    """
+    output_files = dict([(name, os.path.join(runtime.cwd, filename))
+                         for name, filename in
+                         terminal_output_files[output].items()])
+    if output == 'none':
+        stdout = open(os.devnull, 'wb')
+        stderr = subprocess.STDOUT
+    elif output == 'file':
+        stdout = open(output_files['merged'], 'wb')
+        stderr = subprocess.STDOUT
+    else:
+        stdout = open(output_files['stdout'], 'wb')
+        stderr = open(output_files['stderr'], 'wb')
+    try:
+        proc = subprocess.Popen(runtime.cmdline,
+                                stdout=stdout,
+                                stderr=stderr,
+                                shell=True,
+                                cwd=runtime.cwd,
+                                env=runtime.environ)
+        runtime.returncode = proc.wait()
+    finally:
+        stdout.close()
+        if stderr is not subprocess.STDOUT:
+            stderr.close()
+    runtime = FileOutputRuntime([(key, value) for key, value in
+                                 runtime.items()
+                                 if key not in FileOutputRuntime.outputs])
+    runtime.output_files = output_files
+    return runtime
+
+
+class FileOutputRuntime(Bunch):
+    """Runtime of a command whose terminal output was written to files
+
+    `stdout`, `stderr` and `merged` are read from `output_files` each time
+    they are accessed, keeping at most `terminal_output_limit` bytes per
+    file. When both streams were merged into a single file, `stdout` and
+    `stderr` both hold the merged output.
+    """
+
+    outputs = ['stdout', 'stderr', 'merged']
+
+    def __getattr__(self, name):
+        if name not in self.outputs:
+            raise AttributeError(name)
+        if name == 'merged':
+            return (self._read_output('merged', 'stdout').splitlines() +
+                    self._read_output('stderr').splitlines())
+        return self._read_output(name, 'merged')
+
+    def _read_output(self, *names):
+        output_files = self.__dict__.get('output_files', {})
+        for name in names:
+            if name in output_files:
+                output = _read_tail(output_files[name],
+                                    terminal_output_limit())
+                if output.endswith('\n'):
+                    output = output[:-1]
+                return output
+        return ''
+
+
+def _read_tail(filename, nbytes=10000):
+    """Returns at most the last `nbytes` of a file (all of it if `nbytes` is
+    0)
+    """
+    if not os.path.exists(filename):
+        return ''
+    with open(filename, 'rb') as fp:
+        if nbytes:
+            fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, fp.tell() - nbytes))
+        return fp.read()
+
+
 class CommandLineInputSpec(BaseInterfaceInputSpec):
     args = traits.Str(argstr='%s', desc='Additional parameters to the command')
     environ = traits.DictStrStr(desc='Environment variables', usedefault=True,
@@ -1053,12 +1277,21 @@ class CommandLine(BaseInterface):
     >>> cli.inputs.get_hashval()
     ({'args': '-al'}, 'a2f45e04a34630c5f33a75ea2a533cdd')
 
+    The way the terminal output is captured can be changed for an instance
+    or, with `set_default_terminal_output`, for all instances. See
+    `run_command` for the available modes.
+
+    >>> cli.terminal_output = 'file'
+    >>> cli.terminal_output
+    'file'
+
     """
 
     input_spec = CommandLineInputSpec
     _cmd = None
+    _terminal_output = 'stream'
 
-    def __init__(self, command=None, **inputs):
+    def __init__(self, command=None, terminal_output=None, **inputs):
         super(CommandLine, self).__init__(**inputs)
         self._environ = None
         if not hasattr(self, '_cmd'):
@@ -1067,6 +1300,32 @@ class CommandLine(BaseInterface):
             raise Exception("Missing command")
         if command:
             self._cmd = command
+        if terminal_output is not None:
+            self.terminal_output = terminal_output
+
+    @classmethod
+    def set_default_terminal_output(cls, output_type):
+        """Set the default terminal output for CommandLine interfaces
+
+        Interfaces that parse the output of their command set their own
+        in-memory mode and are not affected.
+        """
+        if output_type not in terminal_output_modes:
+            raise AttributeError('Invalid terminal output_type: %s' %
+                                 output_type)
+        cls._terminal_output = output_type
+
+    @property
+    def terminal_output(self):
+        """how the output of the command is captured (see `run_command`)"""
+        return self._terminal_output
+
+    @terminal_output.setter
+    def terminal_output(self, output_type):
+        if output_type not in terminal_output_modes:
+            raise AttributeError('Invalid terminal output_type: %s' %
+                                 output_type)
+        self._terminal_output = output_type
 
     @property
     def cmd(self):
@@ -1084,8 +1343,13 @@ class CommandLine(BaseInterface):
 
     def raise_exception(self, runtime):
         message = "Command:\n" + runtime.cmdline + "\n"
-        message += "Standard output:\n" + runtime.stdout + "\n"
-        message += "Standard error:\n" + runtime.stderr + "\n"
+        if getattr(runtime, 'output_files', None) is not None:
+            for name, filename in sorted(runtime.output_files.items()):
+                message += "Output (%s, last lines of %s):\n%s\n" % (
+                    name, filename, _read_tail(filename))
+        else:
+            message += "Standard output:\n" + runtime.stdout + "\n"
+            message += "Standard error:\n" + runtime.stderr + "\n"
         message += "Return code: " + str(runtime.returncode)
         raise RuntimeError(message)
 
@@ -1129,25 +1393,22 @@ class CommandLine(BaseInterface):
         if not self._exists_in_path(self.cmd.split()[0]):
             raise IOError("%s could not be found on host %s" % (self.cmd.split()[0],
                                                                 runtime.hostname))
-        runtime = run_command(runtime)
+        runtime = self._execute_command(runtime)
         if runtime.returncode is None or runtime.returncode != 0:
             self.raise_exception(runtime)
 
         return runtime
 
+    def _execute_command(self, runtime):
+        """Run the command line of runtime and return the updated runtime
+        """
+        return run_command(runtime, output=self.terminal_output)
+
     def _exists_in_path(self, cmd):
         '''
-        Based on a code snippet from http://orip.org/2009/08/python-checking-if-executable-exists-in.html
+        Checks the PATH for `cmd`, caching the lookup across nodes
         '''
-
-        extensions = os.environ.get("PATHEXT", "").split(os.pathsep)
-        for directory in os.environ.get("PATH", "").split(os.pathsep):
-            base = os.path.join(directory, cmd)
-            options = [base] + [(base + ext) for ext in extensions]
-            for filename in options:
-                if os.path.exists(filename):
-                    return True
-        return False
+        return which(cmd) is not None
 
     def _gen_filename(self, name):
         """ Generate filename attributes before running.
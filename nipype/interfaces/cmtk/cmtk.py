@@ -14,6 +14,7 @@ from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, trait
                                     OutputMultiPath, isdefined)
 from nipype.utils.filemanip import split_filename
 import pickle
+from itertools import islice
 import scipy.io as sio
 import os, os.path as op
 import numpy as np
@@ -68,60 +69,133 @@ def length(xyz, along=False):
         return np.cumsum(dists)
     return np.sum(dists)
 
+def concatenate_streamlines(streamlines):
+    """ Concatenate the points of all streamlines
+
+    Parameters
+    ----------
+    streamlines: sequence of (points, scalars, properties) tuples as returned
+    by nibabel.trackvis.read
+    Returns
+    -------
+    (points: array of size [#points, 3] with the points of all streamlines
+    offsets) : array of size [#streamlines + 1]; the points of streamline i
+    are points[offsets[i]:offsets[i + 1]]
+    """
+    counts = np.array([len(streamline[0]) for streamline in streamlines],
+                      dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    if offsets[-1] == 0:
+        return np.zeros((0, 3)), offsets
+    points = np.concatenate([streamline[0] for streamline in streamlines])
+    return points, offsets
+
+def streamline_lengths(points, offsets):
+    """ Euclidean length of every streamline of concatenated points (see
+    `length`)
+
+    The segment lengths are computed in the precision of the points and
+    summed in double precision.
+    """
+    if len(points) == 0:
+        return np.zeros(len(offsets) - 1)
+    segments = np.zeros(len(points))
+    segments[:-1] = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    # the segments from the last point of a streamline to the next one
+    segments[offsets[1:][offsets[1:] > 0] - 1] = 0
+    starts = np.minimum(offsets[:-1], len(points) - 1)
+    lengths = np.add.reduceat(segments, starts)
+    lengths[np.diff(offsets) < 2] = 0
+    return lengths
+
+def voxel_indices(pointsmm, voxelSize):
+    """ Voxel indices (truncated towards zero) of points in millimeters """
+    return np.trunc(pointsmm / np.asarray(voxelSize, dtype=np.float64)).astype(int)
+
+def group_statistics(groups, values):
+    """ Size, mean, median and standard deviation of the values of every group
+
+    Parameters
+    ----------
+    groups: integer array with the group of every value
+    values: array of values
+    Returns
+    -------
+    (group ids, counts, means, medians, stds) of the non-empty groups in
+    increasing order of group ids
+    """
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    counts = np.diff(np.concatenate((starts, [len(groups)])))
+    means = np.add.reduceat(values, starts) / counts
+    deviations = (values - np.repeat(means, counts)) ** 2
+    stds = np.sqrt(np.add.reduceat(deviations, starts) / counts)
+    medians = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2.
+    return groups[starts], counts, means, medians, stds
+
+def _crossed_rois(points, offsets, roiData, voxelSize):
+    """ Sorted unique (fiber, roi) pairs of the labeled voxels visited by
+    every fiber """
+    idx = voxel_indices(points, voxelSize)
+    labels = roiData[idx[:, 0], idx[:, 1], idx[:, 2]].astype(np.int64)
+    fibers = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    labeled = labels != 0
+    n_labels = labels.max() + 1 if len(labels) else 1
+    keys = np.unique(fibers[labeled] * n_labels + labels[labeled])
+    return keys // n_labels, keys % n_labels
+
 def get_rois_crossed(pointsmm, roiData, voxelSize):
-	n_points = len(pointsmm)
-	rois_crossed = []
-	for j in xrange(0, n_points):
-		# store point
-		x = int(pointsmm[j, 0] / float(voxelSize[0]))
-		y = int(pointsmm[j, 1] / float(voxelSize[1]))
-		z = int(pointsmm[j, 2] / float(voxelSize[2]))
-		if not roiData[x, y, z] == 0:
-			rois_crossed.append(roiData[x, y, z])
-	rois_crossed = dict.fromkeys(rois_crossed).keys() #Removed duplicates from the list
-	return rois_crossed
+    _, rois_crossed = _crossed_rois(np.asarray(pointsmm, dtype=np.float64),
+                                    np.array([0, len(pointsmm)]), roiData,
+                                    voxelSize)
+    return rois_crossed.tolist()
+
+def _cooccurrence_matrix(n_rois, fibers, rois):
+    """ Number of fibers crossing both rois of every pair of distinct rois """
+    from scipy import sparse
+    crossings = sparse.csr_matrix((np.ones(len(fibers), dtype=np.int64),
+                                   (fibers, rois - 1)),
+                                  shape=(fibers.max() + 1 if len(fibers) else 0,
+                                         n_rois))
+    connectivity_matrix = np.asarray((crossings.T * crossings).todense(),
+                                     dtype=np.uint)
+    connectivity_matrix[np.diag_indices(n_rois)] = 0
+    return connectivity_matrix
 
 def get_connectivity_matrix(n_rois, list_of_roi_crossed_lists):
-	connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
-	for rois_crossed in list_of_roi_crossed_lists:
-		for idx_i, roi_i in enumerate(rois_crossed):
-			for idx_j, roi_j in enumerate(rois_crossed):
-				if idx_i > idx_j:
-					if not roi_i == roi_j:
-						connectivity_matrix[roi_i - 1, roi_j - 1] += 1
-	connectivity_matrix = connectivity_matrix + connectivity_matrix.T
-	return connectivity_matrix
-
-def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois):
-	""" Create the intersection arrays for each fiber
-	"""
-	n_fib = len(streamlines)
-	pc = -1
-	# Computation for each fiber
-	final_fiber_ids = []
-	list_of_roi_crossed_lists = []
-	for i, fiber in enumerate(streamlines):
-		pcN = int(round(float(100 * i) / n_fib))
-		if pcN > pc and pcN % 1 == 0:
-			pc = pcN
-			print '%4.0f%%' % (pc)
-		rois_crossed = get_rois_crossed(fiber[0], roiData, voxelSize)
-		if len(rois_crossed) > 0:
-			list_of_roi_crossed_lists.append(list(rois_crossed))
-			final_fiber_ids.append(i)
-
-	connectivity_matrix = get_connectivity_matrix(n_rois, list_of_roi_crossed_lists)
-	dis = n_fib - len(final_fiber_ids)
-	iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
-	iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
-	iflogger.info('Returning the intersecting point connectivity matrix')
-	return connectivity_matrix, final_fiber_ids
-
-def create_endpoints_array(fib, voxelSize):
+    fibers = np.repeat(np.arange(len(list_of_roi_crossed_lists)),
+                       [len(rois) for rois in list_of_roi_crossed_lists])
+    rois = np.array([roi for rois in list_of_roi_crossed_lists for roi in rois],
+                    dtype=np.int64)
+    return _cooccurrence_matrix(n_rois, fibers, rois)
+
+def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois, offsets=None):
+    """ Create the intersection arrays for each fiber
+
+    streamlines are either as read by nibabel.trackvis.read or, if offsets
+    are given, the concatenated points of all fibers
+    """
+    if offsets is None:
+        points, offsets = concatenate_streamlines(streamlines)
+    else:
+        points = streamlines
+    n_fib = len(offsets) - 1
+    fibers, rois = _crossed_rois(points, offsets, roiData, voxelSize)
+    final_fiber_ids = np.unique(fibers).tolist()
+
+    connectivity_matrix = _cooccurrence_matrix(n_rois, fibers, rois)
+    _log_orphans(n_fib - len(final_fiber_ids), n_fib)
+    iflogger.info('Returning the intersecting point connectivity matrix')
+    return connectivity_matrix, final_fiber_ids
+
+def create_endpoints_array(fib, voxelSize, offsets=None):
     """ Create the endpoints arrays for each fiber
     Parameters
     ----------
-    fib: the fibers data
+    fib: the fibers data, or the concatenated points of all fibers if
+    offsets are given
     voxelSize: 3-tuple containing the voxel size of the ROI image
     Returns
     -------
@@ -129,41 +203,32 @@ def create_endpoints_array(fib, voxelSize):
     index of its first and last point in the voxelSize volume
     endpointsmm) : endpoints in milimeter coordinates
     """
-
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
+    if offsets is None:
+        points, offsets = concatenate_streamlines(fib)
+    else:
+        points = fib
+    n = len(offsets) - 1
     endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-        f = fi[0]
-
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
-
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
-
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    if n:
+        endpointsmm[:, 0, :] = points[offsets[:-1]]
+        endpointsmm[:, 1, :] = points[offsets[1:] - 1]
+    # Translate from mm to index (adding 0 turns -0. into 0.)
+    endpoints = np.trunc(endpointsmm / np.asarray(voxelSize, dtype=np.float64)) + 0.
 
     # Return the matrices
     iflogger.info('Returning the endpoint matrix')
     return (endpoints, endpointsmm)
 
-def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_name, endpoint_name, intersections=False):
-    """ Create the connection matrix for each resolution using fibers and ROIs. """
+def _log_orphans(dis, n):
+    iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n, n))
+    iflogger.info("Valid fibers: %i (%f percent)" % (n - dis, 100 - dis * 100.0 / n))
+
+def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_name, endpoint_name, intersections=False, batch_size=100000):
+    """ Create the connection matrix for each resolution using fibers and ROIs.
+
+    The track file is read in batches of batch_size fibers; only arrays with
+    a row per fiber (endpoints, lengths, labels) are kept for all fibers.
+    """
 
     stats = {}
     iflogger.info('Running cmat function')
@@ -171,28 +236,9 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     en_fname = op.abspath(endpoint_name + '_endpoints.npy')
     en_fnamemm = op.abspath(endpoint_name + '_endpointsmm.npy')
 
-    iflogger.info('Reading Trackvis file {trk}'.format(trk=track_file))
-    fib, hdr = nb.trackvis.read(track_file, False)
-    stats['orig_n_fib'] = len(fib)
-    
     roi = nb.load(roi_file)
     roiData = roi.get_data()
     roiVoxelSize = roi.get_header().get_zooms()
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize)
-
-    # Output endpoint arrays
-    iflogger.info('Saving endpoint array: {array}'.format(array=en_fname))
-    np.save(en_fname, endpoints)
-    iflogger.info('Saving endpoint array in mm: {array}'.format(array=en_fnamemm))
-    np.save(en_fnamemm, endpointsmm)
-
-    n = len(fib)
-    iflogger.info('Number of fibers {num}'.format(num=n))
-
-    # Create empty fiber label array
-    fiberlabels = np.zeros((n, 2))
-    final_fiberlabels = []
-    final_fibers_idx = []
 
     # Add node information from specified parcellation scheme
     path, name, ext = split_filename(resolution_network_file)
@@ -215,102 +261,126 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
             xyz = tuple(np.mean(np.where(np.flipud(roiData) == int(d["dn_correspondence_id"])) , axis=1))
             G.node[int(u)]['dn_position'] = tuple([xyz[0], xyz[2], -xyz[1]])
 
+    # Stream the fibers in batches, keeping only per fiber arrays
+    iflogger.info('Reading Trackvis file {trk}'.format(trk=track_file))
+    hdr = nb.trackvis.read(track_file, as_generator=True)[1]
+    endpoints = []
+    endpointsmm = []
+    fiberlengths = []
+    final_fiber_ids = []
+    intersection_matrix = np.zeros((nROIs, nROIs), dtype=np.uint)
+    n = 0
+    for points, offsets in iter_streamline_batches(track_file, batch_size):
+        batch_endpoints, batch_endpointsmm = create_endpoints_array(points, roiVoxelSize, offsets)
+        endpoints.append(batch_endpoints)
+        endpointsmm.append(batch_endpointsmm)
+        fiberlengths.append(streamline_lengths(points, offsets))
+        if intersections:
+            fibers, rois = _crossed_rois(points, offsets, roiData, roiVoxelSize)
+            intersection_matrix += _cooccurrence_matrix(nROIs, fibers, rois)
+            final_fiber_ids.extend((np.unique(fibers) + n).tolist())
+        n += len(offsets) - 1
+    endpoints = np.concatenate(endpoints or [np.zeros((0, 2, 3))])
+    endpointsmm = np.concatenate(endpointsmm or [np.zeros((0, 2, 3))])
+    fiberlengths = np.concatenate(fiberlengths or [np.zeros(0)])
+    stats['orig_n_fib'] = n
+
+    # Output endpoint arrays
+    iflogger.info('Saving endpoint array: {array}'.format(array=en_fname))
+    np.save(en_fname, endpoints)
+    iflogger.info('Saving endpoint array in mm: {array}'.format(array=en_fnamemm))
+    np.save(en_fnamemm, endpointsmm)
+
+    iflogger.info('Number of fibers {num}'.format(num=n))
+
+    # Create empty fiber label array
+    fiberlabels = np.zeros((n, 2))
+
     if intersections:
         iflogger.info("Filtering tractography from intersections")
-        intersection_matrix, final_fiber_ids = create_allpoints_cmat(fib, roiData, roiVoxelSize, nROIs)
+        _log_orphans(n - len(final_fiber_ids), n)
+        iflogger.info('Returning the intersecting point connectivity matrix')
         finalfibers_fname = op.abspath(endpoint_name + '_intersections_streamline_final.trk')
-        stats['intersections_n_fib'] = save_fibers(hdr, fib, finalfibers_fname, final_fiber_ids)
+        stats['intersections_n_fib'] = save_fibers(hdr, track_file, finalfibers_fname, final_fiber_ids)
         intersection_matrix = np.matrix(intersection_matrix)
         I = G.copy()
         H = nx.from_numpy_matrix(np.matrix(intersection_matrix))
-        H = nx.relabel_nodes(H, lambda x: x + 1) #relabel nodes so they start at 1		
+        H = nx.relabel_nodes(H, lambda x: x + 1) #relabel nodes so they start at 1
         I.add_weighted_edges_from(((u, v, d['weight']) for u, v, d in H.edges(data=True)))
 
-    dis = 0
-    for i in xrange(endpoints.shape[0]):
-
-        # ROI start => ROI end
-        try:
-            startROI = int(roiData[endpoints[i, 0, 0], endpoints[i, 0, 1], endpoints[i, 0, 2]])
-            endROI = int(roiData[endpoints[i, 1, 0], endpoints[i, 1, 1], endpoints[i, 1, 2]])
-        except IndexError:
-            iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % i))
-            break
-
-        # Filter
-        if startROI == 0 or endROI == 0:
-            dis += 1
-            fiberlabels[i, 0] = -1
-            continue
-
-        if startROI > nROIs or endROI > nROIs:
-            iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-            iflogger.error("than is expected by the parcellation node information.")
-            iflogger.error("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-            iflogger.error("This needs bugfixing!")
-            continue
-
-        # Update fiber label
-        # switch the rois in order to enforce startROI < endROI
-        if endROI < startROI:
-            tmp = startROI
-            startROI = endROI
-            endROI = tmp
-
-        fiberlabels[i, 0] = startROI
-        fiberlabels[i, 1] = endROI
-
-        final_fiberlabels.append([ startROI, endROI ])
-        final_fibers_idx.append(i)
-
-        # Add edge to graph
-        if G.has_edge(startROI, endROI) and G.edge[startROI][endROI].has_key('fiblist'):
-            G.edge[startROI][endROI]['fiblist'].append(i)
-        else:
-            G.add_edge(startROI, endROI, fiblist=[i])
+    # ROI start => ROI end
+    endpoints_idx = endpoints.astype(int)
+    outside = np.any((endpoints_idx >= roiData.shape[:3]) |
+                     (endpoints_idx < -np.array(roiData.shape[:3])), axis=2).any(axis=1)
+    n_checked = n
+    if outside.any():
+        n_checked = np.argmax(outside)
+        iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % n_checked))
+    endpoints_idx = endpoints_idx[:n_checked]
+    startROIs = roiData[endpoints_idx[:, 0, 0], endpoints_idx[:, 0, 1], endpoints_idx[:, 0, 2]].astype(int)
+    endROIs = roiData[endpoints_idx[:, 1, 0], endpoints_idx[:, 1, 1], endpoints_idx[:, 1, 2]].astype(int)
+
+    # Filter
+    orphans = (startROIs == 0) | (endROIs == 0)
+    dis = int(orphans.sum())
+    fiberlabels[np.flatnonzero(orphans), 0] = -1
+    too_high = ~orphans & ((startROIs > nROIs) | (endROIs > nROIs))
+    for i in np.flatnonzero(too_high):
+        iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
+        iflogger.error("than is expected by the parcellation node information.")
+        iflogger.error("Start ROI: %i, End ROI: %i" % (startROIs[i], endROIs[i]))
+        iflogger.error("This needs bugfixing!")
+
+    # Update fiber label
+    # switch the rois in order to enforce startROI < endROI
+    final_fibers_idx = np.flatnonzero(~orphans & ~too_high)
+    final_fiberlabels_array = np.column_stack((
+        np.minimum(startROIs, endROIs)[final_fibers_idx],
+        np.maximum(startROIs, endROIs)[final_fibers_idx])).astype(int)
+    fiberlabels[final_fibers_idx] = final_fiberlabels_array
 
     # create a final fiber length array
-    finalfiberlength = []
     if intersections:
-        final_fibers_indices = final_fiber_ids
+        final_fiberlength_array = fiberlengths[np.array(final_fiber_ids, dtype=int)]
     else:
-        final_fibers_indices = final_fibers_idx
-
-    for idx in final_fibers_indices:
-        # compute length of fiber
-        finalfiberlength.append(length(fib[idx][0]))
-
-    # convert to array
-    final_fiberlength_array = np.array(finalfiberlength)
-
-    # make final fiber labels as array
-    final_fiberlabels_array = np.array(final_fiberlabels, dtype=int)
-
-    iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n, n))
-    iflogger.info("Valid fibers: %i (%f percent)" % (n - dis, 100 - dis * 100.0 / n))
+        final_fiberlength_array = fiberlengths[final_fibers_idx]
+
+    _log_orphans(dis, n)
+
+    # statistics of the fibers connecting each pair of ROIs, in the order in
+    # which the pairs first occur
+    pair_keys = final_fiberlabels_array[:, 0] * (nROIs + 1) + final_fiberlabels_array[:, 1]
+    unique_keys, first, pair_idx = np.unique(pair_keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(first), dtype=int)
+    rank[order] = np.arange(len(first))
+    pair_ids, counts, means, medians, stds = group_statistics(rank[pair_idx], fiberlengths[final_fibers_idx])
+    pair_keys = unique_keys[order]
+    fiber_edges = {}
+    for pair, count, mean, median, std in zip(pair_ids, counts, means, medians, stds):
+        u, v = [int(roi) for roi in divmod(pair_keys[pair], nROIs + 1)]
+        # Add edge to graph
+        G.add_edge(u, v)
+        fiber_edges[(u, v)] = {'number_of_fibers': int(count),
+                               'fiber_length_mean': float(mean),
+                               'fiber_length_median': float(median),
+                               'fiber_length_std': float(std)}
 
     numfib = nx.Graph()
     numfib.add_nodes_from(G)
     fibmean = numfib.copy()
     fibmedian = numfib.copy()
     fibdev = numfib.copy()
-    for u, v, d in G.edges_iter(data=True):
+    for u, v in G.edges():
         G.remove_edge(u, v)
-        di = {}
-        if d.has_key('fiblist'):
-            di['number_of_fibers'] = len(d['fiblist'])
-            idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (final_fiberlabels_array[:, 1] == int(v)))[0]
-            di['fiber_length_mean'] = float(np.mean(final_fiberlength_array[idx]))
-            di['fiber_length_median'] = float(np.median(final_fiberlength_array[idx]))
-            di['fiber_length_std'] = float(np.std(final_fiberlength_array[idx]))
-        else:
-            di['number_of_fibers'] = 0
-            di['fiber_length_mean'] = 0
-            di['fiber_length_median'] = 0
-            di['fiber_length_std'] = 0
+        di = fiber_edges.get((u, v), fiber_edges.get((v, u)))
+        has_fibers = di is not None
+        if not has_fibers:
+            di = {'number_of_fibers': 0, 'fiber_length_mean': 0,
+                  'fiber_length_median': 0, 'fiber_length_std': 0}
         if not u == v: #Fix for self loop problem
             G.add_edge(u, v, di)
-            if d.has_key('fiblist'):
+            if has_fibers:
                 numfib.add_edge(u, v, weight=di['number_of_fibers'])
                 fibmean.add_edge(u, v, weight=di['fiber_length_mean'])
                 fibmedian.add_edge(u, v, weight=di['fiber_length_median'])
@@ -374,20 +444,58 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
 
     iflogger.info("Filtering tractography - keeping only no orphan fibers")
     finalfibers_fname = op.abspath(endpoint_name + '_streamline_final.trk')
-    stats['endpoint_n_fib'] = save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    stats['endpoint_n_fib'] = save_fibers(hdr, track_file, finalfibers_fname, final_fibers_idx)
     stats['endpoints_percent'] = float(stats['endpoint_n_fib'])/float(stats['orig_n_fib'])*100
-    stats['intersections_percent'] = float(stats['intersections_n_fib'])/float(stats['orig_n_fib'])*100
+    if intersections:
+        stats['intersections_percent'] = float(stats['intersections_n_fib'])/float(stats['orig_n_fib'])*100
     
     out_stats_file = op.abspath(endpoint_name + '_statistics.mat')
     iflogger.info("Saving matrix creation statistics as %s" % out_stats_file)
     sio.savemat(out_stats_file, stats)
 
+class SelectedStreamlines(object):
+    """ Streams the fibers with the given (increasing) indices from a track
+    file; the length is known upfront, so it can be written to the header
+    """
+
+    def __init__(self, track_file, indices):
+        self.track_file = track_file
+        self.indices = np.asarray(indices, dtype=int)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        if not len(self.indices):
+            return
+        selected = np.zeros(self.indices.max() + 1, dtype=bool)
+        selected[self.indices] = True
+        streams = nb.trackvis.read(self.track_file, as_generator=True)[0]
+        for i, stream in enumerate(islice(streams, len(selected))):
+            if selected[i]:
+                yield stream
+
+def iter_streamline_batches(track_file, batch_size=100000):
+    """ Yields the fibers of a track file in batches of batch_size fibers as
+    concatenated points and offsets (see `concatenate_streamlines`) """
+    streams = nb.trackvis.read(track_file, as_generator=True)[0]
+    while True:
+        batch = list(islice(streams, batch_size))
+        if not batch:
+            return
+        yield concatenate_streamlines(batch)
+
 def save_fibers(oldhdr, oldfib, fname, indices):
-    """ Stores a new trackvis file fname using only given indices """
+    """ Stores a new trackvis file fname using only given indices
+
+    oldfib is either the list of fibers or the name of the track file the
+    fibers are streamed from
+    """
     hdrnew = oldhdr.copy()
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
+    if isinstance(oldfib, basestring):
+        outstreams = SelectedStreamlines(oldfib, indices)
+    else:
+        outstreams = [oldfib[i] for i in indices]
     n_fib_out = len(outstreams)
     hdrnew['n_count'] = n_fib_out
     iflogger.info("Writing final non-orphan fibers as %s" % fname)
@@ -406,6 +514,7 @@ class CreateMatrixInputSpec(TraitedSpec):
     out_fiber_length_std_matrix_mat_file = File(genfile=True, desc='Matlab matrix describing the deviation in fiber lengths connecting each node.')
     out_intersection_matrix_mat_file = File(genfile=True, desc='Matlab connectivity matrix if all region/fiber intersections are counted.')
     out_endpoint_array_name = File(genfile=True, desc='Name for the generated endpoint arrays')
+    batch_size = traits.Int(100000, usedefault=True, desc='Number of fibers read from the tract file at once')
 
 class CreateMatrixOutputSpec(TraitedSpec):
     matrix_file = File(desc='NetworkX graph describing the connectivity', exists=True)
@@ -479,7 +588,8 @@ class CreateMatrix(BaseInterface):
             endpoint_name = op.abspath(self.inputs.out_endpoint_array_name)
 
         cmat(self.inputs.tract_file, self.inputs.roi_file, self.inputs.resolution_network_file,
-        matrix_file, matrix_mat_file, endpoint_name, self.inputs.count_region_intersections)
+        matrix_file, matrix_mat_file, endpoint_name, self.inputs.count_region_intersections,
+        self.inputs.batch_size)
         return runtime
 
     def _list_outputs(self):
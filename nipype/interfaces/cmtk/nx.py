@@ -14,9 +14,13 @@ from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, trait
                                     OutputMultiPath, isdefined)
 from nipype.utils.filemanip import split_filename
 import os, os.path as op
+from multiprocessing import Pool, current_process
+from numbers import Number
+from time import time
 import numpy as np
 import networkx as nx
 import scipy.io as sio
+from scipy import sparse
 import pickle
 from nipype.utils.misc import package_check
 import warnings
@@ -95,10 +99,53 @@ def add_dicts_by_key(in_dict1, in_dict2):
     return both
 
 
+def edge_attribute_matrices(ntwk, node_index):
+    """
+    Converts the edges of a network into sparse upper triangular matrices
+
+    Returns a matrix of ones marking the edges and, for each numeric edge
+    attribute, a matrix of its values and a matrix marking the edges on which
+    it is defined. Nodes are mapped to rows and columns with node_index.
+    """
+    n_nodes = len(node_index)
+    edges = ntwk.edges(data=True)
+    rows = np.zeros(len(edges), dtype=int)
+    cols = np.zeros(len(edges), dtype=int)
+    attributes = {}
+    for idx, (u, v, data) in enumerate(edges):
+        rows[idx], cols[idx] = sorted((node_index[u], node_index[v]))
+        for key, value in data.iteritems():
+            if key != 'count' and isinstance(value, Number):
+                attributes.setdefault(key, ([], []))
+                attributes[key][0].append(idx)
+                attributes[key][1].append(value)
+
+    def to_matrix(values, idx=slice(None)):
+        return sparse.coo_matrix((values, (rows[idx], cols[idx])),
+                                 shape=(n_nodes, n_nodes)).tocsr()
+
+    counts = to_matrix(np.ones(len(edges)))
+    matrices = {}
+    for key, (idx, values) in attributes.iteritems():
+        matrices[key] = (to_matrix(np.array(values, dtype=float), idx),
+                         to_matrix(np.ones(len(idx)), idx))
+    return counts, matrices
+
+
+def _sparse_values(matrix, rows, cols):
+    if len(rows) == 0:
+        return np.zeros(0)
+    return np.asarray(matrix[rows, cols]).ravel()
+
+
 def average_networks(in_files, ntwk_res_file, group_id):
     """
     Sums the edges of input networks and divides by the number of networks
     Writes the average network as .pck and .gexf and returns the name of the written networks
+
+    The edge attributes of all networks are summed in sparse matrices indexed
+    by the nodes of the resolution network, which are converted back to a
+    network once all files have been read.
     """
     import networkx as nx
     import os.path as op
@@ -111,66 +158,60 @@ def average_networks(in_files, ntwk_res_file, group_id):
         iflogger.info("Number of networks: {L}, an edge must occur in at least {c} to remain in the average network".format(L=len(in_files), c=count_to_keep_edge))
         ntwk_res_file = read_unknown_ntwk(ntwk_res_file)
         iflogger.info("{n} Nodes found in network resolution file".format(n=ntwk_res_file.number_of_nodes()))
-        ntwk = remove_all_edges(ntwk_res_file)
-        counting_ntwk = ntwk.copy()
+        nodes = sorted(ntwk_res_file.nodes())
+        node_index = dict([(node, idx) for idx, node in enumerate(nodes)])
+        n_files = float(len(in_files))
+
         # Sums all the relevant variables
-        for index, subject in enumerate(in_files):
+        counts = None
+        sums = {}
+        node_values = np.zeros(len(nodes))
+        has_node_values = False
+        for subject in in_files:
             tmp = nx.read_gpickle(subject)
             iflogger.info('File {s} has {n} edges'.format(s=subject, n=tmp.number_of_edges()))
-            edges = tmp.edges_iter()
-            for edge in edges:
-                data = {}
-                data = tmp.edge[edge[0]][edge[1]]
-                data['count'] = 1
-                if ntwk.has_edge(edge[0], edge[1]):
-                    current = {}
-                    current = ntwk.edge[edge[0]][edge[1]]
-                    data = add_dicts_by_key(current, data)
-                ntwk.add_edge(edge[0], edge[1], data)
-            nodes = tmp.nodes_iter()
-            for node in nodes:
-                data = {}
-                data = ntwk.node[node]
-                if tmp.node[node].has_key('value'):
-                    data['value'] = data['value'] + tmp.node[node]['value']
-                ntwk.add_node(node, data)
+            subject_counts, matrices = edge_attribute_matrices(tmp, node_index)
+            if counts is None:
+                counts = subject_counts
+            else:
+                counts = counts + subject_counts
+            for key, (values, defined) in matrices.iteritems():
+                if key in sums:
+                    sums[key] = (sums[key][0] + values, sums[key][1] + defined)
+                else:
+                    sums[key] = (values, defined)
+            for node, data in tmp.nodes_iter(data=True):
+                if data.has_key('value'):
+                    node_values[node_index[node]] += data['value']
+                    has_node_values = True
 
         # Divides each value by the number of files
-        nodes = ntwk.nodes_iter()
-        edges = ntwk.edges_iter()
-        iflogger.info('Total network has {n} edges'.format(n=ntwk.number_of_edges()))
+        counts = counts.tocoo()
+        iflogger.info('Total network has {n} edges'.format(n=counts.nnz))
         avg_ntwk = nx.Graph()
-        newdata = {}
-        for node in nodes:
-            data = ntwk.node[node]
-            newdata = data
-            if data.has_key('value'):
-                newdata['value'] = data['value'] / len(in_files)
-                ntwk.node[node]['value'] = newdata
-            avg_ntwk.add_node(node, newdata)
+        for idx, node in enumerate(nodes):
+            data = dict(ntwk_res_file.node[node])
+            if has_node_values:
+                data['value'] = float(node_values[idx] / n_files)
+            avg_ntwk.add_node(node, data)
 
         edge_dict = {}
-        edge_dict['count'] = np.zeros((avg_ntwk.number_of_nodes(), avg_ntwk.number_of_nodes()))
-        for edge in edges:
-            data = ntwk.edge[edge[0]][edge[1]]
-            if ntwk.edge[edge[0]][edge[1]]['count'] >= count_to_keep_edge:
-                for key in data.keys():
-                    if not key == 'count':
-                        data[key] = data[key] / len(in_files)
-                ntwk.edge[edge[0]][edge[1]] = data
-                avg_ntwk.add_edge(edge[0],edge[1],data)
-            edge_dict['count'][edge[0]-1][edge[1]-1] = ntwk.edge[edge[0]][edge[1]]['count']
+        edge_dict['count'] = counts.toarray()
+        keep = counts.data >= count_to_keep_edge
+        rows, cols = counts.row[keep], counts.col[keep]
+        edge_data = [{'count': int(count)} for count in counts.data[keep]]
+        for key, (values, defined) in sums.iteritems():
+            edge_dict[key] = np.zeros((len(nodes), len(nodes)))
+            values = _sparse_values(values, rows, cols) / n_files
+            defined = _sparse_values(defined, rows, cols) > 0
+            edge_dict[key][rows[defined], cols[defined]] = values[defined]
+            for idx in np.flatnonzero(defined):
+                edge_data[idx][key] = float(values[idx])
+        avg_ntwk.add_edges_from([(nodes[row], nodes[col], data) for row, col, data
+                                 in zip(rows, cols, edge_data)])
 
         iflogger.info('After thresholding, the average network has has {n} edges'.format(n=avg_ntwk.number_of_edges()))
 
-        avg_edges = avg_ntwk.edges_iter()
-        for edge in avg_edges:
-            data = avg_ntwk.edge[edge[0]][edge[1]]
-            for key in data.keys():
-                if not key == 'count':
-                    edge_dict[key] = np.zeros((avg_ntwk.number_of_nodes(), avg_ntwk.number_of_nodes()))
-                    edge_dict[key][edge[0]-1][edge[1]-1] = data[key]
-
         for key in edge_dict.keys():
             tmp = {}
             network_name = group_id + '_' + key + '_average.mat'
@@ -190,43 +231,184 @@ def average_networks(in_files, ntwk_res_file, group_id):
     return network_name, matlab_network_list
 
 
-def compute_node_measures(ntwk, calculate_cliques=False):
+node_metrics = ['degree', 'load_centrality', 'betweenness_centrality',
+                'degree_centrality', 'closeness_centrality', 'triangles',
+                'clustering', 'core_number', 'isolates']
+node_clique_metrics = ['node_clique_number', 'number_of_cliques']
+global_metrics = ['degree_pearsonr', 'degree_assortativity', 'transitivity',
+                  'number_connected_components', 'graph_density',
+                  'number_of_edges', 'number_of_nodes', 'average_clustering',
+                  'average_shortest_path_length']
+global_clique_metrics = ['graph_clique_number']
+dict_metrics = ['rich_club_coef']
+all_metrics = (node_metrics + node_clique_metrics + global_metrics +
+               global_clique_metrics + dict_metrics)
+path_length_metrics = ['closeness_centrality', 'average_shortest_path_length']
+
+
+def shortest_path_lengths(ntwk):
     """
-    These return node-based measures
+    Returns the nodes of the network and the matrix of the number of edges
+    on the shortest path between each pair of them (inf if not connected)
     """
-    iflogger.info('Computing node measures:')
-    measures = {}
-    iflogger.info('...Computing degree...')
-    measures['degree'] = np.array(ntwk.degree().values())
-    iflogger.info('...Computing load centrality...')
-    measures['load_centrality'] = np.array(nx.load_centrality(ntwk).values())
-    iflogger.info('...Computing betweenness centrality...')
-    measures['betweenness_centrality'] = np.array(nx.betweenness_centrality(ntwk).values())
-    iflogger.info('...Computing degree centrality...')
-    measures['degree_centrality'] = np.array(nx.degree_centrality(ntwk).values())
-    iflogger.info('...Computing closeness centrality...')
-    measures['closeness_centrality'] = np.array(nx.closeness_centrality(ntwk).values())
-#    iflogger.info('...Computing eigenvector centrality...')
-#    measures['eigenvector_centrality'] = np.array(nx.eigenvector_centrality(ntwk, max_iter=100000).values())
-    iflogger.info('...Computing triangles...')
-    measures['triangles'] = np.array(nx.triangles(ntwk).values())
-    iflogger.info('...Computing clustering...')
-    measures['clustering'] = np.array(nx.clustering(ntwk).values())
-    iflogger.info('...Computing k-core number')
-    measures['core_number'] = np.array(nx.core_number(ntwk).values())
-    iflogger.info('...Identifying network isolates...')
-    isolate_list = nx.isolates(ntwk)
+    nodes = ntwk.nodes()
+    try:
+        from scipy.sparse import csgraph
+    except ImportError: # scipy < 0.11
+        return nodes, _networkx_path_lengths(ntwk, nodes)
+    adjacency = nx.to_scipy_sparse_matrix(ntwk, nodelist=nodes, weight=None)
+    return nodes, csgraph.shortest_path(adjacency, directed=False,
+                                        unweighted=True)
+
+
+def _networkx_path_lengths(ntwk, nodes):
+    node_index = dict([(node, idx) for idx, node in enumerate(nodes)])
+    lengths = np.empty((len(nodes), len(nodes)))
+    lengths.fill(np.inf)
+    for source, targets in nx.all_pairs_shortest_path_length(ntwk).iteritems():
+        for target, length in targets.iteritems():
+            lengths[node_index[source], node_index[target]] = length
+    return lengths
+
+
+def _closeness_centrality(ntwk, path_lengths):
+    nodes, lengths = path_lengths
+    reachable = np.isfinite(lengths)
+    n_reached = reachable.sum(axis=1) - 1.0
+    total = np.where(reachable, lengths, 0).sum(axis=1)
+    closeness = np.zeros(len(nodes))
+    if len(nodes) > 1:
+        valid = total > 0
+        closeness[valid] = (n_reached[valid] ** 2 / total[valid] /
+                            (len(nodes) - 1))
+    return dict(zip(nodes, closeness))
+
+
+def _average_shortest_path_length(ntwk, path_lengths):
+    """Average over the pairs of nodes of the largest connected component"""
+    nodes, lengths = path_lengths
+    if len(nodes) < 2:
+        return 0.0
+    reachable = np.isfinite(lengths)
+    component = np.flatnonzero(reachable[np.argmax(reachable.sum(axis=1))])
+    if len(component) < 2:
+        return 0.0
+    return (lengths[np.ix_(component, component)].sum() /
+            (len(component) * (len(component) - 1)))
+
+
+def _isolates(ntwk):
     binarized = np.zeros((ntwk.number_of_nodes(), 1))
-    for value in isolate_list:
+    for value in nx.isolates(ntwk):
         value = value - 1 # Zero indexing
         binarized[value] = 1
-    measures['isolates'] = binarized
+    return binarized
+
+
+def compute_measure(name, ntwk, path_lengths=None, betweenness_k=None):
+    """
+    Computes a single network measure
+
+    path_lengths, as returned by shortest_path_lengths, is used for the
+    closeness centrality and the average shortest path length. When
+    betweenness_k is given, the betweenness centrality is estimated from
+    that many randomly sampled nodes.
+    """
+    if name in path_length_metrics and path_lengths is None:
+        path_lengths = shortest_path_lengths(ntwk)
+    if name == 'isolates':
+        return _isolates(ntwk)
+    if name == 'betweenness_centrality':
+        if betweenness_k is None:
+            return np.array(nx.betweenness_centrality(ntwk).values())
+        return np.array(nx.betweenness_centrality(ntwk, k=betweenness_k).values())
+    if name == 'closeness_centrality':
+        return np.array(_closeness_centrality(ntwk, path_lengths).values())
+    if name in node_metrics + node_clique_metrics:
+        return np.array(getattr(nx, name)(ntwk).values())
+    if name == 'average_shortest_path_length':
+        return _average_shortest_path_length(ntwk, path_lengths)
+    if name == 'degree_pearsonr':
+        try:
+            return nx.degree_pearsonr(ntwk)
+        except AttributeError: # For NetworkX 1.6
+            return nx.degree_pearson_correlation_coefficient(ntwk)
+    if name == 'degree_assortativity':
+        try:
+            return nx.degree_assortativity(ntwk)
+        except AttributeError:
+            return nx.degree_assortativity_coefficient(ntwk)
+    if name == 'graph_density':
+        return nx.density(ntwk)
+    if name == 'rich_club_coef':
+        return nx.rich_club_coefficient(ntwk)
+    return getattr(nx, name)(ntwk)
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _timed_measure(name, *args):
+    iflogger.info('...Computing {m}...'.format(m=name))
+    start = time()
+    value = compute_measure(name, *args)
+    return name, value, time() - start
+
+
+def _timed_worker_measure(name):
+    return _timed_measure(name, *_worker_args)
+
+
+def compute_measures(ntwk, metrics, n_procs=1, betweenness_k=None):
+    """
+    Computes the given measures, in n_procs processes if n_procs > 1
+
+    Returns a dictionary of measures and a dictionary of the time in seconds
+    spent on each of them. The shortest path lengths are computed once for
+    all the measures that need them.
+    """
+    measures = {}
+    timings = {}
+    path_lengths = None
+    if set(metrics) & set(path_length_metrics):
+        iflogger.info('...Computing shortest path lengths...')
+        start = time()
+        path_lengths = shortest_path_lengths(ntwk)
+        timings['shortest_path_lengths'] = time() - start
+    args = (ntwk, path_lengths, betweenness_k)
+    n_procs = min(n_procs, len(metrics))
+    if n_procs > 1 and current_process().daemon:
+        iflogger.info('Cannot start processes from a daemonic process, computing measures serially')
+        n_procs = 1
+    if n_procs > 1:
+        pool = Pool(n_procs, initializer=_init_worker, initargs=args)
+        try:
+            results = pool.map(_timed_worker_measure, metrics, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_timed_measure(name, *args) for name in metrics]
+    for name, value, elapsed in results:
+        measures[name] = value
+        timings[name] = elapsed
+    return measures, timings
+
+
+def compute_node_measures(ntwk, calculate_cliques=False):
+    """
+    These return node-based measures
+    """
+    iflogger.info('Computing node measures:')
+    metrics = list(node_metrics)
     if calculate_cliques:
-        iflogger.info('...Calculating node clique number')
-        measures['node_clique_number'] = np.array(nx.node_clique_number(ntwk).values())
-        iflogger.info('...Computing number of cliques for each node...')
-        measures['number_of_cliques'] = np.array(nx.number_of_cliques(ntwk).values())
-    return measures
+        metrics += node_clique_metrics
+    return compute_measures(ntwk, metrics)[0]
 
 
 def compute_edge_measures(ntwk):
@@ -249,50 +431,21 @@ def compute_dict_measures(ntwk):
     Returns a dictionary
     """
     iflogger.info('Computing measures which return a dictionary:')
-    measures = {}
-    iflogger.info('...Computing rich club coefficient...')
-    measures['rich_club_coef'] = nx.rich_club_coefficient(ntwk)
-    return measures
+    return compute_measures(ntwk, dict_metrics)[0]
 
 
 def compute_singlevalued_measures(ntwk, weighted=True, calculate_cliques=False):
     """
     Returns a single value per network
+
+    The shortest path lengths count the edges on the path whether or not
+    weighted is set.
     """
     iflogger.info('Computing single valued measures:')
-    measures = {}
-    iflogger.info('...Computing degree assortativity (pearson number) ...')
-    try:
-        measures['degree_pearsonr'] = nx.degree_pearsonr(ntwk)
-    except AttributeError: # For NetworkX 1.6
-        measures['degree_pearsonr'] = nx.degree_pearson_correlation_coefficient(ntwk)
-    iflogger.info('...Computing degree assortativity...')
-    try:
-        measures['degree_assortativity'] = nx.degree_assortativity(ntwk)
-    except AttributeError:
-        measures['degree_assortativity'] = nx.degree_assortativity_coefficient(ntwk)
-    iflogger.info('...Computing transitivity...')
-    measures['transitivity'] = nx.transitivity(ntwk)
-    iflogger.info('...Computing number of connected_components...')
-    measures['number_connected_components'] = nx.number_connected_components(ntwk)
-    iflogger.info('...Computing graph density...')
-    measures['graph_density'] = nx.density(ntwk)
-    iflogger.info('...Recording number of edges...')
-    measures['number_of_edges'] = nx.number_of_edges(ntwk)
-    iflogger.info('...Recording number of nodes...')
-    measures['number_of_nodes'] = nx.number_of_nodes(ntwk)
-    iflogger.info('...Computing average clustering...')
-    measures['average_clustering'] = nx.average_clustering(ntwk)
-    if nx.is_connected(ntwk):
-        iflogger.info('...Calculating average shortest path length...')
-        measures['average_shortest_path_length'] = nx.average_shortest_path_length(ntwk, weighted)
-    else:
-        iflogger.info('...Calculating average shortest path length...')
-        measures['average_shortest_path_length'] = nx.average_shortest_path_length(nx.connected_component_subgraphs(ntwk)[0], weighted)
+    metrics = list(global_metrics)
     if calculate_cliques:
-        iflogger.info('...Computing graph clique number...')
-        measures['graph_clique_number'] = nx.graph_clique_number(ntwk) #out of memory error
-    return measures
+        metrics += global_clique_metrics
+    return compute_measures(ntwk, metrics)[0]
 
 
 def compute_network_measures(ntwk):
@@ -344,6 +497,9 @@ class NetworkXMetricsInputSpec(BaseInterfaceInputSpec):
     out_node_metrics_matlab = File(genfile=True, desc='Output node metrics in MATLAB .mat format')
     out_edge_metrics_matlab = File(genfile=True, desc='Output edge metrics in MATLAB .mat format')
     out_pickled_extra_measures = File('extra_measures', usedefault=True, desc='Network measures for group 1 that return dictionaries stored as a Pickle.')
+    metrics = traits.List(traits.Enum(*all_metrics), desc='Measures to compute (default: all, clique-related ones only if compute_clique_related_measures is set)')
+    n_procs = traits.Int(1, usedefault=True, nohash=True, desc='Number of measures computed concurrently in separate processes')
+    betweenness_k = traits.Int(desc='Estimate the betweenness centrality from this number of randomly sampled nodes instead of all of them')
 
 class NetworkXMetricsOutputSpec(TraitedSpec):
     gpickled_network_files = OutputMultiPath(File(desc='Output gpickled network files'))
@@ -359,24 +515,33 @@ class NetworkXMetricsOutputSpec(TraitedSpec):
     k_crust = File(desc='Computed k-crust network stored as a NetworkX pickle.')
     pickled_extra_measures = File(desc='Network measures for the group that return dictionaries, stored as a Pickle.')
     matlab_dict_measures = OutputMultiPath(File(desc='Network measures for the group that return dictionaries, stored as matlab matrices.'))
+    metric_timings = traits.Dict(traits.Str, traits.Float, desc='Time in seconds spent computing each measure')
 
 class NetworkXMetrics(BaseInterface):
     """
     Calculates and outputs NetworkX-based measures for an input network
 
+    The measures to compute can be selected with `metrics`. With `n_procs`
+    greater than one they are computed in a pool of processes, and
+    `betweenness_k` samples nodes to estimate the betweenness centrality.
+    The shortest path lengths are computed once for the closeness centrality
+    and the average shortest path length.
+
     Example
     -------
 
     >>> import nipype.interfaces.cmtk as cmtk
     >>> nxmetrics = cmtk.NetworkXMetrics()
     >>> nxmetrics.inputs.in_file = 'subj1.pck'
+    >>> nxmetrics.inputs.metrics = ['degree', 'betweenness_centrality']
+    >>> nxmetrics.inputs.n_procs = 2
     >>> nxmetrics.run()                 # doctest: +SKIP
     """
     input_spec = NetworkXMetricsInputSpec
     output_spec = NetworkXMetricsOutputSpec
 
     def _run_interface(self, runtime):
-        global gpickled, nodentwks, edgentwks, kntwks, matlab
+        global gpickled, nodentwks, edgentwks, kntwks, matlab, timings
         gpickled = list()
         nodentwks = list()
         edgentwks = list()
@@ -388,10 +553,24 @@ class NetworkXMetrics(BaseInterface):
         # The names are then added to the output .pck file list
         # In the case of the degeneracy networks, they are given specified output names
 
-        calculate_cliques = self.inputs.compute_clique_related_measures
-        weighted = self.inputs.treat_as_weighted_graph
-
-        global_measures = compute_singlevalued_measures(ntwk, weighted, calculate_cliques)
+        if isdefined(self.inputs.metrics):
+            metrics = self.inputs.metrics
+        else:
+            metrics = node_metrics + global_metrics + dict_metrics
+            if self.inputs.compute_clique_related_measures:
+                metrics = metrics + node_clique_metrics + global_clique_metrics
+        betweenness_k = None
+        if isdefined(self.inputs.betweenness_k):
+            betweenness_k = self.inputs.betweenness_k
+        measures, timings = compute_measures(ntwk, metrics, self.inputs.n_procs,
+                                             betweenness_k)
+        for name in sorted(timings.keys()):
+            iflogger.info('{m} computed in {t:.3f} s'.format(m=name, t=timings[name]))
+
+        def select(names):
+            return dict([(name, measures[name]) for name in names if name in measures])
+
+        global_measures = select(global_metrics + global_clique_metrics)
         if isdefined(self.inputs.out_global_metrics_matlab):
             global_out_file = op.abspath(self.inputs.out_global_metrics_matlab)
         else:
@@ -399,7 +578,7 @@ class NetworkXMetrics(BaseInterface):
         sio.savemat(global_out_file, global_measures, oned_as='column')
         matlab.append(global_out_file)
 
-        node_measures = compute_node_measures(ntwk, calculate_cliques)
+        node_measures = select(node_metrics + node_clique_metrics)
         for key in node_measures.keys():
             newntwk = add_node_data(node_measures[key], ntwk)
             out_file = op.abspath(self._gen_outfilename(key, 'pck'))
@@ -440,7 +619,7 @@ class NetworkXMetrics(BaseInterface):
         gpickled.extend(kntwks)
 
         out_pickled_extra_measures = op.abspath(self._gen_outfilename(self.inputs.out_pickled_extra_measures, 'pck'))
-        dict_measures = compute_dict_measures(ntwk)
+        dict_measures = select(dict_metrics)
         iflogger.info('Saving extra measure file to {path} in Pickle format'.format(path=op.abspath(out_pickled_extra_measures)))
         file = open(out_pickled_extra_measures, 'w')
         pickle.dump(dict_measures, file)
@@ -485,6 +664,7 @@ class NetworkXMetrics(BaseInterface):
         outputs["edge_measures_matlab"] = op.abspath(self._gen_outfilename('edgemetrics', 'mat'))
         outputs["matlab_matrix_files"] = [outputs["global_measures_matlab"], outputs["node_measures_matlab"], outputs["edge_measures_matlab"]]
         outputs["pickled_extra_measures"] = op.abspath(self._gen_outfilename(self.inputs.out_pickled_extra_measures, 'pck'))
+        outputs["metric_timings"] = timings
         return outputs
 
     def _gen_outfilename(self, name, ext):
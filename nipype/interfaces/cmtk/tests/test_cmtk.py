@@ -0,0 +1,144 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+
+from nipype.testing import (assert_equal, assert_true, assert_almost_equal,
+                            skipif)
+
+try:
+    import networkx as nx
+except ImportError:
+    have_networkx = False
+else:
+    have_networkx = True
+    from nipype.interfaces.cmtk import cmtk
+
+
+def make_cmat_data(tempdir, n_fibers=400):
+    np.random.seed(1)
+    roi = np.zeros((20, 20, 20), dtype=np.int16)
+    for label in range(1, 7):
+        x, y = (label - 1) % 3, (label - 1) // 3
+        roi[2 + 6 * x:7 + 6 * x, 3 + 8 * y:10 + 8 * y, 4:17] = label
+    nb.save(nb.Nifti1Image(roi, np.diag([2., 2., 2., 1.])),
+            os.path.join(tempdir, 'roi.nii'))
+    network = nx.Graph()
+    for label in range(1, 7):
+        network.add_node(label, dn_position=(label, label, label))
+    network.add_edge(1, 2)
+    nx.write_gpickle(network, os.path.join(tempdir, 'network.pck'))
+    streamlines = []
+    for i in range(n_fibers):
+        points = np.random.uniform(0, 40, 3) + \
+            np.cumsum(np.random.randn(np.random.randint(1, 40), 3), axis=0)
+        streamlines.append((np.clip(points, 0, 39.9).astype(np.float32),
+                            None, None))
+    header = nb.trackvis.empty_header()
+    header['voxel_size'] = (2, 2, 2)
+    header['dim'] = (20, 20, 20)
+    nb.trackvis.write(os.path.join(tempdir, 'fibers.trk'), streamlines,
+                      header)
+    return roi, streamlines
+
+
+@skipif(not have_networkx)
+def test_cmat():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    roi, streamlines = make_cmat_data(tempdir)
+    cmtk.cmat('fibers.trk', 'roi.nii', 'network.pck', 'matrix.pck',
+              'matrix.mat', os.path.abspath('fibers'), True)
+
+    # fiber by fiber reference
+    labels = []
+    crossed = []
+    for points, _, _ in streamlines:
+        idx = (points.astype(np.float64) / 2.).astype(int)
+        labels.append(sorted([roi[tuple(idx[0])], roi[tuple(idx[-1])]]))
+        crossed.append(set(roi[tuple(idx.T)].tolist()) - set([0]))
+    labels = np.array(labels)
+    valid = np.all(labels > 0, axis=1)
+    yield (assert_equal, np.load('fibers_final_fiberslabels.npy'),
+           labels[valid])
+    lengths = np.array([cmtk.length(points) for points, _, _ in streamlines])
+    number_of_fibers = np.zeros((6, 6))
+    mean_length = np.zeros((6, 6))
+    for i in range(1, 7):
+        for j in range(i + 1, 7):
+            fibers = valid & (labels[:, 0] == i) & (labels[:, 1] == j)
+            number_of_fibers[i - 1, j - 1] = fibers.sum()
+            if fibers.any():
+                mean_length[i - 1, j - 1] = lengths[fibers].mean()
+    matrix = cmtk.sio.loadmat('matrix.mat')['number_of_fibers']
+    yield assert_equal, np.triu(matrix), number_of_fibers
+    matrix = cmtk.sio.loadmat('matrix_mean_fiber_length.mat')['mean_fiber_length']
+    yield assert_almost_equal, np.triu(matrix), mean_length, 4
+    network = nx.read_gpickle('matrix.pck')
+    yield assert_equal, network.edge[1][2]['number_of_fibers'], \
+        number_of_fibers[0, 1]
+    yield assert_true, 'number_of_fibers' in network.edge[1][2]
+
+    intersections = np.zeros((6, 6), dtype=np.uint)
+    for rois in crossed:
+        for i in rois:
+            for j in rois:
+                if i != j:
+                    intersections[i - 1, j - 1] += 1
+    matrix = cmtk.sio.loadmat('matrix_intersections.mat')['intersections']
+    yield assert_equal, matrix, intersections
+    stats = cmtk.sio.loadmat('fibers_statistics.mat')
+    yield assert_equal, stats['endpoint_n_fib'][0, 0], valid.sum()
+    yield assert_equal, stats['intersections_n_fib'][0, 0], \
+        len([rois for rois in crossed if rois])
+    filtered, hdr = nb.trackvis.read('fibers_streamline_final.trk')
+    yield assert_equal, hdr['n_count'], valid.sum()
+    yield (assert_equal, filtered[-1][0],
+           streamlines[np.flatnonzero(valid)[-1]][0])
+
+    # reading the tracts in batches gives the same results
+    cmtk.cmat('fibers.trk', 'roi.nii', 'network.pck', 'batched.pck',
+              'batched.mat', os.path.abspath('batched'), True, batch_size=37)
+    for name in ['matrix.mat', 'matrix_intersections.mat',
+                 'matrix_mean_fiber_length.mat']:
+        expected = cmtk.sio.loadmat(name)
+        result = cmtk.sio.loadmat(name.replace('matrix', 'batched'))
+        for key in expected:
+            if not key.startswith('__'):
+                yield assert_equal, result[key], expected[key]
+    yield (assert_equal, np.load('batched_final_fiberslabels.npy'),
+           labels[valid])
+    yield (assert_equal, open('batched_streamline_final.trk', 'rb').read(),
+           open('fibers_streamline_final.trk', 'rb').read())
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+@skipif(not have_networkx)
+def test_streamline_arrays():
+    streamlines = [(np.array([[0., 0, 0], [3, 4, 0], [3, 4, 12]]), None, None),
+                   (np.array([[1., 1, 1]]), None, None),
+                   (np.array([[-1., 2.5, 5], [1, 2.5, 5]]), None, None)]
+    points, offsets = cmtk.concatenate_streamlines(streamlines)
+    yield assert_equal, offsets, [0, 3, 4, 6]
+    yield (assert_almost_equal, cmtk.streamline_lengths(points, offsets),
+           [cmtk.length(s[0]) for s in streamlines])
+    endpoints, endpointsmm = cmtk.create_endpoints_array(streamlines,
+                                                         (2., 2., 2.))
+    yield assert_equal, endpoints[2], [[0, 1, 2], [0, 1, 2]]
+    yield assert_equal, endpointsmm[0, 1], [3, 4, 12]
+    groups, counts, means, medians, stds = cmtk.group_statistics(
+        np.array([2, 0, 2, 2, 0]), np.array([1., 5, 2, 6, 4]))
+    yield assert_equal, groups, [0, 2]
+    yield assert_equal, counts, [2, 3]
+    yield assert_almost_equal, means, [4.5, 3]
+    yield assert_almost_equal, medians, [4.5, 2]
+    yield assert_almost_equal, stds, [0.5, np.std([1, 2, 6])]
+    yield (assert_equal,
+           cmtk.get_connectivity_matrix(3, [[1, 2], [3, 2, 1], [3]]),
+           [[0, 2, 1], [2, 0, 1], [1, 1, 0]])
@@ -0,0 +1,149 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import scipy.io as sio
+
+from nipype.testing import assert_equal, assert_almost_equal, skipif
+
+try:
+    import networkx as nx
+except ImportError:
+    have_networkx = False
+else:
+    have_networkx = True
+    from nipype.interfaces.cmtk import nx as cmtk_nx
+
+
+def make_networks(tempdir, n_subjects=5, n_nodes=12):
+    np.random.seed(0)
+    resolution = nx.Graph()
+    for node in range(1, n_nodes + 1):
+        resolution.add_node(node, dn_name='region%d' % node,
+                            dn_position=(node, 0, 0))
+    res_file = os.path.join(tempdir, 'resolution.pck')
+    nx.write_gpickle(resolution, res_file)
+    in_files = []
+    networks = []
+    for subject in range(n_subjects):
+        ntwk = nx.Graph()
+        for node in range(1, n_nodes + 1):
+            ntwk.add_node(node, value=np.random.uniform())
+        for u in range(1, n_nodes + 1):
+            for v in range(u + 1, n_nodes + 1):
+                if np.random.uniform() < 0.4:
+                    ntwk.add_edge(v, u, number_of_fibers=np.random.randint(1, 50),
+                                  fiber_length_mean=np.random.uniform(10, 90),
+                                  label='edge')
+        networks.append(ntwk)
+        in_files.append(os.path.join(tempdir, 'subj%d.pck' % subject))
+        nx.write_gpickle(ntwk, in_files[-1])
+    return res_file, in_files, networks
+
+
+@skipif(not have_networkx)
+def test_average_networks():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    res_file, in_files, networks = make_networks(tempdir)
+    cmtk_nx.average_networks(in_files, res_file, 'group')
+    avg_ntwk = nx.read_gpickle('group_average.pck')
+
+    # edge by edge reference
+    n_nodes = 12
+    keep = np.round(len(networks) / 2.)
+    expected = {}
+    for key in ['count', 'number_of_fibers', 'fiber_length_mean']:
+        expected[key] = np.zeros((n_nodes, n_nodes))
+    for ntwk in networks:
+        for u, v, data in ntwk.edges_iter(data=True):
+            u, v = min(u, v), max(u, v)
+            expected['count'][u - 1, v - 1] += 1
+            for key in ['number_of_fibers', 'fiber_length_mean']:
+                expected[key][u - 1, v - 1] += data[key]
+    for key in ['number_of_fibers', 'fiber_length_mean']:
+        expected[key][expected['count'] < keep] = 0
+        expected[key] /= len(networks)
+    for key in expected:
+        matrix = sio.loadmat('group_%s_average.mat' % key)[key]
+        yield assert_almost_equal, matrix, expected[key]
+    yield (assert_equal, avg_ntwk.number_of_edges(),
+           np.sum(expected['count'] >= keep))
+    for u, v, data in avg_ntwk.edges_iter(data=True):
+        u, v = min(u, v), max(u, v)
+        yield assert_equal, data['count'], expected['count'][u - 1, v - 1]
+        yield (assert_almost_equal, data['fiber_length_mean'],
+               expected['fiber_length_mean'][u - 1, v - 1])
+        yield assert_equal, 'label' in data, False
+    for node in range(1, n_nodes + 1):
+        yield assert_equal, avg_ntwk.node[node]['dn_name'], 'region%d' % node
+        yield (assert_almost_equal, avg_ntwk.node[node]['value'],
+               np.mean([ntwk.node[node]['value'] for ntwk in networks]))
+    yield assert_equal, os.path.exists('group_average.gexf'), True
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+@skipif(not have_networkx)
+def test_network_measures():
+    ntwk = nx.gnm_random_graph(30, 45, seed=2)
+    ntwk = nx.relabel_nodes(ntwk, dict([(i, i + 1) for i in range(30)]))
+    ntwk.add_edge(31, 32)
+    components = sorted(nx.connected_component_subgraphs(ntwk), key=len)
+    path_lengths = cmtk_nx.shortest_path_lengths(ntwk)
+    # networkx fallback for scipy < 0.11
+    yield (assert_equal, cmtk_nx._networkx_path_lengths(ntwk, path_lengths[0]),
+           path_lengths[1])
+    closeness = cmtk_nx.compute_measure('closeness_centrality', ntwk,
+                                        path_lengths)
+    yield (assert_almost_equal, closeness,
+           np.array(nx.closeness_centrality(ntwk).values()))
+    yield (assert_almost_equal,
+           cmtk_nx.compute_measure('average_shortest_path_length', ntwk,
+                                   path_lengths),
+           nx.average_shortest_path_length(components[-1]))
+    yield (assert_almost_equal,
+           cmtk_nx.compute_measure('betweenness_centrality', ntwk,
+                                   betweenness_k=ntwk.number_of_nodes()),
+           np.array(nx.betweenness_centrality(ntwk).values()))
+    serial, _ = cmtk_nx.compute_measures(ntwk, ['degree', 'isolates'])
+    parallel, timings = cmtk_nx.compute_measures(
+        ntwk, ['degree', 'isolates', 'closeness_centrality'], n_procs=2)
+    yield assert_equal, parallel['degree'], serial['degree']
+    yield assert_equal, parallel['closeness_centrality'], closeness
+    yield (assert_equal, sorted(timings.keys()),
+           ['closeness_centrality', 'degree', 'isolates',
+            'shortest_path_lengths'])
+
+
+@skipif(not have_networkx)
+def test_networkx_metrics():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    ntwk = nx.gnm_random_graph(20, 40, seed=3)
+    ntwk = nx.relabel_nodes(ntwk, dict([(i, i + 1) for i in range(20)]))
+    nx.write_gpickle(ntwk, 'network.pck')
+    metrics = cmtk_nx.NetworkXMetrics(in_file='network.pck', n_procs=2,
+                                      metrics=['degree', 'transitivity',
+                                               'average_shortest_path_length'])
+    outputs = metrics.run().outputs
+    node_measures = sio.loadmat(outputs.node_measures_matlab)
+    yield (assert_equal, node_measures['degree'].ravel(),
+           np.array(nx.degree(ntwk).values()))
+    yield assert_equal, 'clustering' in node_measures, False
+    global_measures = sio.loadmat(outputs.global_measures_matlab)
+    yield (assert_almost_equal,
+           global_measures['average_shortest_path_length'][0, 0],
+           nx.average_shortest_path_length(ntwk))
+    yield (assert_equal, sorted(outputs.metric_timings.keys()),
+           ['average_shortest_path_length', 'degree',
+            'shortest_path_lengths', 'transitivity'])
+    yield (assert_equal, outputs.node_measure_networks,
+           os.path.join(tempdir, 'degree.pck'))
+    os.chdir(cwd)
+    rmtree(tempdir)
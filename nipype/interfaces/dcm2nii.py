@@ -32,6 +32,7 @@ class Dcm2nii(CommandLine):
     output_spec=Dcm2niiOutputSpec
 
     _cmd = 'dcm2nii'
+    _terminal_output = 'allatonce'
 
     def _format_arg(self, opt, spec, val):
         if opt in ['gzip_output', 'nii_output', 'anonymize', 'id_in_filename', 'reorient', 'reorient_and_crop', 'convert_all_pars']:
@@ -4,6 +4,8 @@ from nipype.interfaces.base import (TraitedSpec, BaseInterface, BaseInterfaceInp
 from nipype.utils.filemanip import split_filename
 import os.path as op
 import nibabel as nb, nibabel.trackvis as trk
+import numpy as np
+from itertools import islice
 from nipype.utils.misc import package_check
 import warnings
 
@@ -25,6 +27,8 @@ class TrackDensityMapInputSpec(TraitedSpec):
     data_dims = traits.List(traits.Int, minlen=3, maxlen=3,
     desc='The size of the image in voxels.')
     out_filename = File('tdi.nii', usedefault=True, desc='The output filename for the tracks in TrackVis (.trk) format')
+    batch_size = traits.Int(100000, usedefault=True,
+    desc='The number of tracks read from the track file at once')
 
 class TrackDensityMapOutputSpec(TraitedSpec):
     out_file = File(exists=True)
@@ -33,6 +37,9 @@ class TrackDensityMap(BaseInterface):
 	"""
 	Creates a tract density image from a TrackVis track file using functions from dipy
 
+	The tracks are streamed from the file and the density map is accumulated
+	over batches of batch_size tracks.
+
 	Example
 	-------
 
@@ -45,7 +52,7 @@ class TrackDensityMap(BaseInterface):
 	output_spec = TrackDensityMapOutputSpec
 
 	def _run_interface(self, runtime):
-		tracks, header = trk.read(self.inputs.in_file)
+		tracks, header = trk.read(self.inputs.in_file, as_generator=True)
 		if not isdefined(self.inputs.data_dims):
 			data_dims = header['dim']
 		else:
@@ -58,8 +65,12 @@ class TrackDensityMap(BaseInterface):
 
 		affine = header['vox_to_ras']
 
-		streams = ((ii[0]) for ii in tracks)
-		data = density_map(streams, data_dims, voxel_size)
+		data = np.zeros(data_dims, dtype=int)
+		while True:
+			streams = [ii[0] for ii in islice(tracks, self.inputs.batch_size)]
+			if not streams:
+				break
+			data += density_map(streams, data_dims, voxel_size)
 		if data.max() < 2**15:
 		   data = data.astype('int16')
 
@@ -18,6 +18,7 @@ __docformat__ = 'restructuredtext'
 import os
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.toolcache import cached_probe
 from nipype.interfaces.base import (CommandLine, Directory,
                                     CommandLineInputSpec, isdefined)
 
@@ -52,6 +53,11 @@ class Info(object):
         fs_home = os.getenv('FREESURFER_HOME')
         if fs_home is None:
             return None
+        return cached_probe('freesurfer.version', Info._read_version,
+                            args=(fs_home,))
+
+    @staticmethod
+    def _read_version(fs_home):
         versionfile = os.path.join(fs_home, 'build-stamp.txt')
         if not os.path.exists(versionfile):
             return None
@@ -528,6 +528,7 @@ class SurfaceSnapshots(FSCommand):
 
     """
     _cmd = "tksurfer"
+    _terminal_output = 'allatonce'
     input_spec = SurfaceSnapshotsInputSpec
     output_spec = SurfaceSnapshotsOutputSpec
 
@@ -659,6 +660,7 @@ class ImageInfoOutputSpec(TraitedSpec):
 class ImageInfo(FSCommand):
 
     _cmd = "mri_info"
+    _terminal_output = 'allatonce'
     input_spec = ImageInfoInputSpec
     output_spec = ImageInfoOutputSpec
 
@@ -952,6 +954,7 @@ class SmoothTessellation(FSCommand):
     >>> smooth.run() # doctest: +SKIP
     """
     _cmd = 'mris_smooth'
+    _terminal_output = 'allatonce'
     input_spec = SmoothTessellationInputSpec
     output_spec = SmoothTessellationOutputSpec
 
@@ -30,6 +30,7 @@ import os
 import warnings
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.toolcache import cached_probe
 from nipype.interfaces.base import (CommandLine, traits, CommandLineInputSpec,
                                     isdefined)
 
@@ -72,10 +73,18 @@ class Info(object):
             basedir = os.environ['FSLDIR']
         except KeyError:
             return None
-        clout = CommandLine(command='cat',
-                            args='%s/etc/fslversion' % (basedir)).run()
-        out = clout.runtime.stdout
-        return out.strip('\n')
+        return cached_probe('fsl.version', Info._read_version,
+                            args=(basedir,))
+
+    @staticmethod
+    def _read_version(basedir):
+        versionfile = os.path.join(basedir, 'etc', 'fslversion')
+        if not os.path.exists(versionfile):
+            return None
+        fid = open(versionfile, 'rt')
+        version = fid.read()
+        fid.close()
+        return version.strip('\n')
 
     @classmethod
     def output_type_to_ext(cls, output_type):
@@ -123,6 +123,7 @@ class EddyCorrect(FSLCommand):
 
     """
     _cmd = 'eddy_correct'
+    _terminal_output = 'stream'
     input_spec = EddyCorrectInputSpec
     output_spec = EddyCorrectOutputSpec
 
@@ -212,6 +213,7 @@ class BEDPOSTX(FSLCommand):
     """
 
     _cmd = 'bedpostx'
+    _terminal_output = 'stream'
     input_spec = BEDPOSTXInputSpec
     output_spec = BEDPOSTXOutputSpec
     _can_resume = True
@@ -393,6 +395,7 @@ class ProbTrackX(FSLCommand):
     """
 
     _cmd = 'probtrackx'
+    _terminal_output = 'stream'
     input_spec = ProbTrackXInputSpec
     output_spec = ProbTrackXOutputSpec
 
@@ -876,6 +879,7 @@ class XFibres(FSLCommand):
     """Perform model parameters estimation for local (voxelwise) diffusion parameters
     """
     _cmd = "xfibres"
+    _terminal_output = 'stream'
     input_spec = XFibresInputSpec
     output_spec = XFibresOutputSpec
 
@@ -778,6 +778,7 @@ class ContrastMgr(FSLCommand):
     """
 
     _cmd = 'contrast_mgr'
+    _terminal_output = 'stream'
     input_spec = ContrastMgrInputSpec
     output_spec = ContrastMgrOutputSpec
 
@@ -1267,6 +1268,7 @@ class SmoothEstimate(FSLCommand):
     input_spec = SmoothEstimateInputSpec
     output_spec = SmoothEstimateOutputSpec
     _cmd = 'smoothest'
+    _terminal_output = 'allatonce'
 
     def aggregate_outputs(self, runtime=None, needed_outputs=None):
         outputs = self._outputs()
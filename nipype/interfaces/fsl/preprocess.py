@@ -131,6 +131,7 @@ class BET(FSLCommand):
     """
 
     _cmd = 'bet'
+    _terminal_output = 'stream'
     input_spec = BETInputSpec
     output_spec = BETOutputSpec
 
@@ -427,6 +427,7 @@ class ImageStats(FSLCommand):
     output_spec = ImageStatsOutputSpec
 
     _cmd = 'fslstats'
+    _terminal_output = 'allatonce'
 
     def _format_arg(self, name, trait_spec, value):
         if name == 'mask_file':
@@ -492,6 +493,7 @@ class AvScale(FSLCommand):
     output_spec = AvScaleOutputSpec
 
     _cmd = 'avscale'
+    _terminal_output = 'allatonce'
 
     def _format_arg(self, name, trait_spec, value):
         return super(AvScale, self)._format_arg(name, trait_spec, value)
@@ -17,7 +17,10 @@
     >>> os.chdir(datadir)
 
 """
+import atexit
+from fnmatch import fnmatch
 import glob
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import re
@@ -25,6 +28,7 @@ import tempfile
 from warnings import warn
 
 import sqlite3
+import threading
 
 try:
     import pyxnat
@@ -36,7 +40,9 @@ from nipype.interfaces.base import (TraitedSpec, traits, File, Directory,
                                     OutputMultiPath, DynamicTraitedSpec,
                                     Undefined, BaseInterfaceInputSpec)
 from nipype.utils.filemanip import (copyfile, list_to_filename,
-                                    filename_to_list)
+                                    filename_to_list, files_identical,
+                                    transfer_file, related_files, load_json,
+                                    save_json, loadpkl, savepkl)
 
 from .. import logging
 iflogger = logging.getLogger('interface')
@@ -95,6 +101,139 @@ def add_traits(base, names, trait_type=None):
     return base
 
 
+class DirectoryIndex(object):
+    """In-memory listing of a directory tree used to expand glob patterns
+
+    The tree below `root` is listed once, down to `depth` levels (all
+    levels if depth is None), and patterns are matched with the same rules
+    as glob.glob. Patterns outside the root or deeper than the index are
+    expanded with glob.glob.
+
+    The directories a pattern walks through are checked against their
+    modification time and listed again if they changed, so the index stays
+    current without accessing the rest of the tree.
+    """
+
+    def __init__(self, root, depth=None):
+        self.root = os.path.abspath(root)
+        self.depth = depth
+        self.listing = {}
+        self.mtimes = {}
+        self._scan('', 0, set())
+
+    def _scan(self, reldir, level, visited):
+        path = os.path.join(self.root, reldir)
+        realpath = os.path.realpath(path)
+        if realpath in visited:
+            return
+        visited.add(realpath)
+        self.mtimes[reldir] = os.stat(path).st_mtime
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        self.listing[reldir] = names
+        if self.depth is not None and level + 1 >= self.depth:
+            return
+        for name in names:
+            if os.path.isdir(os.path.join(path, name)):
+                self._scan(os.path.join(reldir, name), level + 1, visited)
+
+    def _names(self, reldir):
+        """Return the current names in an indexed directory
+        """
+        path = os.path.join(self.root, reldir)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            del self.listing[reldir]
+            del self.mtimes[reldir]
+            return []
+        if mtime != self.mtimes[reldir]:
+            iflogger.debug('Indexing %s' % path)
+            try:
+                names = os.listdir(path)
+            except OSError:
+                names = []
+            # forget the removed subdirectories
+            removed = [os.path.join(reldir, name)
+                       for name in set(self.listing[reldir]) - set(names)]
+            for subdir in (removed and self.listing.keys()):
+                for name in removed:
+                    if subdir == name or subdir.startswith(name + os.sep):
+                        del self.listing[subdir]
+                        del self.mtimes[subdir]
+                        break
+            self.listing[reldir] = names
+            self.mtimes[reldir] = mtime
+        return self.listing[reldir]
+
+    def glob(self, pattern):
+        """Return the paths matching `pattern` like glob.glob
+        """
+        relpattern = os.path.relpath(os.path.abspath(pattern), self.root)
+        parts = relpattern.split(os.sep)
+        if (relpattern == os.curdir or
+                parts[0] == os.pardir or pattern.endswith(os.sep) or
+                (self.depth is not None and len(parts) > self.depth)):
+            return glob.glob(pattern)
+        candidates = ['']
+        for part in parts:
+            matches = []
+            for reldir in candidates:
+                if reldir not in self.listing:
+                    # a file or a directory created after the scan
+                    if not os.path.isdir(os.path.join(self.root, reldir)):
+                        continue
+                    self._scan(reldir, len(reldir.split(os.sep)), set())
+                names = self._names(reldir)
+                if glob.has_magic(part):
+                    if part[0] != '.':
+                        names = [name for name in names if name[0] != '.']
+                    names = [name for name in names if fnmatch(name, part)]
+                elif part in names:
+                    names = [part]
+                else:
+                    names = []
+                matches.extend([os.path.join(reldir, name) for name in names])
+            candidates = matches
+        return [os.path.join(self.root, path) for path in candidates]
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def get_directory_index(root, depth=None, index_file=None):
+    """Return a DirectoryIndex of `root`
+
+    Indexes are reused within a process and, if `index_file` is given,
+    between processes. They are updated as patterns are matched (see
+    `DirectoryIndex`).
+    """
+    key = (os.path.abspath(root), depth)
+    with _index_lock:
+        index = _index_cache.get(key)
+        if index is None and index_file and os.path.exists(index_file):
+            try:
+                index = loadpkl(index_file)
+            except Exception, e:
+                iflogger.debug('Could not load index %s: %s' % (index_file, e))
+            if index is not None and (index.root, index.depth) != key:
+                index = None
+        if index is not None:
+            _index_cache[key] = index
+            return index
+        iflogger.debug('Indexing %s' % root)
+        index = DirectoryIndex(root, depth)
+        _index_cache[key] = index
+        if index_file:
+            tmp_file = '%s.%d' % (index_file, os.getpid())
+            savepkl(tmp_file, index)
+            os.rename(tmp_file, index_file)
+        return index
+
+
 class IOBase(BaseInterface):
 
     def _run_interface(self, runtime):
@@ -131,6 +270,16 @@ class DataSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     _outputs = traits.Dict(traits.Str, value={}, usedefault=True)
     remove_dest_dir = traits.Bool(False, usedefault=True,
                                   desc='remove dest directory when copying dirs')
+    copy_mode = traits.Enum('copy', 'hardlink', 'reflink', usedefault=True,
+                            desc=('how files are stored: copied, hard linked '
+                                  'or cloned (copy-on-write). Links and '
+                                  'clones fall back to a copy across '
+                                  'filesystems'))
+    n_threads = traits.Int(1, usedefault=True,
+                           desc='number of files copied concurrently')
+    use_manifest = traits.Bool(True, usedefault=True,
+                               desc=('record stored files in a manifest and '
+                                     'skip unchanged files on later runs'))
 
     def __setattr__(self, key, value):
         if key not in self.copyable_trait_names():
@@ -178,6 +327,16 @@ class DataSink(IOBase):
             This is not a thread-safe node because it can write to a common
             shared location. It will not complain when it overwrites a file.
 
+        Files are only stored if the destination differs from the source:
+        files of the same size and modification time are assumed identical
+        and others are compared by content. Stored files are recorded in a
+        manifest (``.datasink_manifest.json`` in the container directory) so
+        that later runs skip unchanged files without reading them. Set
+        `n_threads` to copy several files at once and `copy_mode` to
+        'hardlink' or 'reflink' to avoid copying data within a filesystem
+        (a hard linked file is shared with the working directory, so
+        changes to one affect the other).
+
         .. note::
 
             If both substitutions and regexp_substitutions are used, then
@@ -274,11 +433,89 @@ class DataSink(IOBase):
             iflogger.info('sub: %s -> %s' % (pathstr_, pathstr))
         return pathstr
 
+    def _manifest_file(self, outdir):
+        return os.path.join(outdir, '.datasink_manifest.json')
+
+    def _load_manifest(self, outdir):
+        manifest_file = self._manifest_file(outdir)
+        if self.inputs.use_manifest and os.path.exists(manifest_file):
+            try:
+                return load_json(manifest_file)
+            except ValueError:
+                iflogger.warn('Ignoring corrupt manifest %s' % manifest_file)
+        return {}
+
+    def _save_manifest(self, outdir, entries):
+        manifest_file = self._manifest_file(outdir)
+        # other sinks may share the container
+        manifest = self._load_manifest(outdir)
+        manifest.update(entries)
+        tmp_file = '%s.%d' % (manifest_file, os.getpid())
+        save_json(tmp_file, manifest)
+        os.rename(tmp_file, manifest_file)
+
+    def _sink_file(self, src, dst, related, manifest):
+        """Store a file (and its related files), returns manifest entries
+        """
+        entries = {}
+        pairs = [(src, dst)]
+        if related:
+            pairs.extend([(rel_src, os.path.splitext(dst)[0] +
+                           os.path.splitext(rel_src)[1])
+                          for rel_src in related_files(src)])
+        for src, dst in pairs:
+            src_stat = os.stat(src)
+            entry = [src, src_stat.st_size, src_stat.st_mtime]
+            if os.path.exists(dst):
+                dst_stat = os.stat(dst)
+                stored = manifest.get(dst)
+                if stored and stored == entry + [dst_stat.st_size,
+                                                 dst_stat.st_mtime]:
+                    iflogger.debug('unchanged: %s' % dst)
+                    entries[dst] = stored
+                    continue
+                if files_identical(src, dst):
+                    iflogger.debug('identical: %s %s' % (src, dst))
+                    entries[dst] = entry + [dst_stat.st_size,
+                                            dst_stat.st_mtime]
+                    continue
+            iflogger.debug('%s: %s %s' % (self.inputs.copy_mode, src, dst))
+            transfer_file(src, dst, mode=self.inputs.copy_mode)
+            dst_stat = os.stat(dst)
+            entries[dst] = entry + [dst_stat.st_size, dst_stat.st_mtime]
+        return entries
+
+    def _sink_files(self, jobs, manifest):
+        # a destination written twice keeps the last source, as when
+        # copying serially
+        jobs = dict([(dst, (src, dst, related))
+                     for src, dst, related in jobs]).values()
+
+        def sink(job):
+            src, dst, related = job
+            return self._sink_file(src, dst, related, manifest)
+
+        n_threads = min(self.inputs.n_threads, len(jobs))
+        if n_threads > 1:
+            pool = ThreadPool(n_threads)
+            try:
+                results = pool.map(sink, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(sink, jobs)
+        entries = {}
+        for result in results:
+            entries.update(result)
+        return entries
+
     def _list_outputs(self):
         """Execute this module.
         """
         outputs = self.output_spec().get()
         out_files = []
+        jobs = []
         outdir = self.inputs.base_directory
         if not isdefined(outdir):
             outdir = '.'
@@ -324,8 +561,7 @@ class DataSink(IOBase):
                                 pass
                             else:
                                 raise(inst)
-                    iflogger.debug("copyfile: %s %s" % (src, dst))
-                    copyfile(src, dst, copy=True, hashmethod='content')
+                    jobs.append((src, dst, True))
                     out_files.append(dst)
                 elif os.path.isdir(src):
                     dst = self._get_dst(os.path.join(src, ''))
@@ -344,8 +580,21 @@ class DataSink(IOBase):
                         iflogger.debug("removing: %s" % dst)
                         shutil.rmtree(dst)
                     iflogger.debug("copydir: %s %s" % (src, dst))
-                    copytree(src, dst)
+                    for dirpath, dirnames, filenames in os.walk(src):
+                        dstpath = os.path.join(dst, os.path.relpath(dirpath,
+                                                                    src))
+                        if not os.path.isdir(dstpath):
+                            os.makedirs(dstpath)
+                        jobs.extend([(os.path.join(dirpath, name),
+                                      os.path.normpath(os.path.join(dstpath,
+                                                                    name)),
+                                      False)
+                                     for name in filenames])
                     out_files.append(dst)
+        manifest = self._load_manifest(outdir)
+        entries = self._sink_files(jobs, manifest)
+        if self.inputs.use_manifest and entries:
+            self._save_manifest(outdir, entries)
         outputs['out_file'] = out_files
 
         return outputs
@@ -363,6 +612,15 @@ class DataGrabberInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):  # Inter
     template_args = traits.Dict(key_trait=traits.Str,
                                 value_trait=traits.List(traits.List),
                                 desc='Information to plug into template')
+    use_index = traits.Bool(False, usedefault=True,
+                            desc=('list base directory once and match all '
+                                  'templates against the listing'))
+    index_depth = traits.Int(desc=('number of directory levels listed by '
+                                   'the index (default: all)'),
+                             requires=['use_index'])
+    index_file = File(desc=('file storing the index so that other '
+                            'processes reuse it'),
+                      requires=['use_index'])
 
 
 class DataGrabber(IOBase):
@@ -415,6 +673,12 @@ class DataGrabber(IOBase):
         >>> dg.inputs.field_template = dict(struct='%s/struct.nii')
         >>> dg.inputs.template_args['struct'] = [['sid']]
 
+        List the base directory once and match all templates against the
+        listing, storing it for other grabbers of the same directory
+
+        >>> dg.inputs.use_index = True
+        >>> dg.inputs.index_file = '/tmp/index.pklz'
+
     """
     input_spec = DataGrabberInputSpec
     output_spec = DynamicTraitedSpec
@@ -478,6 +742,19 @@ class DataGrabber(IOBase):
                         (self.__class__.__name__, key)
                     raise ValueError(msg)
 
+        glob_files = glob.glob
+        if self.inputs.use_index:
+            root = self.inputs.base_directory
+            if not isdefined(root):
+                root = os.getcwd()
+            depth = None
+            if isdefined(self.inputs.index_depth):
+                depth = self.inputs.index_depth
+            index_file = None
+            if isdefined(self.inputs.index_file):
+                index_file = os.path.abspath(self.inputs.index_file)
+            glob_files = get_directory_index(root, depth, index_file).glob
+
         outputs = {}
         for key, args in self.inputs.template_args.items():
             outputs[key] = []
@@ -492,7 +769,7 @@ class DataGrabber(IOBase):
             else:
                 template = os.path.abspath(template)
             if not args:
-                filelist = glob.glob(template)
+                filelist = glob_files(template)
                 if len(filelist) == 0:
                     msg = 'Output key: %s Template: %s returned no files' % (
                         key, template)
@@ -530,7 +807,7 @@ class DataGrabber(IOBase):
                             filledtemplate = template%tuple(argtuple)
                         except TypeError as e:
                             raise TypeError(e.message + ": Template %s failed to convert with args %s"%(template, str(tuple(argtuple))))
-                    outfiles = glob.glob(filledtemplate)
+                    outfiles = glob_files(filledtemplate)
                     if len(outfiles) == 0:
                         msg = 'Output key: %s Template: %s returned no files' % (key, filledtemplate)
                         if self.inputs.raise_on_empty:
@@ -1167,18 +1444,124 @@ def push_provenance():
     pass
 
 
-class SQLiteSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
-    database_file = File(exists=True, mandatory=True)
+_sql_connections = {}
+_sql_connections_lock = threading.Lock()
+
+
+def get_sql_connection(key, connect):
+    """Return a connection of this process and the lock guarding it
+
+    Connections are created by calling `connect` the first time a key is
+    requested and kept open until `close_sql_connections` is called (at
+    exit). Forked processes open their own connections.
+    """
+    key = (os.getpid(),) + tuple(key)
+    with _sql_connections_lock:
+        if key not in _sql_connections:
+            _sql_connections[key] = (connect(), threading.Lock())
+        return _sql_connections[key]
+
+
+def close_sql_connections():
+    """Close all connections opened by this process"""
+    with _sql_connections_lock:
+        for key, (conn, _) in _sql_connections.items():
+            if key[0] == os.getpid():
+                try:
+                    conn.close()
+                except Exception, e:
+                    iflogger.debug('Could not close connection: %s' % e)
+        _sql_connections.clear()
+
+atexit.register(close_sql_connections)
+
+
+class SQLSinkBase(IOBase):
+    """Base class of sinks inserting their inputs as rows of a table
+
+    Connections are pooled per process and all rows of a run are inserted
+    in a single transaction with executemany.
+    """
+
+    def __init__(self, input_names, **inputs):
+
+        super(SQLSinkBase, self).__init__(**inputs)
+
+        self._input_names = filename_to_list(input_names)
+        add_traits(self.inputs, [name for name in self._input_names])
+
+    def _connection_key(self):
+        raise NotImplementedError
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _insert_statement(self):
+        raise NotImplementedError
+
+    def _rows(self):
+        values = [getattr(self.inputs, name) for name in self._input_names]
+        if not self.inputs.bulk:
+            return [values]
+        nrows = None
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                if nrows is not None and len(value) != nrows:
+                    raise ValueError('incompatible number of values for %s'
+                                     % self.inputs.table_name)
+                nrows = len(value)
+        if nrows is None:
+            return [values]
+        return [[value[i] if isinstance(value, (list, tuple)) else value
+                 for value in values] for i in range(nrows)]
+
+    def _list_outputs(self):
+        """Execute this module.
+        """
+        rows = self._rows()
+        statement = self._insert_statement()
+        conn, lock = get_sql_connection(self._connection_key(), self._connect)
+        batch_size = max(self.inputs.batch_size, 1)
+        with lock:
+            if hasattr(conn, 'ping'):
+                conn.ping(True)
+            c = conn.cursor()
+            try:
+                for i in range(0, len(rows), batch_size):
+                    c.executemany(statement, rows[i:i + batch_size])
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            finally:
+                c.close()
+        return None
+
+
+class SQLSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     table_name = traits.Str(mandatory=True)
+    bulk = traits.Bool(False, usedefault=True,
+                       desc=('insert a row for each element of list inputs '
+                             '(e.g., outputs collated by a MapNode)'))
+    batch_size = traits.Int(1000, usedefault=True,
+                            desc='number of rows sent per executemany call')
 
 
-class SQLiteSink(IOBase):
-    """ Very simple frontend for storing values into SQLite database.
+class SQLiteSinkInputSpec(SQLSinkInputSpec):
+    database_file = File(exists=True, mandatory=True)
+    use_wal = traits.Bool(True, usedefault=True,
+                          desc=('switch the database to write-ahead logging '
+                                'so readers do not block writers (not '
+                                'supported on network file systems)'))
+    timeout = traits.Float(60, usedefault=True,
+                           desc='seconds to wait for a locked database')
 
-        .. warning::
 
-            This is not a thread-safe node because it can write to a common
-            shared location. It will not complain when it overwrites a file.
+class SQLiteSink(SQLSinkBase):
+    """ Very simple frontend for storing values into SQLite database.
+
+        Concurrent writers wait up to `timeout` seconds for the database
+        lock. Existing rows with the same key are replaced.
 
         Examples
         --------
@@ -1190,32 +1573,35 @@ class SQLiteSink(IOBase):
         >>> sql.inputs.some_measurement = 11.4
         >>> sql.run() # doctest: +SKIP
 
-    """
-    input_spec = SQLiteSinkInputSpec
+        Insert one row per element of the measurements collated by a MapNode
+        in a single transaction
 
-    def __init__(self, input_names, **inputs):
+        >>> sql.inputs.bulk = True
+        >>> sql.inputs.some_measurement = [11.4, 12.1, 9.8]
+        >>> sql.run() # doctest: +SKIP
 
-        super(SQLiteSink, self).__init__(**inputs)
+    """
+    input_spec = SQLiteSinkInputSpec
 
-        self._input_names = filename_to_list(input_names)
-        add_traits(self.inputs, [name for name in self._input_names])
+    def _connection_key(self):
+        return ('sqlite', os.path.abspath(self.inputs.database_file),
+                self.inputs.use_wal, self.inputs.timeout)
 
-    def _list_outputs(self):
-        """Execute this module.
-        """
+    def _connect(self):
         conn = sqlite3.connect(self.inputs.database_file,
+                               timeout=self.inputs.timeout,
                                check_same_thread=False)
-        c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO %s (" % self.inputs.table_name +
-                  ",".join(self._input_names) + ") VALUES (" +
-                  ",".join(["?"] * len(self._input_names)) + ")",
-                  [getattr(self.inputs, name) for name in self._input_names])
-        conn.commit()
-        c.close()
-        return None
+        if self.inputs.use_wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _insert_statement(self):
+        return ("INSERT OR REPLACE INTO %s (" % self.inputs.table_name +
+                ",".join(self._input_names) + ") VALUES (" +
+                ",".join(["?"] * len(self._input_names)) + ")")
 
 
-class MySQLSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+class MySQLSinkInputSpec(SQLSinkInputSpec):
     host = traits.Str('localhost', mandatory=True,
                       requires=['username', 'password'],
                       xor=['config'], usedefault=True)
@@ -1223,12 +1609,11 @@ class MySQLSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
                   desc="MySQL Options File (same format as my.cnf)")
     database_name = traits.Str(
         mandatory=True, desc='Otherwise known as the schema name')
-    table_name = traits.Str(mandatory=True)
     username = traits.Str()
     password = traits.Str()
 
 
-class MySQLSink(IOBase):
+class MySQLSink(SQLSinkBase):
     """ Very simple frontend for storing values into MySQL database.
 
         Examples
@@ -1246,30 +1631,24 @@ class MySQLSink(IOBase):
     """
     input_spec = MySQLSinkInputSpec
 
-    def __init__(self, input_names, **inputs):
-
-        super(MySQLSink, self).__init__(**inputs)
-
-        self._input_names = filename_to_list(input_names)
-        add_traits(self.inputs, [name for name in self._input_names])
+    def _connection_key(self):
+        if isdefined(self.inputs.config):
+            return ('mysql', self.inputs.database_name,
+                    os.path.abspath(self.inputs.config))
+        return ('mysql', self.inputs.database_name, self.inputs.host,
+                self.inputs.username, self.inputs.password)
 
-    def _list_outputs(self):
-        """Execute this module.
-        """
+    def _connect(self):
         import MySQLdb
         if isdefined(self.inputs.config):
-            conn = MySQLdb.connect(db=self.inputs.database_name,
+            return MySQLdb.connect(db=self.inputs.database_name,
                                    read_default_file=self.inputs.config)
-        else:
-            conn = MySQLdb.connect(host=self.inputs.host,
-                                   user=self.inputs.username,
-                                   passwd=self.inputs.password,
-                                   db=self.inputs.database_name)
-        c = conn.cursor()
-        c.execute("REPLACE INTO %s (" % self.inputs.table_name +
-                  ",".join(self._input_names) + ") VALUES (" +
-                  ",".join(["%s"] * len(self._input_names)) + ")",
-                  [getattr(self.inputs, name) for name in self._input_names])
-        conn.commit()
-        c.close()
-        return None
+        return MySQLdb.connect(host=self.inputs.host,
+                               user=self.inputs.username,
+                               passwd=self.inputs.password,
+                               db=self.inputs.database_name)
+
+    def _insert_statement(self):
+        return ("REPLACE INTO %s (" % self.inputs.table_name +
+                ",".join(self._input_names) + ") VALUES (" +
+                ",".join(["%s"] * len(self._input_names)) + ")")
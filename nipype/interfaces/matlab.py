@@ -1,11 +1,20 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """ General matlab interface code """
+import atexit
+import errno
 import os
+import select
+import subprocess
+import threading
+from time import sleep
 
 from nipype.interfaces.base import (CommandLineInputSpec, InputMultiPath, isdefined,
-                                    CommandLine, traits, File, Directory)
-from .. import config
+                                    CommandLine, traits, File, Directory,
+                                    Stream, call_without_cwd_lock,
+                                    collect_streams, terminal_output_limit)
+from .. import config, logging
+iflogger = logging.getLogger('interface')
 
 def get_matlab_command():
     if 'NIPYPE_NO_MATLAB' in os.environ:
@@ -17,7 +26,8 @@ def get_matlab_command():
         matlab_cmd = 'matlab'
 
     try:
-        res = CommandLine(command='which', args=matlab_cmd).run()
+        res = CommandLine(command='which', args=matlab_cmd,
+                          terminal_output='allatonce').run()
         matlab_path = res.runtime.stdout.strip()
     except Exception, e:
         return None
@@ -25,6 +35,218 @@ def get_matlab_command():
 
 no_matlab = get_matlab_command() is None
 
+
+class MatlabWorker(object):
+    """A MATLAB session reading commands from its standard input
+
+    The workspace is cleared before each script, so that variables such as
+    the `jobs` of an SPM batch are not inherited from the previous one. Each
+    script is followed by a command printing a marker on stdout and stderr,
+    which tells when the script has finished.
+    """
+
+    def __init__(self, cmdline, environ):
+        self.proc = subprocess.Popen(cmdline,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     shell=True,
+                                     env=environ)
+        self._njobs = 0
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, runtime, script, log=True):
+        """Run `script` in runtime.cwd and store its output in runtime
+        """
+        self._njobs += 1
+        marker = '__nipype_done_%d_%d__' % (self.proc.pid, self._njobs)
+        done = "fprintf(%d,'\\n" + marker + "\\n');"
+        commands = ['clear all; clear global;',
+                    "cd('%s');" % runtime.cwd.replace("'", "''"),
+                    script,
+                    done % 1 + done % 2,
+                    '']
+        streams = [
+            Stream('stdout', self.proc.stdout, log=log,
+                   limit=terminal_output_limit()),
+            Stream('stderr', self.proc.stderr, log=log,
+                   limit=terminal_output_limit())
+            ]
+        try:
+            self.proc.stdin.write('\n'.join(commands))
+            self.proc.stdin.flush()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+        pending = streams
+        while pending:
+            try:
+                ready = select.select(pending, [], [])[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for stream in ready:
+                stream.read()
+            pending = [stream for stream in streams
+                       if not stream.closed and not
+                       (stream._rows and marker in stream._rows[-1][2])]
+        finished = [stream for stream in streams if not stream.closed]
+        for stream in finished:
+            stream._rows.pop()
+            # the empty line printed before the marker
+            if stream._rows and not stream._rows[-1][2]:
+                stream._rows.pop()
+        if len(finished) == len(streams):
+            runtime.returncode = 0
+        else:
+            # the script ended the session
+            runtime.returncode = self.proc.wait()
+        return collect_streams(runtime, streams)
+
+    def close(self):
+        """Ask MATLAB to exit, terminating it if it doesn't
+        """
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        for _ in range(50):
+            if not self.alive():
+                break
+            sleep(0.1)
+        else:
+            self.proc.terminate()
+        self.proc.wait()
+
+
+class MatlabPool(object):
+    """Persistent MATLAB workers shared by the interfaces of a process
+
+    At most `size` workers exist at a time. Workers are reused by commands
+    with the same MATLAB command line and environment; an idle worker with
+    a different configuration is closed to make room if necessary.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = {}
+        self._nworkers = 0
+        self._cond = threading.Condition()
+
+    def run(self, cmdline, runtime, script, log=True):
+        key = (cmdline, tuple(sorted(runtime.environ.items())))
+        worker = self._checkout(key, cmdline, runtime.environ)
+        try:
+            runtime = call_without_cwd_lock(worker.run, runtime, script, log)
+        finally:
+            self._checkin(key, worker)
+        return runtime
+
+    def _checkout(self, key, cmdline, environ):
+        self._cond.acquire()
+        try:
+            while True:
+                while self._idle.get(key):
+                    worker = self._idle[key].pop()
+                    if worker.alive():
+                        return worker
+                    self._nworkers -= 1
+                if self._nworkers < self.size:
+                    break
+                others = [k for k in self._idle if self._idle[k]]
+                if others:
+                    self._idle[others[0]].pop().close()
+                    self._nworkers -= 1
+                    break
+                self._cond.wait()
+            self._nworkers += 1
+        finally:
+            self._cond.release()
+        iflogger.info('Starting MATLAB worker: %s' % cmdline)
+        try:
+            return MatlabWorker(cmdline, environ)
+        except:
+            self._checkin(key, None)
+            raise
+
+    def _checkin(self, key, worker):
+        self._cond.acquire()
+        try:
+            if worker is not None and worker.alive():
+                self._idle.setdefault(key, []).append(worker)
+            else:
+                self._nworkers -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """Close all idle workers
+        """
+        self._cond.acquire()
+        try:
+            for workers in self._idle.values():
+                for worker in workers:
+                    worker.close()
+                    self._nworkers -= 1
+            self._idle = {}
+        finally:
+            self._cond.release()
+
+    def forget(self):
+        """Drop workers inherited from a parent process without closing them
+        """
+        for workers in self._idle.values():
+            for worker in workers:
+                for fp in [worker.proc.stdin, worker.proc.stdout,
+                           worker.proc.stderr]:
+                    fp.close()
+        self._idle = {}
+        self._nworkers = 0
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_matlab_pool():
+    """Returns the MATLAB worker pool of this process or None if disabled
+
+    The size of the pool is set by the `matlab_pool_size` execution option.
+    Processes forked from a process with a pool, e.g. by the MultiProc
+    plugin, start their own workers.
+    """
+    global _pool
+    size = 0
+    if config.has_option('execution', 'matlab_pool_size'):
+        size = int(config.get('execution', 'matlab_pool_size'))
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _pool.forget()
+            _pool = None
+        if _pool is not None and _pool.size != size:
+            _pool.close()
+            _pool = None
+        if _pool is None and size > 0:
+            _pool = MatlabPool(size)
+        return _pool
+
+
+def close_matlab_pool():
+    """Close the idle MATLAB workers of this process
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = None
+
+atexit.register(close_matlab_pool)
+
 class MatlabInputSpec(CommandLineInputSpec):
     """ Basic expected inputs to Matlab interface """
 
@@ -63,6 +285,11 @@ class MatlabInputSpec(CommandLineInputSpec):
 class MatlabCommand(CommandLine):
     """Interface that runs matlab code
 
+    If the execution option `matlab_pool_size` is positive, the code is run
+    by a persistent MATLAB session (see `get_matlab_pool`) instead of a new
+    MATLAB process. This does not apply to the MCR or when a logfile is
+    requested. The output of pooled sessions is always kept in memory.
+
     >>> import nipype.interfaces.matlab as matlab
     >>> mlab = matlab.MatlabCommand()
     >>> mlab.inputs.script = "which('who')"
@@ -70,6 +297,7 @@ class MatlabCommand(CommandLine):
     """
 
     _cmd = 'matlab'
+    _terminal_output = 'stream'
     _default_matlab_cmd = None
     _default_mfile = None
     _default_paths = None
@@ -131,16 +359,34 @@ class MatlabCommand(CommandLine):
 
     def _run_interface(self,runtime):
         runtime = super(MatlabCommand, self)._run_interface(runtime)
-        try:
-            # Matlab can leave the terminal in a barbbled state
-            os.system('stty sane')
-        except:
-            # We might be on a system where stty doesn't exist
-            pass
-        if 'MATLAB code threw an exception' in runtime.stderr:
+        if runtime.stderr and \
+                'MATLAB code threw an exception' in runtime.stderr:
             self.raise_exception(runtime)
         return runtime
 
+    def _execute_command(self, runtime):
+        pool = None
+        if not self.inputs.uses_mcr and not isdefined(self.inputs.logfile):
+            pool = get_matlab_pool()
+        if pool is None:
+            runtime = super(MatlabCommand, self)._execute_command(runtime)
+            try:
+                # Matlab can leave the terminal in a barbbled state
+                os.system('stty sane')
+            except:
+                # We might be on a system where stty doesn't exist
+                pass
+            return runtime
+        cmdline = ' '.join([self.cmd] + self._parse_inputs(skip=['script']))
+        if self.inputs.mfile:
+            # the m-file was written when generating the command line
+            script = "run('%s');" % os.path.join(runtime.cwd,
+                                                 self.inputs.script_file)
+        else:
+            script = self._gen_matlab_command('%s', self.inputs.script)
+        return pool.run(cmdline, runtime, script,
+                        log=self.terminal_output == 'stream')
+
     def _format_arg(self, name, trait_spec, value):
         if name in ['script']:
             argstr = trait_spec.argstr
@@ -156,7 +402,7 @@ class MatlabCommand(CommandLine):
         if isdefined(self.inputs.paths):
             paths = self.inputs.paths
         # prescript
-        prescript = self.inputs.prescript
+        prescript = list(self.inputs.prescript)
         postscript = self.inputs.postscript
 
         #postcript takes different default value depending on the mfile argument
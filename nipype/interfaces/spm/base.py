@@ -15,10 +15,12 @@ from scipy.io import savemat
 # Local imports
 from nipype.interfaces.base import (BaseInterface, traits, isdefined,
                                     InputMultiPath, BaseInterfaceInputSpec,
-                                    Directory)
+                                    Directory, Bunch, InterfaceBatch,
+                                    thread_state)
 
 from nibabel import load
 from nipype.interfaces.matlab import MatlabCommand
+from nipype.utils.toolcache import cached_probe
 
 import nipype.utils.spm_docs as sd
 
@@ -132,7 +134,15 @@ class Info(object):
                 matlab_cmd = os.environ['MATLABCMD']
             except:
                 matlab_cmd = 'matlab -nodesktop -nosplash'
+        return cached_probe('spm.version', Info._probe_version,
+                            env_vars=('MATLABPATH',),
+                            args=(matlab_cmd, MatlabCommand._default_paths))
+
+    @staticmethod
+    def _probe_version(matlab_cmd, paths=None):
         mlab = MatlabCommand(matlab_cmd = matlab_cmd)
+        if paths:
+            mlab.inputs.paths = paths
         mlab.inputs.script = """
         if isempty(which('spm')),
         throw(MException('SPMCheck:NotFound','SPM not in matlab path'));
@@ -169,6 +179,84 @@ def no_spm():
         return False
 
 
+class SPMBatch(InterfaceBatch):
+    """Runs the scripts of several SPM interfaces in one MATLAB session
+
+    Each script is run in the working directory of its interface and inside
+    its own try/catch block, so that a failing job doesn't stop the others.
+    The output is split between the interfaces using markers printed before
+    each script.
+    """
+
+    failed_message = 'NIPYPE SPM batch job failed:'
+
+    def _run(self, items):
+        first = items[0]['interface'].mlab
+        mlab = MatlabCommand(matlab_cmd=first.cmd,
+                             mfile=first.inputs.mfile,
+                             paths=first.inputs.paths,
+                             uses_mcr=first.inputs.uses_mcr)
+        mlab.inputs.script_file = 'pyscript_batch_%s.m' % \
+            items[0]['interface'].__class__.__name__.lower()
+        mlab.inputs.script = self._make_batch_script(items)
+        results = mlab.run()
+        runtimes = self._split_runtime(results.runtime, len(items))
+        for item, runtime in zip(items, runtimes):
+            item['result'] = Bunch(runtime=runtime)
+
+    def _make_batch_script(self, items):
+        mscript = ''
+        for i, item in enumerate(items):
+            mscript += """
+        fprintf(1,'\\n%(marker)s\\n');fprintf(2,'\\n%(marker)s\\n');
+        cd('%(cwd)s');
+        clear jobs;
+        try,
+        %(script)s
+        catch ME,
+        fprintf(2,'%(failed)s\\n%%s\\n',ME.message);
+        end;
+        """ % dict(marker=self._marker(i),
+                   cwd=item['cwd'].replace("'", "''"),
+                   script=item['script'],
+                   failed=self.failed_message)
+        return mscript
+
+    def _marker(self, index):
+        return '__nipype_spm_batch_job_%d__' % index
+
+    def _split_runtime(self, runtime, nitems):
+        """Split the output of the batch into one runtime per job
+        """
+        markers = [self._marker(i) for i in range(nitems)]
+        runtimes = [Bunch(returncode=runtime.returncode,
+                          cmdline=runtime.cmdline,
+                          stdout=[], stderr=[], merged=[])
+                    for _ in range(nitems)]
+        for name in ['stdout', 'stderr', 'merged']:
+            value = getattr(runtime, name, None)
+            if value is None:
+                continue
+            if name != 'merged':
+                value = value.split('\n')
+            current = None
+            for line in value:
+                found = [i for i, marker in enumerate(markers)
+                         if line.endswith(marker)]
+                if found:
+                    # the empty line printed before the marker
+                    if current is not None and \
+                            getattr(runtimes[current], name)[-1:] == ['']:
+                        getattr(runtimes[current], name).pop()
+                    current = found[0]
+                elif current is not None:
+                    getattr(runtimes[current], name).append(line)
+        for item_runtime in runtimes:
+            item_runtime.stdout = '\n'.join(item_runtime.stdout)
+            item_runtime.stderr = '\n'.join(item_runtime.stderr)
+        return runtimes
+
+
 class SPMCommandInputSpec(BaseInterfaceInputSpec):
     matlab_cmd = traits.Str(desc='matlab command to use')
     paths = InputMultiPath(Directory(), desc='Paths to add to matlabpath')
@@ -232,19 +320,39 @@ class SPMCommand(BaseInterface):
         if not isdefined(self.inputs.use_mcr) and self._use_mcr:
             self.inputs.use_mcr = self._use_mcr
 
+    @classmethod
+    def _create_batch(cls, nitems, cwd):
+        """Batch running the jobs of a MapNode in a single MATLAB session
+        """
+        return SPMBatch(nitems, cwd)
+
     def _run_interface(self, runtime):
         """Executes the SPM function using MATLAB."""
-        self.mlab.inputs.script = self._make_matlab_command(deepcopy(self._parse_inputs()))
-        results = self.mlab.run()
+        script = self._make_matlab_command(deepcopy(self._parse_inputs()))
+        batch = getattr(thread_state, 'batch', None)
+        batched = isinstance(batch, SPMBatch)
+        if batched:
+            results = batch.submit(dict(interface=self, script=script,
+                                        cwd=os.getcwd()))
+        else:
+            self.mlab.inputs.script = script
+            results = self.mlab.run()
         runtime.returncode = results.runtime.returncode
-        if self.mlab.inputs.uses_mcr:
-            if 'Skipped' in results.runtime.stdout:
-                self.raise_exception(runtime)
         runtime.stdout = results.runtime.stdout
         runtime.stderr = results.runtime.stderr
         runtime.merged = results.runtime.merged
+        if self.mlab.inputs.uses_mcr:
+            if 'Skipped' in results.runtime.stdout:
+                self._raise_exception(runtime)
+        if batched and SPMBatch.failed_message in runtime.stderr:
+            self._raise_exception(runtime)
         return runtime
 
+    def _raise_exception(self, runtime):
+        raise RuntimeError('SPM job failed\nStandard output:\n%s\n'
+                           'Standard error:\n%s' % (runtime.stdout,
+                                                     runtime.stderr))
+
     def _list_outputs(self):
         """Determine the expected outputs based on inputs."""
 
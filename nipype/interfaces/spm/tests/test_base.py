@@ -13,6 +13,7 @@ from nipype.interfaces.spm import no_spm
 import nipype.interfaces.matlab as mlab
 from nipype.interfaces.spm.base import SPMCommandInputSpec
 from nipype.interfaces.base import traits
+import nipype.interfaces.base as nib
 
 try:
     matlab_cmd = os.environ['MATLABCMD']
@@ -147,3 +148,32 @@ def test_make_matlab_command():
     script = dc._make_matlab_command([contents])
     yield assert_true, 'jobs{1}.jobtype{1}.jobname{1}.contents(3) = 3;' in script
     clean_directory(outdir, cwd)
+
+
+def test_batch_script():
+    outdir = mkdtemp()
+    batch = spm.SPMBatch(2, outdir)
+    items = [dict(script='a=1;', cwd='/tmp/a'),
+             dict(script='b=2;', cwd="/tmp/b'c")]
+    script = batch._make_batch_script(items)
+    yield assert_true, "cd('/tmp/a');" in script
+    yield assert_true, "cd('/tmp/b''c');" in script
+    yield assert_true, script.index('a=1;') < script.index('b=2;')
+    runtime = nib.Bunch(returncode=0, cmdline='matlab',
+                        stdout='ver\n\n__nipype_spm_batch_job_0__\nfoo\n'
+                        '\n__nipype_spm_batch_job_1__\nbar',
+                        stderr='\n__nipype_spm_batch_job_0__\n'
+                        '\n__nipype_spm_batch_job_1__\n%s\nerr' %
+                        spm.SPMBatch.failed_message,
+                        merged=['stdout 1:ver',
+                                'stdout 2:__nipype_spm_batch_job_0__',
+                                'stdout 3:foo',
+                                'stdout 4:__nipype_spm_batch_job_1__',
+                                'stdout 5:bar'])
+    runtimes = batch._split_runtime(runtime, 2)
+    yield assert_equal, runtimes[0].stdout, 'foo'
+    yield assert_equal, runtimes[1].stdout, 'bar'
+    yield assert_equal, runtimes[0].stderr, ''
+    yield assert_true, spm.SPMBatch.failed_message in runtimes[1].stderr
+    yield assert_equal, runtimes[1].merged, ['stdout 5:bar']
+    rmtree(outdir)
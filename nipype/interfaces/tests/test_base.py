@@ -1,5 +1,6 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+from cPickle import dumps, loads
 import os
 import tempfile
 import shutil
@@ -324,3 +325,69 @@ def test_Commandline_environ():
     ci3.inputs.environ = {'DISPLAY' : ':2'}
     res = ci3.run()
     yield assert_equal, res.runtime.environ['DISPLAY'], ':2'
+
+
+def test_CommandLine_output():
+    tmpd = tempfile.mkdtemp()
+    oldcwd = os.getcwd()
+    os.chdir(tmpd)
+    cmd = 'echo out; echo err >&2'
+    ci = nib.CommandLine(command=cmd)
+    res = ci.run()
+    yield assert_equal, res.runtime.stdout, 'out'
+    yield assert_equal, res.runtime.stderr, 'err'
+    yield assert_equal, sorted([row.split(':')[-1] for row in res.runtime.merged]), ['err', 'out']
+    ci = nib.CommandLine(command=cmd, terminal_output='allatonce')
+    res = ci.run()
+    yield assert_equal, res.runtime.stdout, 'out'
+    yield assert_equal, res.runtime.stderr, 'err'
+    ci = nib.CommandLine(command=cmd, terminal_output='file')
+    res = ci.run()
+    yield assert_equal, res.runtime.output_files, {
+        'merged': os.path.join(tmpd, 'output.nipype')}
+    yield assert_equal, sorted(open('output.nipype').read().split()), \
+        ['err', 'out']
+    # the output is read back from the files when accessed
+    yield assert_equal, sorted(res.runtime.stdout.split()), ['err', 'out']
+    yield assert_equal, res.runtime.stderr, res.runtime.stdout
+    yield assert_equal, sorted(res.runtime.merged), ['err', 'out']
+    ci.terminal_output = 'file_split'
+    res = ci.run()
+    yield assert_equal, open('stdout.nipype').read(), 'out\n'
+    yield assert_equal, open('stderr.nipype').read(), 'err\n'
+    yield assert_equal, res.runtime.stdout, 'out'
+    yield assert_equal, res.runtime.stderr, 'err'
+    yield assert_equal, res.runtime.merged, ['out', 'err']
+    # results keep the file names, not the output
+    res = loads(dumps(res, 2))
+    yield assert_true, 'stdout' not in res.runtime.__dict__
+    yield assert_equal, res.runtime.stdout, 'out'
+    config.set('execution', 'terminal_output_limit', '2')
+    yield assert_equal, res.runtime.stdout, 't'
+    config.set('execution', 'terminal_output_limit', '0')
+    ci.terminal_output = 'none'
+    res = ci.run()
+    yield assert_equal, res.runtime.returncode, 0
+    yield assert_equal, (res.runtime.stdout, res.runtime.merged), ('', [])
+
+    def set_mode():
+        ci.terminal_output = 'bogus'
+    yield assert_raises, AttributeError, set_mode
+
+    # a class default only applies to that class and its subclasses
+    class Quiet(nib.CommandLine):
+        pass
+    Quiet.set_default_terminal_output('none')
+    yield assert_equal, Quiet(command=cmd).terminal_output, 'none'
+    yield assert_equal, nib.CommandLine(command=cmd).terminal_output, 'stream'
+    os.chdir(oldcwd)
+    shutil.rmtree(tmpd)
+
+
+def test_CommandLine_output_limit():
+    config.set('execution', 'terminal_output_limit', '16')
+    ci = nib.CommandLine(command='seq', args='10000 10008')
+    res = ci.run()
+    config.set('execution', 'terminal_output_limit', '0')
+    yield assert_equal, res.runtime.stdout.split('\n')[-1], '10008'
+    yield assert_true, len(res.runtime.stdout) <= 16
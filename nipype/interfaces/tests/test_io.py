@@ -3,9 +3,13 @@
 import os
 import glob
 import shutil
+import sqlite3
+import sys
+import types
 from tempfile import mkstemp, mkdtemp
 
-from nipype.testing import assert_equal, assert_true, assert_false
+from nipype.testing import (assert_equal, assert_true, assert_false,
+                            assert_raises)
 import nipype.interfaces.io as nio
 from nipype.interfaces.base import Undefined
 
@@ -15,6 +19,65 @@ def test_datagrabber():
     yield assert_equal, dg.inputs.base_directory, Undefined
     yield assert_equal, dg.inputs.template_args,{'outfiles': []}
 
+def test_datagrabber_index():
+    basedir = mkdtemp()
+    for sid in ['s1', 's2', 's3']:
+        os.makedirs(os.path.join(basedir, sid, 'func'))
+        for name in ['f1.nii', 'f2.nii', 'struct.nii', '.hidden.nii']:
+            open(os.path.join(basedir, sid, name), 'wt').close()
+        open(os.path.join(basedir, sid, 'func', 'run1.nii'), 'wt').close()
+    index = nio.DirectoryIndex(basedir)
+    for pattern in ['*', 's1/*.nii', 's?/f[12].nii', 's*/func/*',
+                    's2/struct.nii', 's2/missing.nii', 's1/.*',
+                    's1/f1.nii/*', '*/*/*/*']:
+        pattern = os.path.join(basedir, pattern)
+        yield assert_equal, sorted(index.glob(pattern)), \
+            sorted(glob.glob(pattern))
+    # patterns deeper than the index use glob
+    index = nio.DirectoryIndex(basedir, depth=1)
+    yield assert_equal, index.listing.keys(), ['']
+    pattern = os.path.join(basedir, 's*', 'f1.nii')
+    yield assert_equal, sorted(index.glob(pattern)), \
+        sorted(glob.glob(pattern))
+
+    index_file = os.path.join(mkdtemp(), 'index.pklz')
+    dg = nio.DataGrabber(infields=['sid'], outfields=['func', 'struct'])
+    dg.inputs.base_directory = basedir
+    dg.inputs.template = '%s/%s.nii'
+    dg.inputs.template_args['func'] = [['sid', ['f1', 'f2']]]
+    dg.inputs.template_args['struct'] = [['sid', 'struct']]
+    dg.inputs.sid = 's1'
+    dg.inputs.use_index = True
+    dg.inputs.index_file = index_file
+    outputs = dg._list_outputs()
+    yield assert_equal, outputs['func'], [os.path.join(basedir, 's1', 'f1.nii'),
+                                          os.path.join(basedir, 's1', 'f2.nii')]
+    yield assert_equal, outputs['struct'], os.path.join(basedir, 's1',
+                                                         'struct.nii')
+    yield assert_true, os.path.exists(index_file)
+    index = nio.get_directory_index(basedir, index_file=index_file)
+    nio._index_cache.clear()
+    # the stored index is reused
+    yield assert_equal, nio.get_directory_index(basedir,
+                                                index_file=index_file).mtimes, \
+        index.mtimes
+    # and the directories a pattern walks are listed again if they changed
+    index = nio.get_directory_index(basedir, index_file=index_file)
+    open(os.path.join(basedir, 's1', 'f3.nii'), 'wt').close()
+    os.utime(os.path.join(basedir, 's1'), (0, 1000))
+    os.makedirs(os.path.join(basedir, 's4', 'func'))
+    open(os.path.join(basedir, 's4', 'func', 'run1.nii'), 'wt').close()
+    shutil.rmtree(os.path.join(basedir, 's2'))
+    for pattern in ['s1/f*.nii', 's*/func/*', 's2/*']:
+        pattern = os.path.join(basedir, pattern)
+        yield assert_equal, sorted(index.glob(pattern)), \
+            sorted(glob.glob(pattern))
+    yield assert_false, 's2' in index.listing
+    yield assert_true, 's4/func' in index.listing
+    nio._index_cache.clear()
+    shutil.rmtree(basedir)
+    shutil.rmtree(os.path.dirname(index_file))
+
 def test_datasink():
     ds = nio.DataSink()
     yield assert_true, ds.inputs.parameterization
@@ -82,8 +145,166 @@ def test_datasink_copydir():
     shutil.rmtree(outdir)
     shutil.rmtree(pth)
 
+def test_datasink_skip_unchanged():
+    indir = mkdtemp()
+    outdir = mkdtemp()
+    files = []
+    for i in range(4):
+        f = os.path.join(indir, 'file%d.txt' % i)
+        open(f, 'wt').write('content %d' % i)
+        files.append(f)
+    ds = nio.DataSink(base_directory=outdir, parameterization=False,
+                      n_threads=2)
+    setattr(ds.inputs, '@files', files)
+    ds.run()
+    out_files = [os.path.join(outdir, os.path.basename(f)) for f in files]
+    yield assert_equal, [open(f).read() for f in out_files], \
+        ['content %d' % i for i in range(4)]
+    yield assert_true, os.path.exists(os.path.join(outdir,
+                                                   '.datasink_manifest.json'))
+    # copies keep the modification time of the source
+    yield assert_equal, int(os.stat(out_files[0]).st_mtime), \
+        int(os.stat(files[0]).st_mtime)
+    # unchanged files are not stored again
+    os.chmod(out_files[1], 0444)
+    open(files[2], 'wt').write('new content')
+    ds.run()
+    yield assert_equal, open(out_files[2]).read(), 'new content'
+    yield assert_equal, os.stat(out_files[1]).st_mode & 0777, 0444
+    shutil.rmtree(indir)
+    shutil.rmtree(outdir)
+
+def test_datasink_hardlink():
+    indir = mkdtemp()
+    outdir = mkdtemp()
+    orig = os.path.join(indir, 'file.txt')
+    open(orig, 'wt').write('content')
+    ds = nio.DataSink(base_directory=outdir, parameterization=False,
+                      copy_mode='hardlink', use_manifest=False)
+    setattr(ds.inputs, '@file', orig)
+    ds.run()
+    out_file = os.path.join(outdir, 'file.txt')
+    yield assert_true, os.path.samefile(orig, out_file)
+    yield assert_false, os.path.exists(os.path.join(outdir,
+                                                    '.datasink_manifest.json'))
+    shutil.rmtree(indir)
+    shutil.rmtree(outdir)
+
 def test_freesurfersource():
     fss = nio.FreeSurferSource()
     yield assert_equal, fss.inputs.hemi, 'both'
     yield assert_equal, fss.inputs.subject_id, Undefined
     yield assert_equal, fss.inputs.subjects_dir, Undefined
+
+def test_sqlitesink():
+    tempdir = mkdtemp()
+    db_file = os.path.join(tempdir, 'test.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE results (subject_id TEXT PRIMARY KEY, '
+                 'measurement REAL NOT NULL)')
+    conn.close()
+    sql = nio.SQLiteSink(input_names=['subject_id', 'measurement'])
+    sql.inputs.database_file = db_file
+    sql.inputs.table_name = 'results'
+    sql.inputs.subject_id = 's1'
+    sql.inputs.measurement = 11.4
+    sql.run()
+    # a MapNode's collated outputs are written in one call
+    sql.inputs.bulk = True
+    sql.inputs.batch_size = 2
+    sql.inputs.subject_id = ['s1', 's2', 's3']
+    sql.inputs.measurement = [1.0, 2.0, 3.0]
+    sql.run()
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute('SELECT * FROM results ORDER BY subject_id').fetchall()
+    yield assert_equal, rows, [('s1', 1.0), ('s2', 2.0), ('s3', 3.0)]
+    yield assert_equal, conn.execute('PRAGMA journal_mode').fetchone()[0], \
+        'wal'
+    conn.close()
+    # the connection is reused
+    yield assert_equal, len(nio._sql_connections), 1
+    sql.inputs.measurement = [1.0, 2.0]
+    yield assert_raises, ValueError, sql.run
+    # failed transactions are rolled back
+    sql.inputs.subject_id = ['s4', 's5']
+    sql.inputs.measurement = [4.0, None]
+    yield assert_raises, sqlite3.IntegrityError, sql.run
+    conn = sqlite3.connect(db_file)
+    yield assert_equal, conn.execute('SELECT COUNT(*) FROM results'
+                                     ).fetchone()[0], 3
+    conn.close()
+    nio.close_sql_connections()
+    shutil.rmtree(tempdir)
+
+
+class FakeMySQLConnection(object):
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.rows = []
+        self.commits = 0
+        self.closed = False
+
+    def ping(self, reconnect):
+        pass
+
+    def cursor(self):
+        return FakeMySQLCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMySQLCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def executemany(self, statement, rows):
+        self.conn.statement = statement
+        self.conn.rows.extend(rows)
+
+    def close(self):
+        pass
+
+
+def test_mysqlsink():
+    connections = []
+
+    def connect(**kwargs):
+        connections.append(FakeMySQLConnection(**kwargs))
+        return connections[-1]
+
+    old_module = sys.modules.get('MySQLdb')
+    sys.modules['MySQLdb'] = types.ModuleType('MySQLdb')
+    sys.modules['MySQLdb'].connect = connect
+    sql = nio.MySQLSink(input_names=['subject_id', 'measurement'])
+    sql.inputs.database_name = 'db'
+    sql.inputs.table_name = 'results'
+    sql.inputs.username = 'user'
+    sql.inputs.password = 'secret'
+    sql.inputs.bulk = True
+    sql.inputs.subject_id = ['s1', 's2']
+    sql.inputs.measurement = 1.0
+    sql.run()
+    sql.inputs.subject_id = 's3'
+    sql.run()
+    yield assert_equal, len(connections), 1
+    conn = connections[0]
+    yield assert_equal, conn.kwargs['db'], 'db'
+    yield assert_equal, conn.statement, \
+        'REPLACE INTO results (subject_id,measurement) VALUES (%s,%s)'
+    yield assert_equal, conn.rows, [['s1', 1.0], ['s2', 1.0], ['s3', 1.0]]
+    yield assert_equal, conn.commits, 2
+    nio.close_sql_connections()
+    yield assert_true, conn.closed
+    if old_module is None:
+        del sys.modules['MySQLdb']
+    else:
+        sys.modules['MySQLdb'] = old_module
@@ -83,3 +83,87 @@ def test_set_matlabcmd():
     mi.set_default_matlab_cmd('foo')
     yield assert_equal, mi._default_matlab_cmd, 'foo'
     mi.set_default_matlab_cmd(matlab_cmd)
+
+
+fake_matlab = """#!%s
+# reads commands from stdin like 'matlab -nodesktop -nosplash < script'
+import os
+import re
+import sys
+
+log = open(%r, 'a')
+workspace = {}
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    if line.startswith('clear all;'):
+        workspace.clear()
+    match = re.match(r"cd\\('(.*)'\\);", line)
+    if match:
+        os.chdir(match.group(1))
+    match = re.match(r"run\\('(.*)'\\);", line)
+    if match:
+        script = open(match.group(1)).read()
+        log.write('%%d %%s\\n' %% (os.getpid(), os.getcwd()))
+        log.flush()
+        if 'exit' in script:
+            sys.exit(0)
+        sys.stdout.write('ran %%s\\n' %% os.path.basename(match.group(1)))
+        if 'error(' in script:
+            sys.stderr.write('MATLAB code threw an exception:\\n')
+        workspace.update(re.findall(r"\\b(\\w+)=(\\w+);", script))
+        for name in re.findall(r"disp\\((\\w+)\\)", script):
+            if name in workspace:
+                sys.stdout.write('%%s\\n' %% workspace[name])
+            else:
+                sys.stderr.write('Undefined variable %%s\\n' %% name)
+    for fd, marker in re.findall(r"fprintf\\((\\d),'\\\\n(\\w+)\\\\n'\\);", line):
+        [sys.stdout, sys.stderr][int(fd) - 1].write('\\n%%s\\n' %% marker)
+    sys.stdout.flush()
+    sys.stderr.flush()
+"""
+
+
+def test_matlab_pool():
+    import sys
+    from nipype import config
+    cwd = os.getcwd()
+    basedir = mkdtemp()
+    logfile = os.path.join(basedir, 'fake_matlab.log')
+    stub = os.path.join(basedir, 'fake_matlab')
+    open(stub, 'wt').write(fake_matlab % (sys.executable, logfile))
+    os.chmod(stub, 0755)
+    config.set('execution', 'matlab_pool_size', '1')
+    pids = []
+    for i, script in enumerate(['a=1;', 'b=2;', "error('foo');", 'exit;',
+                                'c=3;']):
+        os.mkdir(os.path.join(basedir, 'run%d' % i))
+        os.chdir(os.path.join(basedir, 'run%d' % i))
+        mc = mlab.MatlabCommand(matlab_cmd=stub, script=script, mfile=True,
+                                terminal_output='allatonce')
+        if 'error' in script:
+            yield assert_raises, RuntimeError, mc.run
+        else:
+            res = mc.run()
+            yield assert_equal, res.runtime.returncode, 0
+            if 'exit' not in script:
+                yield assert_equal, res.runtime.stdout, 'ran pyscript.m'
+        pid, rundir = open(logfile).readlines()[-1].split()
+        yield assert_equal, rundir, os.path.realpath(os.getcwd())
+        pids.append(pid)
+    # a single session runs the scripts until one of them exits MATLAB
+    yield assert_equal, len(set(pids[:4])), 1
+    yield assert_true, pids[4] != pids[3]
+    # a reused session does not see the variables of the previous script
+    for i, script in enumerate(["jobs=1;disp(jobs)", 'disp(jobs)']):
+        os.chdir(os.path.join(basedir, 'run%d' % i))
+        res = mlab.MatlabCommand(matlab_cmd=stub, script=script, mfile=True,
+                                 terminal_output='allatonce').run()
+        pids.append(open(logfile).readlines()[-1].split()[0])
+    yield assert_equal, pids[5], pids[6]
+    yield assert_equal, res.runtime.stderr, 'Undefined variable jobs'
+    mlab.close_matlab_pool()
+    config.set('execution', 'matlab_pool_size', '0')
+    os.chdir(cwd)
+    rmtree(basedir)
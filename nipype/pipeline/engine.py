@@ -23,6 +23,8 @@ from socket import gethostname
 from string import Template
 import sys
 from tempfile import mkdtemp
+import threading
+from time import strftime
 from warnings import warn
 
 import numpy as np
@@ -36,7 +38,8 @@ logger = logging.getLogger('workflow')
 from ..interfaces.base import (traits, InputMultiPath, CommandLine,
                                Undefined, TraitedSpec, DynamicTraitedSpec,
                                Bunch, InterfaceResult, md5, Interface,
-                               TraitDictObject, TraitListObject, isdefined)
+                               TraitDictObject, TraitListObject, isdefined,
+                               thread_state)
 from ..utils.misc import getsource
 from ..utils.filemanip import (save_json, FileNotFoundError,
                                filename_to_list, list_to_filename,
@@ -49,7 +52,8 @@ from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir,
                     clean_working_directory, format_dot,
                     get_print_name, merge_dict,
-                    evaluate_connect_function)
+                    evaluate_connect_function, load_resultfile,
+                    compact_environ, restore_environ, save_environ)
 
 class WorkflowBase(object):
     """ Define common attributes and functions for workflows and nodes
@@ -504,6 +508,14 @@ connected.
             self.config['execution']['crashdump_dir'] = self.config['crashdump_dir']
             del self.config['crashdump_dir']
         self.config = merge_dict(deepcopy(config._sections), self.config)
+        self.config['execution']['crashlog_id'] = '%s-%s' % (
+            strftime('%Y%m%d-%H%M%S'), self.name)
+        if self.base_dir and self.config['execution'].get(
+                'environment_capture', 'delta') == 'delta':
+            # result environments are stored as changes to the environment
+            # of this process, which may differ from that of the workers
+            self.config['execution']['environment_base'] = save_environ(
+                os.path.join(self.base_dir, self.name, '_environments'))
         logger.info(str(sorted(self.config)))
         self._set_needed_outputs(flatgraph)
         execgraph = generate_expanded_graph(deepcopy(flatgraph))
@@ -976,6 +988,7 @@ class Node(WorkflowBase):
         if needed_outputs:
             self.needed_outputs = sorted(needed_outputs)
         self._got_inputs = False
+        self._hashval = None
 
     @property
     def interface(self):
@@ -1015,6 +1028,16 @@ class Node(WorkflowBase):
                                                               parameter,
                                                               str(val)))
         setattr(self.inputs, parameter, deepcopy(val))
+        self._hashval = None
+
+    def set_hashval(self, hashed_inputs, hashvalue):
+        """Provide the hash of the current inputs
+
+        Used by callers that already hashed the inputs (e.g.,
+        nipype.caching) to avoid hashing the input files again. The hash is
+        discarded when the node has run or an input is set with set_input.
+        """
+        self._hashval = (hashed_inputs, hashvalue)
 
     def get_output(self, parameter):
         """Retrieve a particular output of the node"""
@@ -1062,6 +1085,7 @@ class Node(WorkflowBase):
         outdir = self.output_dir()
         logger.info("Executing node %s in dir: %s" % (self._id, outdir))
         hash_exists, hashvalue, hashfile, hashed_inputs = self.hash_exists(updatehash=updatehash)
+        self._hashval = None
 
         if (not updatehash and (((self.overwrite == None
                                   and self._interface.always_run)
@@ -1150,8 +1174,12 @@ class Node(WorkflowBase):
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
-        hashed_inputs, hashvalue = self.inputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+        if getattr(self, '_hashval', None):
+            hashed_inputs, hashvalue = self._hashval
+            hashed_inputs = dict(hashed_inputs)
+        else:
+            hashed_inputs, hashvalue = self.inputs.get_hashval(
+                hash_method=self.config['execution']['hash_method'])
         if str2bool(self.config['execution']['remove_unnecessary_outputs']) \
             and self.needed_outputs:
             hashobject = md5()
@@ -1191,7 +1219,7 @@ class Node(WorkflowBase):
             logger.debug('input: %s' % key)
             results_file = info[0]
             logger.debug('results file: %s' % results_file)
-            results = loadpkl(results_file)
+            results = load_resultfile(results_file)
             output_value = Undefined
             if isinstance(info[1], tuple):
                 output_name = info[1][0]
@@ -1235,12 +1263,29 @@ class Node(WorkflowBase):
                 outputs = result.outputs.dictcopy()  # outputs was a bunch
             result.outputs.set(**modify_paths(outputs, relative=True,
                                               basedir=cwd))
+        runtimes = result.runtime
+        if not isinstance(runtimes, list):
+            runtimes = [runtimes]
+        runtimes = [runtime for runtime in runtimes if runtime is not None]
+        environs = [compact_environ(runtime, self._environ_table_dir(),
+                                    self.config)
+                    for runtime in runtimes]
 
         savepkl(resultsfile, result)
         logger.debug('saved results in %s' % resultsfile)
 
         if result.outputs:
             result.outputs.set(**outputs)
+        for runtime, environ in zip(runtimes, environs):
+            restore_environ(runtime, environ)
+
+    def _environ_table_dir(self):
+        """Directory storing the environments of the nodes of a workflow
+        """
+        topdir = self.base_dir
+        if self._hierarchy:
+            topdir = os.path.join(topdir, self._hierarchy.split('.')[0])
+        return os.path.join(topdir, '_environments')
 
     def _load_resultfile(self, cwd):
         """Load results if it exists in cwd
@@ -1307,7 +1352,7 @@ class Node(WorkflowBase):
                 aggouts = self._interface.aggregate_outputs(needed_outputs=self.needed_outputs)
                 runtime = Bunch(cwd=cwd,
                                 returncode=0,
-                                environ=deepcopy(os.environ.data),
+                                environ=dict(os.environ),
                                 hostname=gethostname())
                 result = InterfaceResult(interface=self._interface.__class__,
                                          runtime=runtime,
@@ -1326,7 +1371,7 @@ class Node(WorkflowBase):
             self._originputs = deepcopy(self._interface.inputs)
         if execute:
             runtime = Bunch(returncode=1,
-                            environ=deepcopy(os.environ.data),
+                            environ=dict(os.environ),
                             hostname=gethostname())
             result = InterfaceResult(interface=self._interface.__class__,
                                      runtime=runtime,
@@ -1466,12 +1511,22 @@ class Node(WorkflowBase):
                 fp.writelines(write_rst_dict(
                         {'hostname': self.result.runtime.hostname,
                          'duration': self.result.runtime.duration}))
-            if hasattr(self.result.runtime, 'merged'):
+            if hasattr(self.result.runtime, 'output_files'):
+                fp.writelines(write_rst_header('Terminal output', level=2))
+                fp.writelines(write_rst_dict(self.result.runtime.output_files))
+            elif hasattr(self.result.runtime, 'merged'):
                 fp.writelines(write_rst_header('Terminal output', level=2))
                 fp.writelines(write_rst_list(self.result.runtime.merged))
             if hasattr(self.result.runtime, 'environ'):
                 fp.writelines(write_rst_header('Environment', level=2))
+                environ = compact_environ(self.result.runtime,
+                                          self._environ_table_dir(),
+                                          self.config)
+                if hasattr(self.result.runtime, 'environ_hash'):
+                    fp.writelines('Changes to environment %s\n\n' %
+                                  self.result.runtime.environ_hash)
                 fp.writelines(write_rst_dict(self.result.runtime.environ))
+                restore_environ(self.result.runtime, environ)
         fp.close()
 
 
@@ -1488,7 +1543,8 @@ class MapNode(Node):
 
     """
 
-    def __init__(self, interface, iterfield=None, **kwargs):
+    def __init__(self, interface, iterfield=None, batch_subnodes=False,
+                 **kwargs):
         """
 
         Parameters
@@ -1500,9 +1556,15 @@ class MapNode(Node):
         set node.iterfield = ['infile'].  If this list has more than 1 item
         then the inputs are selected in order simultaneously from each of these
         fields and each field will need to have the same number of members.
+
+        batch_subnodes : boolean
+            Run the subnodes as a single job and let the interface combine
+            their work, e.g. SPM interfaces run all their jobs in a single
+            MATLAB session. Ignored if the interface doesn't support batches.
         """
         super(MapNode, self).__init__(interface, **kwargs)
         self.iterfield = iterfield
+        self.batch_subnodes = batch_subnodes
         if self.iterfield is None:
             raise Exception("Iterfield must be provided")
         elif isinstance(self.iterfield, str):
@@ -1609,6 +1671,13 @@ class MapNode(Node):
             yield i, node
 
     def _node_runner(self, nodes, updatehash=False):
+        if self.batch_subnodes:
+            if hasattr(self._interface, '_create_batch'):
+                for result in self._batch_runner(nodes, updatehash=updatehash):
+                    yield result
+                return
+            logger.warn('%s does not support batches, running subnodes '
+                        'one at a time' % self._interface.__class__.__name__)
         for i, node in nodes:
             err = None
             try:
@@ -1619,6 +1688,44 @@ class MapNode(Node):
                     raise
             yield i, node, err
 
+    def _batch_runner(self, nodes, updatehash=False):
+        """Run the subnodes on threads sharing an interface batch
+        """
+        nodes = list(nodes)
+        base_cwd = os.getcwd()
+        batch = self._interface._create_batch(len(nodes), base_cwd)
+        cwd_lock = threading.Lock()
+        errors = {}
+
+        def run_subnode(i, node):
+            cwd_lock.acquire()
+            thread_state.cwd_lock = cwd_lock
+            thread_state.base_cwd = base_cwd
+            thread_state.batch = batch
+            try:
+                node.run(updatehash=updatehash)
+            except Exception, err:
+                errors[i] = err
+            finally:
+                thread_state.batch = None
+                batch.leave()
+                os.chdir(base_cwd)
+                thread_state.cwd_lock = None
+                cwd_lock.release()
+
+        threads = [threading.Thread(target=run_subnode, args=(i, node))
+                   for i, node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i, node in nodes:
+            if i in errors and \
+                    str2bool(self.config['execution']['stop_on_first_crash']):
+                self._result = node.result
+                raise errors[i]
+            yield i, node, errors.get(i)
+
     def _collate_results(self, nodes):
         self._result = InterfaceResult(interface=[], runtime=[],
                                        outputs=self.outputs)
@@ -7,9 +7,11 @@ from copy import deepcopy
 from glob import glob
 import os
 import pwd
+from Queue import Queue
 import shutil
 from socket import gethostname
 import sys
+from threading import Thread
 from time import strftime, sleep, time
 from traceback import format_exception, format_exc
 from warnings import warn
@@ -17,10 +19,10 @@ from warnings import warn
 import numpy as np
 import scipy.sparse as ssp
 
-from ..utils import (nx, dfs_preorder)
+from ..utils import (nx, dfs_preorder, walk_files)
 from ..engine import (MapNode, str2bool)
 
-from nipype.utils.filemanip import savepkl, loadpkl
+from nipype.utils.filemanip import savepkl, loadpkl, append_crashlog
 from nipype.interfaces.utility import Function
 
 
@@ -62,6 +64,9 @@ def report_crash(node, traceback=None, hostname=None):
         crashdir = os.getcwd()
     if not os.path.exists(crashdir):
         os.makedirs(crashdir)
+    if node.config['execution'].get('crashfile_format', 'npz') == 'jsonl':
+        return _append_crash_record(node, crashdir, host, login_name,
+                                    timeofcrash, traceback)
     crashfile = os.path.join(crashdir, crashfile)
     logger.info('Saving crash info to %s' % crashfile)
     logger.info(''.join(traceback))
@@ -69,6 +74,55 @@ def report_crash(node, traceback=None, hostname=None):
     return crashfile
 
 
+def _append_crash_record(node, crashdir, host, login_name, timeofcrash,
+                         traceback):
+    """Appends crash information to the crash log of the current run
+
+    Instead of pickling the whole node, only its id, inputs, host and
+    traceback are stored as one line of a json-lines log shared by all nodes
+    of a workflow run. The node itself is pickled next to the log only if
+    `crashlog_save_node` is set.
+    """
+    runid = node.config['execution'].get('crashlog_id', None)
+    if not runid:
+        runid = strftime('%Y%m%d')
+    crashlog = os.path.join(crashdir, 'crash-%s-%s.jsonl' % (runid,
+                                                             login_name))
+    record = dict(node=node._id,
+                  hierarchy=node._hierarchy,
+                  host=host,
+                  login=login_name,
+                  time=timeofcrash,
+                  traceback=traceback,
+                  node_pickle=None)
+    try:
+        record['inputs'] = node.inputs.get_traitsfree()
+    except Exception:
+        record['inputs'] = None
+    if node.base_dir:
+        record['output_dir'] = node.output_dir()
+    if str2bool(node.config['execution'].get('crashlog_save_node', False)):
+        pklfile = os.path.join(crashdir, 'crash-%s-%s-%s.pklz' % (timeofcrash,
+                                                                  login_name,
+                                                                  node._id))
+        savepkl(pklfile, dict(node=node, traceback=traceback))
+        record['node_pickle'] = pklfile
+    logger.info('Saving crash info to %s' % crashlog)
+    logger.info(''.join(traceback))
+    append_crashlog(crashlog, record)
+    return crashlog
+
+
+def _get_dir_size(path):
+    """Returns the total size in bytes of the files below a directory
+    """
+    size = 0
+    for filename in walk_files(path):
+        if not os.path.islink(filename):
+            size += os.path.getsize(filename)
+    return size
+
+
 def report_nodes_not_run(notrun):
     """List nodes that crashed with crashfile info
 
@@ -191,11 +245,19 @@ class DistributedPluginBase(PluginBase):
         proc_pending==False
         depidx: a boolean matrix (NxN) storing the dependency structure accross
             processes. Process dependencies are derived from each column.
+        producers: list (N) of the indices of the processes whose outputs
+            each process consumes
+        refcount: an integer vector (N) counting the consumers of each
+            process that have not finished yet. Set to -1 once the directory
+            of the process has been removed.
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
         self.depidx = None
-        self.refidx = None
+        self.producers = None
+        self.refcount = None
+        self._dirs_to_remove = []
+        self._dir_remover = None
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
@@ -203,6 +265,11 @@ class DistributedPluginBase(PluginBase):
         self.max_jobs = np.inf
         if plugin_args and 'max_jobs' in plugin_args:
             self.max_jobs = plugin_args['max_jobs']
+        self.disk_budget = None
+        if plugin_args and 'disk_budget' in plugin_args:
+            self.disk_budget = plugin_args['disk_budget']
+        self.disk_usage = None
+        self._started_branches = set()
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -250,10 +317,18 @@ class DistributedPluginBase(PluginBase):
                     slots = self.max_jobs - num_jobs
                 self._send_procs_to_workers(updatehash=updatehash,
                                             slots=slots, graph=graph)
-            sleep(2)
+            self._wait()
         self._remove_node_dirs()
+        if self._dir_remover:
+            self._dir_remover.join()
+            self._dir_remover = None
         report_nodes_not_run(notrun)
 
+    def _wait(self):
+        """Pause between polls of pending tasks
+        """
+        sleep(2)
+
     def _get_result(self, taskid):
         raise NotImplementedError
 
@@ -308,6 +383,8 @@ class DistributedPluginBase(PluginBase):
                                          np.zeros(numnodes, dtype=bool)))
         self.proc_pending = np.concatenate((self.proc_pending,
                                             np.zeros(numnodes, dtype=bool)))
+        self.disk_usage = np.concatenate((self.disk_usage,
+                                          np.zeros(numnodes)))
         return False
 
     def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
@@ -317,6 +394,8 @@ class DistributedPluginBase(PluginBase):
             # Check to see if a job is available
             jobids = np.flatnonzero((self.proc_done == False) & \
                                     (self.depidx.sum(axis=0) == 0).__array__())
+            if self.disk_budget is not None:
+                jobids = self._prioritize_branches(jobids)
             if len(jobids) > 0:
                 # send all available jobs
                 logger.info('Submitting %d jobs' % len(jobids))
@@ -328,13 +407,15 @@ class DistributedPluginBase(PluginBase):
                             self._clean_queue(jobid, graph)
                             self.proc_pending[jobid] = False
                             continue
-                        if num_subnodes > 1:
+                        if num_subnodes > 1 and \
+                                not self.procs[jobid].batch_subnodes:
                             submit = self._submit_mapnode(jobid)
                             if not submit:
                                 continue
                     # change job status in appropriate queues
                     self.proc_done[jobid] = True
                     self.proc_pending[jobid] = True
+                    self._started_branches.add(self._get_branch(jobid))
                     # Send job to task manager and add to pending tasks
                     logger.info('Executing: %s ID: %d' % \
                                     (self.procs[jobid]._id, jobid))
@@ -395,7 +476,44 @@ class DistributedPluginBase(PluginBase):
         rowview = self.depidx.getrowview(jobid)
         rowview[rowview.nonzero()] = 0
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            producers = self.producers[jobid]
+            self.refcount[producers] -= 1
+            self._dirs_to_remove.extend(producers[self.refcount[producers] == 0])
+            if self.refcount[jobid] == 0:
+                self._dirs_to_remove.append(jobid)
+            if self.disk_budget is not None:
+                self.disk_usage[jobid] = _get_dir_size(
+                    self.procs[jobid].output_dir())
+                logger.debug('Disk usage: %d of %d bytes' %
+                             (self.disk_usage.sum(), self.disk_budget))
+
+    def _get_branch(self, jobid):
+        """Returns the value of the outermost iterable of a node, if any
+        """
+        parameterization = self.procs[jobid].parameterization
+        if parameterization:
+            return parameterization[0]
+        return None
+
+    def _prioritize_branches(self, jobids):
+        """Orders ready jobs so that started iterable branches finish first
+
+        When the disk usage of the working directory exceeds the budget, jobs
+        that would start a new branch are held back, unless nothing else is
+        running.
+        """
+        started = np.array([self._get_branch(jobid) in self._started_branches
+                            for jobid in jobids], dtype=bool)
+        jobids = np.concatenate((jobids[started], jobids[~started]))
+        if self.disk_usage.sum() >= self.disk_budget:
+            num_started = np.sum(started)
+            if num_started == 0 and not np.any(self.proc_pending):
+                num_started = 1
+            if num_started < len(jobids):
+                logger.info(('Disk budget exceeded, holding back %d jobs of '
+                             'new branches') % (len(jobids) - num_started))
+            jobids = jobids[:num_started]
+        return jobids
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
@@ -405,8 +523,13 @@ class DistributedPluginBase(PluginBase):
             self.depidx = nx.to_scipy_sparse_matrix(graph, format='lil')
         except:
             self.depidx = nx.to_scipy_sparse_matrix(graph)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
+        refidx = ssp.csc_matrix(self.depidx)
+        self.producers = [refidx.indices[refidx.indptr[i]:refidx.indptr[i + 1]]
+                          for i in range(len(self.procs))]
+        self.refcount = np.diff(ssp.csr_matrix(self.depidx).indptr)
+        self._dirs_to_remove = []
+        self.disk_usage = np.zeros(len(self.procs))
+        self._started_branches = set([None])
         self.proc_done = np.zeros(len(self.procs), dtype=bool)
         self.proc_pending = np.zeros(len(self.procs), dtype=bool)
 
@@ -422,18 +545,61 @@ class DistributedPluginBase(PluginBase):
 
     def _remove_node_dirs(self):
         """Removes directories whose outputs have already been used up
+
+        Only processes whose consumers finished since the last call are
+        considered. The directories are removed by a background thread.
+        """
+        candidates = self._dirs_to_remove
+        self._dirs_to_remove = []
+        if not str2bool(self._config['execution']['remove_node_directories']):
+            return
+        for idx in candidates:
+            if self.refcount[idx] != 0:
+                continue
+            if self.proc_done[idx] and (not self.proc_pending[idx]):
+                self.refcount[idx] = -1
+                self.disk_usage[idx] = 0
+                outdir = self.procs[idx].output_dir()
+                logger.info(('[node dependencies finished] '
+                             'removing node: %s from directory %s') % \
+                            (self.procs[idx]._id, outdir))
+                if self._dir_remover is None:
+                    self._dir_remover = DirectoryRemover()
+                self._dir_remover.put(outdir)
+
+
+class DirectoryRemover(object):
+    """Removes directories on a background thread
+
+    The queue is bounded, so that the scheduler blocks instead of piling up
+    deletions when the filesystem cannot keep up.
+    """
+
+    def __init__(self, maxsize=100):
+        self._queue = Queue(maxsize=maxsize)
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            try:
+                shutil.rmtree(path)
+            except Exception, e:
+                logger.warn('Could not remove directory %s: %s' % (path,
+                                                                  str(e)))
+
+    def put(self, path):
+        self._queue.put(path)
+
+    def join(self):
+        """Wait for all queued directories to be removed
         """
-        if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero((self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
-                    continue
-                if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
-                    outdir = self.procs[idx]._output_directory()
-                    logger.info(('[node dependencies finished] '
-                                 'removing node: %s from directory %s') % \
-                                (self.procs[idx]._id, outdir))
-                    shutil.rmtree(outdir)
+        self._queue.put(None)
+        self._thread.join()
 
 
 class SGELikeBatchManagerBase(DistributedPluginBase):
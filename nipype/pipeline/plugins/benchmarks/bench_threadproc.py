@@ -0,0 +1,89 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the ThreadProc plugin against MultiProc
+
+The graph mixes command line nodes that wait on an external program with
+short python nodes, which is typical for FSL/AFNI/FreeSurfer workflows.
+
+Run with ``python -c "import nipype; nipype.bench()"`` or directly with
+``nosetests -s --match bench bench_threadproc.py``.
+"""
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import nipype.interfaces.base as nib
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
+
+
+class SleepInputSpec(nib.CommandLineInputSpec):
+    seconds = nib.traits.Float(argstr='%g', position=0, mandatory=True,
+                               desc='time to sleep')
+    index = nib.traits.Int(desc='position of the node in the fan out')
+
+
+class SleepOutputSpec(nib.TraitedSpec):
+    index = nib.traits.Int(desc='position of the node in the fan out')
+
+
+class Sleep(nib.CommandLine):
+    _cmd = 'sleep'
+    input_spec = SleepInputSpec
+    output_spec = SleepOutputSpec
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['index'] = self.inputs.index
+        return outputs
+
+
+def square(index):
+    return index ** 2
+
+
+def create_mixed_workflow(base_dir, n_branches=16, seconds=1.0):
+    wf = pe.Workflow(name='mixed', base_dir=base_dir)
+    source = pe.Node(niu.IdentityInterface(fields=['index']), name='source')
+    source.iterables = ('index', range(n_branches))
+    command = pe.Node(Sleep(seconds=seconds), name='command')
+    python = pe.Node(niu.Function(input_names=['index'],
+                                  output_names=['out'],
+                                  function=square),
+                     name='python')
+    wf.connect(source, 'index', command, 'index')
+    wf.connect(command, 'index', python, 'index')
+    return wf
+
+
+def time_plugin(plugin, plugin_args, n_branches, seconds):
+    base_dir = mkdtemp(prefix='bench_threadproc_')
+    wf = create_mixed_workflow(base_dir, n_branches=n_branches,
+                               seconds=seconds)
+    wf.config['execution'] = {'crashdump_dir': base_dir,
+                              'create_report': 'false'}
+    t0 = time()
+    wf.run(plugin=plugin, plugin_args=plugin_args)
+    elapsed = time() - t0
+    rmtree(base_dir)
+    return elapsed
+
+
+def bench_threadproc_vs_multiproc():
+    n_branches = 16
+    seconds = 1.0
+    n_workers = 4
+    print
+    print 'Mixed graph: %d x (sleep %gs -> python function)' % (n_branches,
+                                                               seconds)
+    multiproc = time_plugin('MultiProc', {'n_procs': n_workers},
+                            n_branches, seconds)
+    print 'MultiProc  (n_procs=%d): %6.2f s' % (n_workers, multiproc)
+    threadproc = time_plugin('ThreadProc', {'n_threads': n_branches,
+                                            'n_procs': n_workers},
+                             n_branches, seconds)
+    print 'ThreadProc (n_threads=%d, n_procs=%d): %6.2f s' % (n_branches,
+                                                             n_workers,
+                                                             threadproc)
+    print 'ratio: %.2f' % (multiproc / threadproc)
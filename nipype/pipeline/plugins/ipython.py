@@ -16,6 +16,15 @@ except:
 
 from .base import (DistributedPluginBase, logger, report_crash)
 
+def setup_engine(node_config, results_cache_size):
+    """Configure nipype on an engine once for all tasks of a run
+    """
+    from nipype import config, logging
+    from nipype.pipeline.utils import enable_results_cache
+    config.update_config(node_config)
+    logging.update_logging(config)
+    enable_results_cache(results_cache_size)
+
 def execute_task(pckld_task, node_config, updatehash):
     from socket import gethostname
     from traceback import format_exc
@@ -23,8 +32,9 @@ def execute_task(pckld_task, node_config, updatehash):
     traceback=None
     result=None
     try:
-        config.update_config(node_config)
-        logging.update_logging(config)
+        if node_config is not None:
+            config.update_config(node_config)
+            logging.update_logging(config)
         from cPickle import loads
         task = loads(pckld_task)
         result = task.run(updatehash=updatehash)
@@ -33,8 +43,26 @@ def execute_task(pckld_task, node_config, updatehash):
         result = task.result
     return result, traceback, gethostname()
 
+def execute_batch(tasks):
+    """Run a batch of (pickled node, node config, updatehash) tasks on an
+    engine configured by setup_engine
+
+    The node config is None unless it differs from the config of the run.
+    """
+    return [execute_task(pckld_task, node_config, updatehash)
+            for pckld_task, node_config, updatehash in tasks]
+
 class IPythonPlugin(DistributedPluginBase):
     """Execute workflow with ipython
+
+    The plugin_args input to run can be used to control the execution.
+    Currently supported options are:
+
+    - batch_size : number of ready nodes sent to an engine as a single task
+      (default 1)
+    - results_cache_size : number of upstream result files each engine keeps
+      in memory (default 100, 0 disables the cache)
+
     """
 
     def __init__(self, plugin_args=None):
@@ -45,12 +73,28 @@ class IPythonPlugin(DistributedPluginBase):
         self.taskclient = None
         self.taskmap = {}
         self._taskid = 0
+        self._batch = []
+        self._batch_size = 1
+        self._results_cache_size = 100
+        self._configured_engines = set()
+        if plugin_args:
+            if 'batch_size' in plugin_args:
+                self._batch_size = plugin_args['batch_size']
+            if 'results_cache_size' in plugin_args:
+                self._results_cache_size = plugin_args['results_cache_size']
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline is distributed approaches
         based on IPython's parallel processing interface
         """
         # retrieve clients again
+        self.taskclient = self._get_client()
+        self._node_config = config
+        self._configured_engines = set()
+        self._setup_engines()
+        return super(IPythonPlugin, self).run(graph, config, updatehash=updatehash)
+
+    def _get_client(self):
         try:
             name = 'IPython.parallel'
             __import__(name)
@@ -59,20 +103,32 @@ class IPythonPlugin(DistributedPluginBase):
             raise ImportError("Ipython kernel not found. Parallel execution " \
                               "will be unavailable")
         try:
-            self.taskclient = self.iparallel.Client()
+            return self.iparallel.Client()
         except Exception, e:
             if isinstance(e, TimeoutError):
                 raise Exception("No IPython clients found.")
             if isinstance(e, ValueError):
                 raise Exception("Ipython kernel not installed")
             raise e
-        return super(IPythonPlugin, self).run(graph, config, updatehash=updatehash)
+
+    def _setup_engines(self):
+        """Push config and logging setup to engines not yet configured
+        """
+        new_engines = [engine for engine in self.taskclient.ids
+                       if engine not in self._configured_engines]
+        if new_engines:
+            logger.debug('Configuring engines: %s' % str(new_engines))
+            self.taskclient[new_engines].apply_sync(setup_engine,
+                                                    self._node_config,
+                                                    self._results_cache_size)
+            self._configured_engines.update(new_engines)
 
     def _get_result(self, taskid):
         if taskid not in self.taskmap:
             raise ValueError('Task %d not in pending list'%taskid)
-        if self.taskmap[taskid].ready():
-            result, traceback, hostname = self.taskmap[taskid].get()
+        batch, index = self.taskmap[taskid]
+        if batch['result'].ready():
+            result, traceback, hostname = batch['result'].get()[index]
             result_out = dict(result=None, traceback=None)
             result_out['result'] = result
             result_out['traceback'] = traceback
@@ -82,15 +138,37 @@ class IPythonPlugin(DistributedPluginBase):
             return None
 
     def _submit_job(self, node, updatehash=False):
-        pckld_node = dumps(node, 2)
-        result_object = self.taskclient.load_balanced_view().apply(execute_task,
-                                                                   pckld_node,
-                                                                   node.config,
-                                                                   updatehash)
         self._taskid += 1
-        self.taskmap[self._taskid] = result_object
+        # engines already run with the workflow config (setup_engine)
+        node_config = None
+        if node.config != self._node_config:
+            node_config = node.config
+        self._batch.append((self._taskid,
+                            (dumps(node, 2), node_config, updatehash)))
+        if len(self._batch) >= self._batch_size:
+            self._flush_batch()
         return self._taskid
 
+    def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
+        super(IPythonPlugin, self)._send_procs_to_workers(updatehash=updatehash,
+                                                          slots=slots,
+                                                          graph=graph)
+        self._flush_batch()
+
+    def _flush_batch(self):
+        """Send the collected nodes to the engines
+        """
+        if not self._batch:
+            return
+        self._setup_engines()
+        view = self.taskclient.load_balanced_view()
+        result_object = view.apply(execute_batch,
+                                   [task for _, task in self._batch])
+        batch = dict(result=result_object, pending=len(self._batch))
+        for index, (taskid, _) in enumerate(self._batch):
+            self.taskmap[taskid] = (batch, index)
+        self._batch = []
+
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
             node._result = result['result']
@@ -103,5 +181,8 @@ class IPythonPlugin(DistributedPluginBase):
     def _clear_task(self, taskid):
         if IPyversion >= '0.11':
             logger.debug("Clearing id: %d"%taskid)
-            self.taskclient.purge_results(self.taskmap[taskid])
+            batch, _ = self.taskmap[taskid]
+            batch['pending'] -= 1
+            if batch['pending'] == 0:
+                self.taskclient.purge_results(batch['result'])
             del self.taskmap[taskid]
@@ -6,6 +6,7 @@ def configuration(parent_package='',top_path=None):
     config = Configuration('plugins', parent_package, top_path)
 
     config.add_data_dir('tests')
+    config.add_data_dir('benchmarks')
 
     return config
 
@@ -2,12 +2,19 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Tests for the engine module
 """
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
 import numpy as np
 import scipy.sparse as ssp
 
 from nipype.testing import (assert_raises, assert_equal, assert_true,
                             assert_false, skipif)
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
 import nipype.pipeline.plugins.base as pb
+from nipype.utils.filemanip import loadcrash, load_crashlog
 
 def test_scipy_sparse():
     foo = ssp.lil_matrix(np.eye(3, k=1))
@@ -15,6 +22,30 @@ def test_scipy_sparse():
     goo[goo.nonzero()] = 0
     yield assert_equal, foo[0,1], 0
 
+def test_report_crash_jsonl():
+    temp_dir = mkdtemp(prefix='test_crash_')
+    node = pe.Node(niu.IdentityInterface(fields=['a']), name='crasher')
+    node.inputs.a = 3
+    node.config = {'execution': {'crashdump_dir': temp_dir,
+                                 'crashfile_format': 'jsonl',
+                                 'crashlog_save_node': 'false',
+                                 'crashlog_id': 'run'}}
+    crashlog = pb.report_crash(node, traceback=['first\n'])
+    pb.report_crash(node, traceback=['second\n'], hostname='otherhost')
+    yield assert_equal, os.listdir(temp_dir), [os.path.basename(crashlog)]
+    records = loadcrash(crashlog)
+    yield assert_equal, len(records), 2
+    yield assert_equal, records[0]['node'], 'crasher'
+    yield assert_equal, records[0]['inputs'], {'a': 3}
+    yield assert_equal, records[1]['host'], 'otherhost'
+    yield assert_equal, records[1]['traceback'], ['second\n']
+    yield assert_equal, records[1]['node_pickle'], None
+    node.config['execution']['crashlog_save_node'] = 'true'
+    pb.report_crash(node, traceback=['third\n'])
+    record = load_crashlog(crashlog)[-1]
+    yield assert_equal, loadcrash(record['node_pickle'])['node'].inputs.a, 3
+    rmtree(temp_dir)
+
 '''
 Can use the following code to test that a mapnode crash continues successfully
 Need to put this into a nose-test with a timeout
@@ -38,4 +69,69 @@ wf.add_nodes([funkynode])
 wf.base_dir = '/tmp'
 
 wf.run(plugin='MultiProc')
-'''
\ No newline at end of file
+'''
+def test_remove_node_dirs():
+    temp_dir = mkdtemp(prefix='test_remove_')
+    nodes = [pe.Node(niu.IdentityInterface(fields=['a']), name=name,
+                     base_dir=temp_dir) for name in 'abcd']
+    for node in nodes:
+        os.makedirs(node.output_dir())
+    a, b, c, d = nodes
+    graph = pb.nx.DiGraph()
+    graph.add_edges_from([(a, b), (a, c), (c, d)])
+    plugin = pb.DistributedPluginBase()
+    plugin._config = {'execution': {'remove_node_directories': 'true'}}
+    plugin._generate_dependency_list(graph)
+    plugin.mapnodesubids = {}
+    idx = dict((node, plugin.procs.index(node)) for node in nodes)
+
+    def finish(node):
+        plugin.proc_done[idx[node]] = True
+        plugin._task_finished_cb(idx[node])
+        plugin._remove_node_dirs()
+
+    finish(a)
+    finish(c)
+    # a is still needed by b
+    yield assert_equal, list(plugin.refcount[[idx[a], idx[c]]]), [1, 1]
+    finish(b)
+    finish(d)
+    plugin._dir_remover.join()
+    for node in nodes:
+        yield assert_false, os.path.exists(node.output_dir())
+    yield assert_equal, list(plugin.refcount), [-1] * 4
+    rmtree(temp_dir)
+
+def test_disk_budget_prioritizes_started_branches():
+    temp_dir = mkdtemp(prefix='test_budget_')
+    nodes = []
+    for subject in ['s1', 's2']:
+        for name in ['a', 'b']:
+            node = pe.Node(niu.IdentityInterface(fields=['a']), name=name,
+                           base_dir=temp_dir)
+            node.parameterization = ['_subject_id_%s' % subject]
+            nodes.append(node)
+    s1a, s1b, s2a, s2b = nodes
+    graph = pb.nx.DiGraph()
+    graph.add_edges_from([(s1a, s1b), (s2a, s2b)])
+    plugin = pb.DistributedPluginBase(plugin_args={'disk_budget': 10})
+    plugin._generate_dependency_list(graph)
+    plugin.mapnodesubids = {}
+    idx = dict((node, plugin.procs.index(node)) for node in nodes)
+    os.makedirs(s1a.output_dir())
+    open(os.path.join(s1a.output_dir(), 'big.nii'), 'wb').write('0' * 20)
+    plugin.proc_done[idx[s1a]] = True
+    plugin._started_branches.add('_subject_id_s1')
+    plugin._task_finished_cb(idx[s1a])
+    yield assert_equal, plugin.disk_usage.sum(), 20
+    ready = np.array([idx[s2a], idx[s1b]])
+    # over budget: only the started subject may proceed
+    yield assert_equal, list(plugin._prioritize_branches(ready)), [idx[s1b]]
+    plugin.disk_usage[:] = 0
+    yield assert_equal, list(plugin._prioritize_branches(ready)), \
+        [idx[s1b], idx[s2a]]
+    # nothing running and no started branch ready: allow one new branch
+    plugin.disk_usage[idx[s1a]] = 20
+    yield assert_equal, list(plugin._prioritize_branches(ready[:1])), \
+        [idx[s2a]]
+    rmtree(temp_dir)
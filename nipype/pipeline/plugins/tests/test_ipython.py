@@ -0,0 +1,183 @@
+import os
+import nipype.interfaces.base as nib
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal, assert_true
+import nipype.pipeline.engine as pe
+import nipype.pipeline.plugins.ipython as ipy
+from nipype.pipeline.utils import enable_results_cache
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+    input2 = nib.traits.Int(desc='a random int')
+
+class OutputSpec(nib.TraitedSpec):
+    output1 = nib.traits.List(nib.traits.Int, desc='outputs')
+
+class TestInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [1, self.inputs.input1]
+        return outputs
+
+class FakeAsyncResult(object):
+    """Runs the task immediately in the current process"""
+
+    def __init__(self, func, args):
+        self._value = func(*args)
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self._value
+
+class FakeView(object):
+
+    def __init__(self, client, targets=None):
+        self.client = client
+        self.targets = targets
+
+    def apply(self, func, *args):
+        self.client.applied.append(func.__name__)
+        self.client.args.append(args)
+        return FakeAsyncResult(func, args)
+
+    def apply_sync(self, func, *args):
+        self.client.synced.append((func.__name__, list(self.targets)))
+        return [func(*args) for _ in self.targets]
+
+class FakeClient(object):
+    """In-process stand-in for IPython.parallel.Client"""
+
+    ids = [0, 1]
+
+    def __init__(self):
+        self.applied = []
+        self.args = []
+        self.synced = []
+        self.purged = []
+
+    def __getitem__(self, targets):
+        return FakeView(self, targets)
+
+    def load_balanced_view(self):
+        return FakeView(self)
+
+    def purge_results(self, result):
+        self.purged.append(result)
+
+class FakeIPythonPlugin(ipy.IPythonPlugin):
+
+    def _get_client(self):
+        return self.client
+
+def test_run_ipython_batched():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    old_state = (ipy.IPython_not_loaded, getattr(ipy, 'IPyversion', None))
+    ipy.IPython_not_loaded = False
+    ipy.IPyversion = '0.13'
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    pipe.connect([(mod1,mod2,[('output1','input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    runner = FakeIPythonPlugin(plugin_args={'batch_size': 2})
+    runner.client = FakeClient()
+    execgraph = pipe.run(plugin=runner)
+    names = ['.'.join((node._hierarchy,node.name)) for node in execgraph.nodes()]
+    node = execgraph.nodes()[names.index('pipe.mod1')]
+    result = node.get_output('output1')
+    yield assert_equal, result, [1, 1]
+    # config is pushed once to every engine
+    yield assert_equal, runner.client.synced, [('setup_engine', [0, 1])]
+    # mod1, both mapnode subnodes in a single task, then the mapnode itself
+    yield assert_equal, runner.client.applied, ['execute_batch'] * 3
+    yield assert_equal, len(runner.client.purged), 3
+    yield assert_equal, runner.taskmap, {}
+    # nodes running with the workflow config send no config of their own
+    tasks = [task for args in runner.client.args for task in args[0]]
+    yield assert_equal, len(tasks), 4
+    yield assert_equal, [task[1] for task in tasks], [None] * 4
+    yield assert_equal, [task[2] for task in tasks], [False] * 4
+    subnode_dirs = [d for d in os.listdir(os.path.join(temp_dir, 'pipe',
+                                                       'mod2'))
+                    if d.startswith('mapflow')]
+    yield assert_true, len(subnode_dirs) > 0
+
+    enable_results_cache(0)
+    ipy.IPython_not_loaded, ipy.IPyversion = old_state
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+
+def test_run_ipython_configures_engines_once():
+    from nipype import config
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    old_state = (ipy.IPython_not_loaded, getattr(ipy, 'IPyversion', None))
+    ipy.IPython_not_loaded = False
+    ipy.IPyversion = '0.13'
+    updates = []
+    update_config = config.update_config
+
+    def counting_update_config(config_dict):
+        updates.append(config_dict)
+        update_config(config_dict)
+    config.update_config = counting_update_config
+
+    pipe = pe.Workflow(name='pipe')
+    for index in range(3):
+        mod = pe.Node(interface=TestInterface(), name='mod%d' % index)
+        mod.inputs.input1 = index
+        pipe.add_nodes([mod])
+    pipe.base_dir = os.getcwd()
+    runner = FakeIPythonPlugin(plugin_args={'batch_size': 2})
+    runner.client = FakeClient()
+    try:
+        pipe.run(plugin=runner)
+    finally:
+        del config.update_config
+    # one update per engine from setup_engine, none per task
+    yield assert_equal, len(updates), len(FakeClient.ids)
+    yield assert_equal, sum([len(args[0]) for args in runner.client.args]), 3
+
+    enable_results_cache(0)
+    ipy.IPython_not_loaded, ipy.IPyversion = old_state
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+
+def test_execute_batch_node_config():
+    from nipype import config
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    mod1 = pe.Node(interface=TestInterface(), name='mod1')
+    mod1.inputs.input1 = 1
+    mod1.base_dir = temp_dir
+    node_config = {'execution': {'nipype_test_option': 'mod1'}}
+    results = ipy.execute_batch([(ipy.dumps(mod1, 2), node_config, False),
+                                 (ipy.dumps(mod1, 2), None, True)])
+    yield assert_equal, [traceback for _, traceback, _ in results], \
+        [None, None]
+    yield assert_equal, results[0][0].outputs.output1, [1, 1]
+    yield assert_equal, config.get('execution', 'nipype_test_option'), 'mod1'
+    config._config.remove_option('execution', 'nipype_test_option')
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
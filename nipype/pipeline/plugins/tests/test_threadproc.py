@@ -0,0 +1,108 @@
+import os
+from multiprocessing import active_children
+import threading
+import nipype.interfaces.base as nib
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.threadproc import ThreadProcPlugin
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+    input2 = nib.traits.Int(desc='a random int')
+
+class OutputSpec(nib.TraitedSpec):
+    output1 = nib.traits.List(nib.traits.Int, desc='outputs')
+
+class TestInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [1, self.inputs.input1]
+        return outputs
+
+class TouchInputSpec(nib.CommandLineInputSpec):
+    input1 = nib.traits.Int(argstr='touched_%d', position=0,
+                            desc='a random int')
+
+class TouchOutputSpec(nib.TraitedSpec):
+    out_file = nib.File(exists=True, desc='created file')
+
+class TestCommand(nib.CommandLine):
+    _cmd = 'sleep 0.2; touch'
+    input_spec = TouchInputSpec
+    output_spec = TouchOutputSpec
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = os.path.abspath('touched_%d' %
+                                              self.inputs.input1)
+        return outputs
+
+def test_run_threadproc():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(),name='mod1')
+    mod2 = pe.MapNode(interface=TestCommand(),
+                      iterfield=['input1'],
+                      name='mod2')
+    mod3 = pe.MapNode(interface=TestCommand(),
+                      iterfield=['input1'],
+                      name='mod3')
+    mod3.inputs.input1 = [2, 3, 4]
+    pipe.connect([(mod1,mod2,[('output1','input1')])])
+    pipe.add_nodes([mod3])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    children = active_children()
+    n_threads = threading.active_count()
+    execgraph = pipe.run(plugin="ThreadProc",
+                         plugin_args={'n_threads': 3, 'n_procs': 1})
+    names = ['.'.join((node._hierarchy,node.name)) for node in execgraph.nodes()]
+    node = execgraph.nodes()[names.index('pipe.mod1')]
+    result = node.get_output('output1')
+    yield assert_equal, result, [1, 1]
+    # every command ran in its own node directory
+    node = execgraph.nodes()[names.index('pipe.mod3')]
+    out_files = node.get_output('out_file')
+    for i, out_file in enumerate(out_files):
+        yield assert_equal, out_file, os.path.join(temp_dir, 'pipe', 'mod3',
+                                                   'mapflow', '_mod3%d' % i,
+                                                   'touched_%d' % (i + 2))
+        yield assert_equal, os.path.exists(out_file), True
+    yield assert_equal, os.getcwd(), temp_dir
+    # the pools are shut down with the run
+    yield assert_equal, [child for child in active_children()
+                         if child not in children], []
+    yield assert_equal, threading.active_count(), n_threads
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class PendingResult(object):
+    """Async result not yet marked as ready"""
+
+    def ready(self):
+        return False
+
+def test_threadproc_callback_result():
+    runner = ThreadProcPlugin(plugin_args={'poll_interval': 60})
+    runner._taskresult[1] = PendingResult()
+    yield assert_equal, runner._get_result(1), None
+    result = dict(result=None, traceback=None)
+    runner._notify(1, result)
+    # the callback wakes the scheduler and hands over the result
+    yield assert_equal, runner._task_done.is_set(), True
+    yield assert_equal, runner._get_result(1), result
+    runner._clear_task(1)
+    yield assert_equal, (runner._taskresult, runner._done), ({}, {})
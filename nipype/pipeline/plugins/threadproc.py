@@ -0,0 +1,148 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution via a thread pool and a process pool
+
+Command line nodes spend most of their time waiting for an external program
+and are run on threads of the workflow process. All other nodes are run in a
+pool of worker processes.
+"""
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool, ThreadPool
+import os
+import threading
+
+from ...interfaces.base import CommandLine, thread_state
+from .base import (DistributedPluginBase, logger, report_crash)
+from .multiproc import run_node
+
+
+def run_node_threaded(node, updatehash, cwd_lock, base_cwd):
+    """Run a node on a thread sharing the working directory with others
+
+    The lock is held while python code executes and released by
+    `run_command` while the external program runs.
+    """
+    cwd_lock.acquire()
+    thread_state.cwd_lock = cwd_lock
+    thread_state.base_cwd = base_cwd
+    try:
+        return run_node(node, updatehash)
+    finally:
+        os.chdir(base_cwd)
+        thread_state.cwd_lock = None
+        cwd_lock.release()
+
+
+class ThreadProcPlugin(DistributedPluginBase):
+    """Execute workflow with a thread pool and a process pool
+
+    Nodes wrapping a CommandLine interface are run on threads, all other
+    nodes in separate processes. Completed tasks wake up the scheduler
+    immediately instead of waiting for the next poll.
+
+    The plugin_args input to run can be used to control the execution.
+    Currently supported options are:
+
+    - n_threads : maximum number of command line nodes run concurrently
+      (default: number of cpus)
+    - n_procs : maximum number of other nodes run concurrently (default:
+      number of cpus)
+    - poll_interval : maximum time in seconds between checks of pending
+      tasks (default: 2)
+
+    """
+
+    def __init__(self, plugin_args=None):
+        super(ThreadProcPlugin, self).__init__(plugin_args=plugin_args)
+        self._taskresult = {}
+        self._done = {}
+        self._taskid = 0
+        self._task_done = threading.Event()
+        self._cwd_lock = threading.Lock()
+        self._n_threads = cpu_count()
+        self._n_procs = cpu_count()
+        self._poll_interval = 2
+        self.pool = None
+        self.thread_pool = None
+        if plugin_args:
+            if 'n_threads' in plugin_args:
+                self._n_threads = plugin_args['n_threads']
+            if 'n_procs' in plugin_args:
+                self._n_procs = plugin_args['n_procs']
+            if 'poll_interval' in plugin_args:
+                self._poll_interval = plugin_args['poll_interval']
+
+    def run(self, graph, config, updatehash=False):
+        """Executes a pre-defined pipeline with pools that only live for
+        this run
+        """
+        # fork the worker processes before any other thread exists
+        self.pool = Pool(processes=self._n_procs)
+        self.thread_pool = ThreadPool(processes=self._n_threads)
+        try:
+            return super(ThreadProcPlugin, self).run(graph, config,
+                                                     updatehash=updatehash)
+        finally:
+            self.pool.close()
+            self.thread_pool.close()
+            self.pool.join()
+            self.thread_pool.join()
+
+    def _wait(self):
+        self._task_done.wait(self._poll_interval)
+        self._task_done.clear()
+
+    def _notify(self, taskid, result):
+        # the pools call back before the async result is marked as ready,
+        # so the result is stored here for _get_result
+        self._done[taskid] = result
+        self._task_done.set()
+
+    def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
+        # nodes run without submitting execute on the scheduling thread and
+        # may change the working directory
+        self._cwd_lock.acquire()
+        try:
+            super(ThreadProcPlugin, self)._send_procs_to_workers(
+                updatehash=updatehash, slots=slots, graph=graph)
+        finally:
+            self._cwd_lock.release()
+
+    def _get_result(self, taskid):
+        if taskid not in self._taskresult:
+            raise RuntimeError('ThreadProc task %d not found' % taskid)
+        if taskid in self._done:
+            return self._done[taskid]
+        if self._taskresult[taskid].ready():
+            # failed tasks are not called back, get raises their error
+            return self._taskresult[taskid].get()
+        return None
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        callback = lambda result, taskid=self._taskid: self._notify(taskid,
+                                                                     result)
+        if isinstance(node._interface, CommandLine):
+            logger.debug('Running node %s on a thread' % node)
+            self._taskresult[self._taskid] = self.thread_pool.apply_async(
+                run_node_threaded,
+                (node, updatehash, self._cwd_lock, os.getcwd()),
+                callback=callback)
+        else:
+            self._taskresult[self._taskid] = self.pool.apply_async(
+                run_node, (node, updatehash), callback=callback)
+        return self._taskid
+
+    def _report_crash(self, node, result=None):
+        if result and result['traceback']:
+            node._result = result['result']
+            node._traceback = result['traceback']
+            return report_crash(node,
+                                traceback=result['traceback'])
+        else:
+            return report_crash(node)
+
+    def _clear_task(self, taskid):
+        del self._taskresult[taskid]
+        self._done.pop(taskid, None)
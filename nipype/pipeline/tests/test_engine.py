@@ -405,3 +405,61 @@ def test_node_hash():
     os.chdir(cwd)
     rmtree(wd)
 
+
+
+class CountingBatch(nib.InterfaceBatch):
+    rounds = []
+
+    def _run(self, items):
+        values = sorted([item['value'] for item in items])
+        self.rounds.append(values)
+        for item in items:
+            item['result'] = sum(values)
+
+
+class BatchInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    @classmethod
+    def _create_batch(cls, nitems, cwd):
+        return CountingBatch(nitems, cwd)
+
+    def _run_interface(self, runtime):
+        if self.inputs.input1 < 0:
+            raise ValueError('negative input')
+        self._total = nib.thread_state.batch.submit(
+            dict(value=self.inputs.input1))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [self.inputs.input1, self._total]
+        return outputs
+
+
+def test_mapnode_batch():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    n1 = pe.MapNode(BatchInterface(), iterfield=['input1'], name='n1',
+                    batch_subnodes=True)
+    n1.inputs.input1 = [1, 2, 3]
+    w1 = pe.Workflow(name='test')
+    w1.base_dir = wd
+    w1.add_nodes([n1])
+    # the mapnode is a single job of the plugin
+    execgraph = w1.run(plugin='MultiProc', plugin_args={'n_procs': 2})
+    yield assert_equal, len(execgraph.nodes()), 1
+    yield assert_equal, execgraph.nodes()[0].get_output('output1'), \
+        [[1, 6], [2, 6], [3, 6]]
+    # a subnode failing before submitting doesn't block the others
+    CountingBatch.rounds = []
+    n2 = pe.MapNode(BatchInterface(), iterfield=['input1'], name='n2',
+                    batch_subnodes=True)
+    n2.inputs.input1 = [-1, 4, 5]
+    n2.base_dir = wd
+    yield assert_raises, Exception, n2.run
+    yield assert_equal, CountingBatch.rounds, [[4, 5]]
+    os.chdir(cwd)
+    rmtree(wd)
@@ -13,7 +13,9 @@ import nipype.pipeline.engine as pe
 import nipype.interfaces.base as nib
 import nipype.interfaces.utility as niu
 from ... import config
-from ..utils import merge_dict
+from ..utils import (merge_dict, enable_results_cache, load_resultfile,
+                     expand_environ, compact_environ, save_environ)
+from ...utils.filemanip import savepkl, loadpkl
 
 
 def test_identitynode_removal():
@@ -291,3 +293,72 @@ def test_multi_disconnected_iterable():
     eg = metawf.run(plugin='Linear')
     yield assert_equal, len(eg.nodes()), 60
     rmtree(out_dir)
+
+def test_results_cache():
+    out_dir = mkdtemp()
+    results_file = os.path.join(out_dir, 'result_test.pklz')
+    savepkl(results_file, {'a': 1})
+    enable_results_cache(maxsize=1)
+    first = load_resultfile(results_file)
+    yield assert_true, load_resultfile(results_file) is first
+    # rewriting the file invalidates the cached entry
+    savepkl(results_file, {'a': 1, 'b': 2})
+    os.utime(results_file, (0, 0))
+    yield assert_equal, load_resultfile(results_file), {'a': 1, 'b': 2}
+    enable_results_cache(0)
+    yield assert_false, load_resultfile(results_file) is \
+        load_resultfile(results_file)
+    rmtree(out_dir)
+
+
+def test_environ_delta():
+    cur_dir = os.getcwd()
+    out_dir = mkdtemp()
+    os.chdir(out_dir)
+    os.environ['NIPYPE_TEST_REMOVED'] = '1'
+    n1 = pe.Node(nib.CommandLine(command='true'), name='n1')
+    n1.inputs.environ = {'NIPYPE_TEST_ADDED': '2'}
+    wf = pe.Workflow(name='wf')
+    wf.base_dir = out_dir
+    wf.add_nodes([n1])
+    wf.run()
+    result = loadpkl(os.path.join(out_dir, 'wf', 'n1', 'result_n1.pklz'))
+    yield assert_equal, result.runtime.environ['NIPYPE_TEST_ADDED'], '2'
+    yield assert_false, 'NIPYPE_TEST_REMOVED' in result.runtime.environ
+    table_dir = os.path.join(out_dir, 'wf', '_environments')
+    yield assert_equal, os.listdir(table_dir), \
+        ['%s.json' % result.runtime.environ_hash]
+    del os.environ['NIPYPE_TEST_REMOVED']
+    result.runtime.environ['NIPYPE_TEST_UNSET'] = None
+    environ = expand_environ(result.runtime, table_dir)
+    yield assert_equal, environ['NIPYPE_TEST_REMOVED'], '1'
+    yield assert_equal, environ['NIPYPE_TEST_ADDED'], '2'
+    yield assert_false, 'NIPYPE_TEST_UNSET' in environ
+    # full capture set for the workflow only
+    wf.config['execution'] = {'environment_capture': 'full'}
+    n1.inputs.environ = {'NIPYPE_TEST_ADDED': '3'}
+    wf.run()
+    result = loadpkl(os.path.join(out_dir, 'wf', 'n1', 'result_n1.pklz'))
+    yield assert_equal, result.runtime.environ['PATH'], os.environ['PATH']
+    yield assert_false, hasattr(result.runtime, 'environ_hash')
+    os.chdir(cur_dir)
+    rmtree(out_dir)
+
+
+def test_environ_base():
+    out_dir = mkdtemp()
+    # the base is the environment saved by the submitting process
+    basehash = save_environ(out_dir, {'JOB_ID': '1', 'HOME': '/home'})
+    runtime = nib.Bunch(environ={'JOB_ID': '2', 'HOME': '/home', 'A': 'b'})
+    cfg = {'execution': {'environment_base': basehash}}
+    compact_environ(runtime, out_dir, cfg)
+    yield assert_equal, runtime.environ, {'JOB_ID': '2', 'A': 'b'}
+    yield assert_equal, runtime.environ_hash, basehash
+    yield assert_equal, os.listdir(out_dir), ['%s.json' % basehash]
+    yield assert_equal, expand_environ(runtime, out_dir), \
+        {'JOB_ID': '2', 'HOME': '/home', 'A': 'b'}
+    cfg['execution']['environment_capture'] = 'none'
+    runtime = nib.Bunch(environ={'A': 'b'})
+    compact_environ(runtime, out_dir, cfg)
+    yield assert_equal, runtime.environ, {}
+    rmtree(out_dir)
@@ -15,7 +15,7 @@ import networkx as nx
 
 from nipype.interfaces.base import CommandLine, isdefined, Undefined
 from nipype.utils.filemanip import fname_presuffix, FileNotFoundError,\
-    filename_to_list
+    filename_to_list, loadpkl, load_json, save_json, md5
 from nipype.utils.misc import create_function_from_source, str2bool
 from nipype.interfaces.utility import IdentityInterface
 
@@ -570,7 +570,7 @@ def export_graph(graph_in, base_dir=None, show=False, use_execgraph=False,
     logger.info('Creating detailed dot file: %s' % outfname)
     _write_detailed_dot(graph, outfname)
     cmd = 'dot -T%s -O %s' % (format, outfname)
-    res = CommandLine(cmd).run()
+    res = CommandLine(cmd, terminal_output='allatonce').run()
     if res.runtime.returncode:
         logger.warn('dot2png: %s', res.runtime.stderr)
     pklgraph = _create_dot_graph(graph, show_connectinfo, simple_form)
@@ -581,7 +581,7 @@ def export_graph(graph_in, base_dir=None, show=False, use_execgraph=False,
     nx.write_dot(pklgraph, outfname)
     logger.info('Creating dot file: %s' % outfname)
     cmd = 'dot -T%s -O %s' % (format, outfname)
-    res = CommandLine(cmd).run()
+    res = CommandLine(cmd, terminal_output='allatonce').run()
     if res.runtime.returncode:
         logger.warn('dot2png: %s', res.runtime.stderr)
     if show:
@@ -593,7 +593,7 @@ def export_graph(graph_in, base_dir=None, show=False, use_execgraph=False,
 
 def format_dot(dotfilename, format=None):
     cmd = 'dot -T%s -O %s' % (format, dotfilename)
-    CommandLine(cmd).run()
+    CommandLine(cmd, terminal_output='allatonce').run()
     logger.info('Converting dotfile: %s to %s format' % (dotfilename, format))
 
 
@@ -648,6 +648,178 @@ def walk_files(cwd):
             yield os.path.join(path, f)
 
 
+_results_cache = None
+
+
+def enable_results_cache(maxsize=100):
+    """Keep recently loaded result files in memory
+
+    This is meant for long-lived worker processes (e.g., IPython engines)
+    where many nodes read the results of the same upstream node. Entries are
+    invalidated when the modification time or size of the file changes. A
+    `maxsize` of 0 disables the cache.
+    """
+    global _results_cache
+    if maxsize:
+        _results_cache = dict(maxsize=maxsize, order=[], data={})
+    else:
+        _results_cache = None
+
+
+def load_resultfile(results_file):
+    """Load a pickled result file, consulting the results cache if enabled
+    """
+    if _results_cache is None:
+        return loadpkl(results_file)
+    stat = os.stat(results_file)
+    key = (results_file, stat.st_mtime, stat.st_size)
+    order = _results_cache['order']
+    data = _results_cache['data']
+    if key in data:
+        order.remove(key)
+        order.append(key)
+        return data[key]
+    results = loadpkl(results_file)
+    data[key] = results
+    order.append(key)
+    while len(order) > _results_cache['maxsize']:
+        del data[order.pop(0)]
+    return results
+
+
+_environ_table = {}
+_environ_saved = set()
+
+
+def _environ_capture(cfg=None):
+    if cfg is not None and \
+            'environment_capture' in cfg.get('execution', {}):
+        return cfg['execution']['environment_capture']
+    if config.has_option('execution', 'environment_capture'):
+        return config.get('execution', 'environment_capture')
+    return 'delta'
+
+
+def environ_hash(environ):
+    """Returns the hash identifying an environment in environment tables
+    """
+    return md5(str(sorted(environ.items()))).hexdigest()
+
+
+def save_environ(table_dir, environ=None):
+    """Write an environment (default: os.environ) to the environment table
+    in table_dir unless already there
+
+    Returns the hash identifying the environment.
+    """
+    if environ is None:
+        environ = os.environ
+    environ = dict(environ)
+    basehash = environ_hash(environ)
+    _environ_table[basehash] = environ
+    if table_dir is not None and (table_dir, basehash) not in _environ_saved:
+        tablefile = os.path.join(table_dir, '%s.json' % basehash)
+        if not os.path.exists(tablefile):
+            if not os.path.exists(table_dir):
+                try:
+                    os.makedirs(table_dir)
+                except OSError:
+                    # created by another process
+                    pass
+            tmpfile = '%s.%d' % (tablefile, os.getpid())
+            save_json(tmpfile, environ)
+            os.rename(tmpfile, tablefile)
+        _environ_saved.add((table_dir, basehash))
+    return basehash
+
+
+def _load_environ(basehash, table_dir):
+    if basehash not in _environ_table:
+        if table_dir is None:
+            return None
+        tablefile = os.path.join(table_dir, '%s.json' % basehash)
+        if not os.path.exists(tablefile):
+            return None
+        _environ_table[basehash] = load_json(tablefile)
+    return _environ_table[basehash]
+
+
+def compact_environ(runtime, table_dir=None, cfg=None):
+    """Reduce the environment stored in runtime before saving results
+
+    Depending on the `environment_capture` execution option, the
+    environment is kept (full), removed (none) or replaced by its
+    differences to a base environment (delta, the default). Removed
+    variables are set to None in the delta. The base environment is
+    identified by `runtime.environ_hash` (see `expand_environ`).
+
+    The options are read from cfg, the config of the node, if given. When
+    running a workflow, the base is the environment of the process that
+    submitted it, saved once to `table_dir` by `Workflow.run` and named by
+    the `environment_base` execution option. Otherwise the environment of
+    the current process is used and written to `table_dir`.
+
+    Returns the environment previously stored in runtime or None if it
+    was not changed.
+    """
+    environ = getattr(runtime, 'environ', None)
+    capture = _environ_capture(cfg)
+    if environ is None or capture == 'full' or \
+            hasattr(runtime, 'environ_hash'):
+        return None
+    if capture == 'none':
+        runtime.environ = {}
+        return environ
+    base = None
+    if cfg is not None and 'environment_base' in cfg.get('execution', {}):
+        basehash = cfg['execution']['environment_base']
+        base = _load_environ(basehash, table_dir)
+    if base is None:
+        basehash = save_environ(table_dir)
+        base = _environ_table[basehash]
+    delta = dict([(key, value) for key, value in environ.items()
+                  if base.get(key) != value])
+    delta.update([(key, None) for key in base if key not in environ])
+    runtime.environ = delta
+    runtime.environ_hash = basehash
+    return environ
+
+
+def restore_environ(runtime, environ):
+    """Undo `compact_environ`
+    """
+    if environ is None:
+        return
+    runtime.environ = environ
+    if hasattr(runtime, 'environ_hash'):
+        del runtime.environ_hash
+
+
+def expand_environ(runtime, table_dir=None):
+    """Returns the full environment of a runtime loaded from a result file
+
+    table_dir is the directory the environment table was saved to, i.e.
+    `_environments` in the directory of the top-level workflow.
+    """
+    basehash = getattr(runtime, 'environ_hash', None)
+    if basehash is None:
+        return runtime.environ
+    if basehash in _environ_table:
+        environ = dict(_environ_table[basehash])
+    else:
+        if table_dir is None:
+            raise ValueError('Environment %s not loaded and no table '
+                             'given' % basehash)
+        environ = load_json(os.path.join(table_dir, '%s.json' % basehash))
+        _environ_table[basehash] = dict(environ)
+    for key, value in runtime.environ.items():
+        if value is None:
+            environ.pop(key, None)
+        else:
+            environ[key] = value
+    return environ
+
+
 def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
                             files2keep=None, dirs2keep=None):
     """Removes all files not needed for further analysis from the directory
@@ -670,7 +842,8 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
         input_files.extend(walk_outputs(inputdict))
         needed_files += [path for path, type in input_files if type == 'f']
     for extra in ['_0x*.json', 'provenance.xml', 'pyscript*.m',
-                  'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz']:
+                  'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz',
+                  '*.nipype']:
         needed_files.extend(glob(os.path.join(cwd, extra)))
     if files2keep:
         needed_files.extend(filename_to_list(files2keep))
@@ -32,18 +32,25 @@ log_rotate = 4
 [execution]
 create_report = true
 crashdump_dir = %s
+crashfile_format = npz
+crashlog_save_node = false
 display_variable = :1
+environment_capture = delta
 hash_method = timestamp
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = false
+matlab_pool_size = 0
 matplotlib_backend = Agg
 plugin = Linear
+probe_cache_on_disk = false
+probe_cache_ttl = 86400
 remove_node_directories = false
 remove_unnecessary_outputs = true
 single_thread_matlab = true
 stop_on_first_crash = false
 stop_on_first_rerun = false
+terminal_output_limit = 0
 use_relative_paths = false
 
 [check]
@@ -268,6 +268,106 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
 
     return newfile
 
+FICLONE = 0x40049409
+
+
+def files_identical(file1, file2):
+    """Return True if two files have the same content
+
+    Files of different size differ and files of the same size and
+    modification time are assumed identical; only the remaining cases are
+    compared by content hash.
+    """
+    if not os.path.isfile(file1) or not os.path.isfile(file2):
+        return False
+    stat1 = os.stat(file1)
+    stat2 = os.stat(file2)
+    if (stat1.st_dev, stat1.st_ino) == (stat2.st_dev, stat2.st_ino):
+        return True
+    if stat1.st_size != stat2.st_size:
+        return False
+    # timestamps set by os.utime are truncated to microseconds
+    if abs(stat1.st_mtime - stat2.st_mtime) < 1e-6:
+        return True
+    return hash_infile(file1) == hash_infile(file2)
+
+
+def _reflink(originalfile, newfile):
+    import fcntl
+    src = open(originalfile, 'rb')
+    try:
+        dst = open(newfile, 'wb')
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        finally:
+            dst.close()
+    except (IOError, OSError):
+        if os.path.exists(newfile):
+            os.unlink(newfile)
+        raise
+    finally:
+        src.close()
+
+
+def transfer_file(originalfile, newfile, mode='copy'):
+    """Copy ``originalfile`` to ``newfile`` keeping its modification time
+
+    Parameters
+    ----------
+    originalfile : str
+        full path to original file
+    newfile : str
+        full path to new file, replaced if it exists
+    mode : str
+        'copy', 'hardlink' or 'reflink' (copy-on-write clone). Links and
+        clones fall back to a copy when the files are on different
+        filesystems or the filesystem does not support them.
+
+    Returns
+    -------
+    mode actually used
+
+    """
+    if os.path.lexists(newfile):
+        os.unlink(newfile)
+    if mode == 'hardlink':
+        try:
+            os.link(originalfile, newfile)
+            return mode
+        except (OSError, AttributeError), e:
+            fmlogger.debug('Could not link %s: %s' % (originalfile, e))
+            mode = 'copy'
+    elif mode == 'reflink':
+        try:
+            _reflink(originalfile, newfile)
+        except (IOError, OSError, ImportError), e:
+            fmlogger.debug('Could not clone %s: %s' % (originalfile, e))
+            mode = 'copy'
+    if mode != 'reflink':
+        shutil.copyfile(originalfile, newfile)
+        mode = 'copy'
+    stat = os.stat(originalfile)
+    os.utime(newfile, (stat.st_atime, stat.st_mtime))
+    return mode
+
+
+def related_files(filename):
+    """Return existing files that belong with ``filename`` (e.g., the
+    header of an analyze image)
+    """
+    companions = []
+    if filename.endswith('.img'):
+        companions = ['.hdr', '.mat']
+    elif filename.endswith('.BRIK'):
+        companions = ['.HEAD']
+    related = []
+    for ext in companions:
+        related_file = filename[:-4] + ext
+        if os.path.exists(related_file):
+            related.append(related_file)
+    return related
+
+
 def copyfiles(filelist, dest, copy=False, create_new=False):
     """Copy or symlink files in ``filelist`` to ``dest`` directory.
 
@@ -389,9 +489,59 @@ def loadflat(infile, *args):
 def loadcrash(infile, *args):
     if '.pkl' in infile:
         return loadpkl(infile)
+    elif infile.endswith('.jsonl'):
+        return load_crashlog(infile)
     else:
         return loadflat(infile, *args)
 
+def append_crashlog(filename, record):
+    """Append a crash record to a json-lines crash log
+
+    The log is locked while writing, so that processes on different hosts can
+    share a single log per workflow run.
+
+    Parameters
+    ----------
+    filename : str
+        Crash log to append to. Created if it does not exist.
+    record : dict
+        Crash information. Values that cannot be serialized by json are
+        stored as their string representation.
+
+    Returns
+    -------
+    offset : int
+        Byte offset of the record in the log
+    """
+    from ..external import portalocker
+    line = json.dumps(record, sort_keys=True, default=str)
+    with open(filename, 'at') as fp:
+        portalocker.lock(fp, portalocker.LOCK_EX)
+        fp.seek(0, os.SEEK_END)
+        offset = fp.tell()
+        fp.write(line + '\n')
+    return offset
+
+def load_crashlog(filename, offset=None):
+    """Load records from a json-lines crash log
+
+    Parameters
+    ----------
+    filename : str
+        Crash log to read
+    offset : int
+        If given, only the record starting at this byte offset is returned
+
+    Returns
+    -------
+    records : list of dicts (or a single dict if offset is given)
+    """
+    with open(filename, 'rt') as fp:
+        if offset is not None:
+            fp.seek(offset)
+            return json.loads(fp.readline())
+        return [json.loads(line) for line in fp if line.strip()]
+
 def loadpkl(infile):
     """Load a zipped or plain cPickled file
     """
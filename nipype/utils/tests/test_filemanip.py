@@ -9,7 +9,8 @@ from nipype.utils.filemanip import (save_json, load_json, loadflat,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    cleandir, split_filename)
+                                    cleandir, split_filename,
+                                    files_identical, transfer_file)
 
 import numpy as np
 
@@ -118,6 +119,44 @@ def test_copyfiles():
     os.unlink(new_img2)
     os.unlink(new_hdr2)
 
+def test_transfer_file():
+    orig_img, orig_hdr = _temp_analyze_files()
+    pth, fname = os.path.split(orig_img)
+    new_img = os.path.join(pth, 'newfile.img')
+    open(orig_img, 'wt').write('image')
+    os.utime(orig_img, (0, 1000))
+    for mode in ['copy', 'hardlink', 'reflink']:
+        used_mode = transfer_file(orig_img, new_img, mode)
+        yield assert_true, used_mode in [mode, 'copy']
+        yield assert_equal, open(new_img).read(), 'image'
+        yield assert_equal, os.stat(new_img).st_mtime, 1000
+        yield assert_true, files_identical(orig_img, new_img)
+    os.remove(new_img)
+    os.remove(orig_img)
+    os.remove(orig_hdr)
+
+def test_files_identical():
+    orig_img, orig_hdr = _temp_analyze_files()
+    pth, fname = os.path.split(orig_img)
+    new_img = os.path.join(pth, 'newfile.img')
+    open(orig_img, 'wt').write('image')
+    open(new_img, 'wt').write('image')
+    # same size and mtime, no hashing needed
+    os.utime(orig_img, (0, 1000))
+    os.utime(new_img, (0, 1000))
+    yield assert_true, files_identical(orig_img, new_img)
+    # different mtime falls back to the content
+    os.utime(new_img, (0, 2000))
+    yield assert_true, files_identical(orig_img, new_img)
+    open(new_img, 'wt').write('other')
+    yield assert_false, files_identical(orig_img, new_img)
+    open(new_img, 'wt').write('longer image')
+    yield assert_false, files_identical(orig_img, new_img)
+    yield assert_false, files_identical(orig_img, orig_img + '.missing')
+    os.remove(new_img)
+    os.remove(orig_img)
+    os.remove(orig_hdr)
+
 def test_filename_to_list():
     x = filename_to_list('foo.nii')
     yield assert_equal, x, ['foo.nii']
@@ -0,0 +1,98 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_true
+from nipype import config
+from nipype.utils import toolcache
+from nipype.interfaces import fsl
+
+
+def test_cached_probe():
+    calls = []
+
+    def probe(arg):
+        calls.append(arg)
+        return 'v%d' % len(calls)
+
+    toolcache.clear_cache()
+    env = {'PATH': '/a', 'FOO': '1'}
+    yield assert_equal, toolcache.cached_probe('test', probe, ('FOO',),
+                                               (1,), env), 'v1'
+    yield assert_equal, toolcache.cached_probe('test', probe, ('FOO',),
+                                               (1,), env), 'v1'
+    env['FOO'] = '2'
+    yield assert_equal, toolcache.cached_probe('test', probe, ('FOO',),
+                                               (1,), env), 'v2'
+    yield assert_equal, toolcache.cached_probe('test', probe, ('FOO',),
+                                               (2,), env), 'v3'
+    # expired entries are probed again
+    config.set('execution', 'probe_cache_ttl', '0.000001')
+    yield assert_equal, toolcache.cached_probe('test', probe, ('FOO',),
+                                               (2,), env), 'v4'
+    config.set('execution', 'probe_cache_ttl', '86400')
+    # failed probes are run again unless cache_miss is set
+    calls = []
+    yield assert_equal, toolcache.cached_probe('test', lambda: calls.append(1)), None
+    yield assert_equal, toolcache.cached_probe('test', lambda: calls.append(1)), None
+    yield assert_equal, len(calls), 2
+    toolcache.cached_probe('test', lambda: calls.append(1), cache_miss=True)
+    toolcache.cached_probe('test', lambda: calls.append(1), cache_miss=True)
+    yield assert_equal, len(calls), 3
+    toolcache.clear_cache()
+
+
+def test_cached_probe_on_disk():
+    tempdir = mkdtemp()
+    old_data_file = config.data_file
+    config.data_file = os.path.join(tempdir, 'nipype.json')
+    config.set('execution', 'probe_cache_on_disk', 'true')
+    toolcache.clear_cache()
+    toolcache.cached_probe('test', lambda: 'on disk')
+    toolcache.clear_cache()
+    yield assert_equal, toolcache.cached_probe('test', lambda: 'new'), \
+        'on disk'
+    yield assert_true, len(config.get_data('probe_cache')) > 0
+    toolcache.clear_cache(disk=True)
+    yield assert_equal, config.get_data('probe_cache'), {}
+    config.set('execution', 'probe_cache_on_disk', 'false')
+    config.data_file = old_data_file
+    rmtree(tempdir)
+
+
+def test_which():
+    tempdir = mkdtemp()
+    toolcache.clear_cache()
+    env = {'PATH': tempdir}
+    yield assert_equal, toolcache.which('nipype_tool', env), None
+    tool = os.path.join(tempdir, 'nipype_tool')
+    open(tool, 'wt').close()
+    yield assert_equal, toolcache.which('nipype_tool', env), tool
+    os.remove(tool)
+    # successful lookups are cached
+    yield assert_equal, toolcache.which('nipype_tool', env), tool
+    toolcache.clear_cache()
+    rmtree(tempdir)
+
+
+def test_fsl_version():
+    tempdir = mkdtemp()
+    old_fsldir = os.environ.get('FSLDIR')
+    os.environ['FSLDIR'] = tempdir
+    os.mkdir(os.path.join(tempdir, 'etc'))
+    versionfile = os.path.join(tempdir, 'etc', 'fslversion')
+    open(versionfile, 'wt').write('4.1.9\n')
+    toolcache.clear_cache()
+    yield assert_equal, fsl.Info.version(), '4.1.9'
+    open(versionfile, 'wt').write('5.0.0\n')
+    yield assert_equal, fsl.Info.version(), '4.1.9'
+    toolcache.clear_cache()
+    yield assert_equal, fsl.Info.version(), '5.0.0'
+    if old_fsldir is None:
+        del os.environ['FSLDIR']
+    else:
+        os.environ['FSLDIR'] = old_fsldir
+    toolcache.clear_cache()
+    rmtree(tempdir)
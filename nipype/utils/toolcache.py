@@ -0,0 +1,138 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Process-wide cache of executable lookups and tool version probes
+
+Locating an executable stats every directory of the PATH and finding the
+version of a package often requires running one of its programs (or a whole
+MATLAB session for SPM). The results only change when the environment
+changes, so they are cached keyed by the relevant environment variables.
+
+Entries expire after `probe_cache_ttl` seconds (execution section of the
+config). With `probe_cache_on_disk` set, entries are also stored in the
+nipype data file (``~/.nipype/nipype.json``) and shared between processes.
+"""
+
+import os
+import threading
+from time import time
+
+from .. import config, logging
+logger = logging.getLogger('interface')
+
+_cache = {}
+_cache_lock = threading.Lock()
+_disk_key = 'probe_cache'
+
+
+def _ttl():
+    if config.has_option('execution', 'probe_cache_ttl'):
+        return float(config.get('execution', 'probe_cache_ttl'))
+    return 0
+
+
+def _use_disk():
+    return (config.has_option('execution', 'probe_cache_on_disk') and
+            config.getboolean('execution', 'probe_cache_on_disk'))
+
+
+def _make_key(name, env_vars, args, env):
+    if env is None:
+        env = os.environ
+    parts = [name] + ['%s=%s' % (var, env.get(var, ''))
+                      for var in ('PATH', 'PATHEXT') + tuple(env_vars)]
+    parts += [str(arg) for arg in args]
+    return '|'.join(parts)
+
+
+def _valid(entry, ttl):
+    return ttl <= 0 or time() - entry[0] < ttl
+
+
+def cached_probe(name, func, env_vars=(), args=(), env=None, cache_miss=False):
+    """Return ``func(*args)``, reusing a previous result if possible
+
+    Parameters
+    ----------
+    name : str
+        identifies the probe
+    func : callable
+        computes the value
+    env_vars : sequence of str
+        environment variables, besides PATH and PATHEXT, that the value
+        depends on
+    args : sequence
+        arguments passed to func; part of the key
+    env : dict
+        environment used to build the key (default: os.environ)
+    cache_miss : bool
+        if True, a result of None is cached too. By default a failed probe,
+        e.g. because of a missing license, is run again the next time.
+
+    """
+    key = _make_key(name, env_vars, args, env)
+    ttl = _ttl()
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry is not None and _valid(entry, ttl):
+        return entry[1]
+    if _use_disk():
+        disk_cache = config.get_data(_disk_key) or {}
+        entry = disk_cache.get(key)
+        if entry is not None and _valid(entry, ttl):
+            with _cache_lock:
+                _cache[key] = tuple(entry)
+            return entry[1]
+    value = func(*args)
+    if value is None and not cache_miss:
+        return value
+    entry = (time(), value)
+    with _cache_lock:
+        _cache[key] = entry
+    if _use_disk():
+        disk_cache = config.get_data(_disk_key) or {}
+        disk_cache[key] = entry
+        if ttl > 0:
+            disk_cache = dict([(k, v) for k, v in disk_cache.items()
+                               if _valid(v, ttl)])
+        try:
+            config.save_data(_disk_key, disk_cache)
+        except IOError, e:
+            logger.debug('Could not save probe cache: %s' % str(e))
+    return value
+
+
+def clear_cache(disk=False):
+    """Forget all cached probes, including the on-disk ones if `disk`
+    """
+    with _cache_lock:
+        _cache.clear()
+    if disk and config.get_data(_disk_key) is not None:
+        config.save_data(_disk_key, {})
+
+
+def _find_executable(cmd, path, pathext):
+    extensions = pathext.split(os.pathsep)
+    for directory in path.split(os.pathsep):
+        base = os.path.join(directory, cmd)
+        options = [base] + [(base + ext) for ext in extensions]
+        for filename in options:
+            if os.path.exists(filename):
+                return filename
+    return None
+
+
+def which(cmd, env=None):
+    """Return the path of executable `cmd` found in PATH or None
+
+    Only successful lookups are cached.
+
+    Based on a code snippet from
+    http://orip.org/2009/08/python-checking-if-executable-exists-in.html
+    """
+    if env is None:
+        env = os.environ
+    path = env.get('PATH', '')
+    pathext = env.get('PATHEXT', '')
+    return cached_probe('which',
+                        lambda cmd: _find_executable(cmd, path, pathext),
+                        args=(cmd,), env=env)